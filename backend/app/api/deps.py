@@ -0,0 +1,22 @@
+from fastapi import Request
+from ..services.service_integrator import ServiceIntegrator
+from ..services.job_queue import IngestionJobQueue
+from app.config import settings
+
+
+def get_service_integrator(request: Request) -> ServiceIntegrator:
+    """Return the application-scoped ServiceIntegrator built in the lifespan"""
+    service = getattr(request.app.state, "service_integrator", None)
+    if service is None:
+        # Lifespan did not run (e.g. app mounted without startup events)
+        service = ServiceIntegrator(settings)
+        request.app.state.service_integrator = service
+    return service
+
+
+def get_job_queue(request: Request) -> IngestionJobQueue:
+    """Return the ingestion job queue started in the lifespan"""
+    job_queue = getattr(request.app.state, "job_queue", None)
+    if job_queue is None:
+        raise RuntimeError("Ingestion job queue is not running")
+    return job_queue
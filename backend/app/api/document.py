@@ -1,7 +1,8 @@
-from fastapi import APIRouter, UploadFile, HTTPException
+from fastapi import APIRouter, UploadFile, HTTPException, Depends
 from pydantic import BaseModel
-from ..services.service_integrator import ServiceIntegrator
-from app.config import settings
+from ..services.job_queue import IngestionJobQueue
+from ..models.schemas import JobResponse, JobStatus
+from .deps import get_job_queue
 from typing import List
 import logging
 
@@ -17,20 +18,33 @@ class ProcessDocumentsRequest(BaseModel):
     chat_id: str
     documents: List[DocumentRequest]
 
-@router.post("/process")
-async def process_documents(request: ProcessDocumentsRequest):
-    """Process documents using their file paths"""
+@router.post("/process", status_code=202)
+async def process_documents(
+    request: ProcessDocumentsRequest,
+    job_queue: IngestionJobQueue = Depends(get_job_queue)
+):
+    """Queue documents for background processing and return the job id"""
     try:
         logger.info(f"Processing request: {request}")
-        service = ServiceIntegrator(settings)
         
-        results = await service.process_documents(
+        job_id = await job_queue.enqueue(
             chat_id=request.chat_id,
             documents=[{"id": doc.id, "file_path": doc.file_path} for doc in request.documents]
         )
         
-        return results
+        return {"job_id": job_id, "status": JobStatus.QUEUED}
         
     except Exception as e:
         logger.error(f"Error processing documents: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(
+    job_id: str,
+    job_queue: IngestionJobQueue = Depends(get_job_queue)
+):
+    """Report per-document progress and stage of an ingestion job"""
+    job = await job_queue.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
\ No newline at end of file
@@ -0,0 +1,71 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from starlette.datastructures import MutableHeaders
+from typing import Dict, List, Tuple
+import time
+from ..services.service_integrator import ServiceIntegrator
+from .deps import get_service_integrator
+from ..utils.metrics import HTTP_REQUEST_SECONDS, render_metrics, server_timing_header, start_request_timings
+
+router = APIRouter(tags=["metrics"])
+
+
+class MetricsMiddleware:
+    """Times every HTTP request per route and, with ``server_timing``, adds
+    a Server-Timing header breaking the request down by instrumented stage"""
+
+    def __init__(self, app, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings = start_request_timings() if self.server_timing else None
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                elapsed = time.perf_counter() - start
+                # The matched route's template keeps label cardinality bounded
+                route = getattr(scope.get("route"), "path", "unmatched")
+                HTTP_REQUEST_SECONDS.observe(elapsed, scope["method"], route, str(message["status"]))
+                if timings is not None:
+                    MutableHeaders(scope=message).append("Server-Timing", server_timing_header(timings, elapsed))
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+def _numeric(stats) -> Dict[str, float]:
+    if not isinstance(stats, dict):
+        return {}
+    return {
+        key: value for key, value in stats.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(service: ServiceIntegrator = Depends(get_service_integrator)):
+    """
+    Stage latency histograms, error counters and cache statistics in the
+    Prometheus text format
+    """
+    cache_stats = service.gemini.cache_stats()
+    coalescer = service.query_coalescer
+    extra: List[Tuple[str, str, Dict[str, float]]] = [
+        ("pdfchat_embedding_cache", "Embedding cache counters",
+         _numeric(cache_stats.get("embeddings") if isinstance(cache_stats, dict) else None)),
+        ("pdfchat_response_cache", "LLM response cache counters",
+         _numeric(cache_stats.get("responses") if isinstance(cache_stats, dict) else None)),
+        ("pdfchat_query_coalescing", "Query coalescing counters",
+         _numeric(coalescer.stats() if coalescer is not None else None)),
+        ("pdfchat_chunk_writes", "Chunk insert counters", _numeric(service.supabase.write_stats())),
+    ]
+    return PlainTextResponse(
+        render_metrics([entry for entry in extra if entry[2]]),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
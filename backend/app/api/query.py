@@ -1,8 +1,13 @@
 from fastapi import APIRouter, HTTPException, Depends
-from typing import Optional, List
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, Optional, List
+import json
+from ..config import settings
 from ..services.service_integrator import ServiceIntegrator
-from app.config import settings
-from ..models.schemas import QueryRequest, QueryResponse
+from .deps import get_service_integrator
+from ..models.schemas import (
+    BatchQueryRequest, BatchQueryResponse, BatchQueryResult, QueryRequest, QueryResponse, SourceReference
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,12 +15,14 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/query", tags=["query"])
 
 @router.post("/", response_model=QueryResponse)
-async def query_documents(request: QueryRequest):
+async def query_documents(
+    request: QueryRequest,
+    service: ServiceIntegrator = Depends(get_service_integrator)
+):
     """
     Query processed documents and get relevant responses
     """
     try:
-        service = ServiceIntegrator(settings)
         result = await service.query_documents(
             query=request.query,
             chat_id=request.chat_id,
@@ -29,4 +36,93 @@ async def query_documents(request: QueryRequest):
         
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/batch", response_model=BatchQueryResponse)
+async def query_documents_batch(
+    request: BatchQueryRequest,
+    service: ServiceIntegrator = Depends(get_service_integrator)
+):
+    """
+    Answer many questions against the same documents in one request. Results
+    are in question order; a question that could not be answered has an
+    "error" instead of a "response"
+    """
+    limit = settings.QUERY_BATCH_MAX_QUESTIONS
+    if len(request.queries) > limit:
+        raise HTTPException(status_code=400, detail=f"At most {limit} queries per batch")
+
+    try:
+        results = await service.query_documents_batch(
+            queries=request.queries,
+            chat_id=request.chat_id,
+            document_ids=request.document_ids
+        )
+
+        return BatchQueryResponse(results=[BatchQueryResult(**result) for result in results])
+
+    except Exception as e:
+        logger.error(f"Error processing batch query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _encode_event(event: Dict) -> str:
+    if event['event'] == 'sources':
+        # Same validation and fields as QueryResponse.source_references
+        return _sse('sources', [
+            SourceReference.model_validate(chunk).model_dump(mode="json") for chunk in event['data']
+        ])
+    return _sse(event['event'], event['data'])
+
+
+@router.post("/stream")
+async def query_documents_stream(
+    request: QueryRequest,
+    service: ServiceIntegrator = Depends(get_service_integrator)
+):
+    """
+    Query processed documents and stream the response as Server-Sent Events:
+    a "sources" event with the source references, "token" events with the
+    generated text, then "done" (or "error" if generation fails)
+    """
+    events = service.query_documents_stream(
+        query=request.query,
+        chat_id=request.chat_id,
+        document_ids=request.document_ids
+    )
+    try:
+        # Retrieval runs before the response starts, so its failures are plain HTTP errors
+        first = await events.__anext__()
+    except Exception as e:
+        logger.error(f"Error processing query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def stream() -> AsyncIterator[str]:
+        try:
+            yield _encode_event(first)
+            async for event in events:
+                yield _encode_event(event)
+        except Exception as e:
+            logger.error(f"Error streaming query: {str(e)}")
+            yield _sse('error', {'detail': str(e)})
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/cache-stats")
+async def cache_stats(service: ServiceIntegrator = Depends(get_service_integrator)):
+    """
+    Hit-rate metrics of the embedding and LLM response caches, and of
+    query coalescing
+    """
+    coalescer = service.query_coalescer
+    return {**service.gemini.cache_stats(), "queries": coalescer.stats() if coalescer is not None else None}
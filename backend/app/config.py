@@ -1,26 +1,114 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Optional
 
 class Settings(BaseSettings):
     # API Configuration
     API_V1_STR: str = "/api/v1"
     PROJECT_NAME: str = "Financial Document Processor"
+    SERVER_TIMING_ENABLED: bool = False  # Add a per-request Server-Timing header with instrumented stage durations
     
     # Supabase Configuration
     SUPABASE_URL: str
     SUPABASE_KEY: str
     SUPABASE_SERVICE_KEY: str
+    SUPABASE_MAX_WORKERS: int = 16  # Threads available for blocking supabase-py calls
+    SUPABASE_TIMEOUT: float = 30.0  # HTTP timeout of database and storage calls; a hung call fails and frees its thread
+    CHUNK_INSERT_BATCH_ROWS: int = 200  # Max chunk rows per insert request
+    CHUNK_INSERT_BATCH_BYTES: int = 2 * 1024 * 1024  # Max estimated request body per insert
+    CHUNK_INSERT_CONCURRENCY: int = 4  # Insert requests in flight per store_chunks call
+    CHUNK_INSERT_MAX_RETRIES: int = 3  # Retries of a failed batch, as an idempotent upsert
+    CHUNK_INSERT_RETRY_BACKOFF: float = 0.5  # Seconds before the first retry; doubles each time
+    CHUNK_READ_PAGE_ROWS: int = 1000  # Rows per paged chunk read; must not exceed PostgREST's max-rows
     
     # Google API Configuration
     GOOGLE_API_KEY: str
 
+    # Embedding Configuration
+    EMBEDDING_MODEL: str = "models/text-embedding-004"
+    EMBEDDING_BATCH_SIZE: int = 100  # Texts per batchEmbedContents request (API max is 100)
+    EMBEDDING_MAX_CONCURRENT_BATCHES: int = 4
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_MAX_BYTES: int = 64 * 1024 * 1024  # 64MB of float32 vectors in memory
+    EMBEDDING_CACHE_PATH: Optional[str] = None  # SQLite file for a persistent tier, e.g. ".cache/embeddings.db"
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MAX_BYTES: int = 16 * 1024 * 1024  # 16MB of generated responses in memory
+    RESPONSE_CACHE_TTL_SECONDS: int = 24 * 60 * 60  # Responses are regenerated after a day; 0 keeps them until evicted
+    RESPONSE_CACHE_PATH: Optional[str] = None  # SQLite file for a persistent tier, e.g. ".cache/responses.db"
+
+    EMBEDDING_DIMENSION: int = 768
+    # "float" stores only the pgvector column; "float16" / "int8" also store a compact
+    # base64 blob in chunks.embedding_q, which the local index loads instead
+    EMBEDDING_STORAGE_FORMAT: str = "float"
+
+    # Retrieval Configuration
+    RETRIEVAL_BACKEND: str = "supabase"  # "supabase" (match_documents RPC), "local" (exact NumPy index) or "ivf" (approximate)
+    # "float16" halves / "int8" quarters index memory at a small accuracy cost, but each query
+    # upcasts the stored vectors to float32 block by block: at 100k 768-d chunks a search takes
+    # ~35 ms p50 with float32, ~280 ms (8x) with float16 and ~75 ms (2x) with int8
+    LOCAL_INDEX_DTYPE: str = "float32"
+    LOCAL_INDEX_LOAD_CONCURRENCY: int = 4  # Documents fetched at once when a chat's index is first loaded
+    QUANTIZED_RERANK_FACTOR: int = 4  # Re-score limit * factor quantized candidates with exact embeddings; 0 disables
+    IVF_NPROBE: int = 16  # Cells scanned per query; higher means better recall and slower queries
+    IVF_NLIST: Optional[int] = None  # Cells per chat index; defaults to sqrt(chunk count)
+    IVF_MIN_TRAIN_SIZE: int = 10000  # Smaller chats are searched exactly
+    IVF_INDEX_DIR: str = "data/vector_index"
+    HYBRID_RETRIEVAL: bool = True  # Fuse BM25 keyword matches with vector matches by reciprocal rank
+    HYBRID_CANDIDATES: int = 20  # Candidates taken from each of the vector and BM25 lists before fusion
+    LEXICAL_INDEX_MAX_CHATS: int = 32  # BM25 indexes kept in memory per process; the least recently queried chat is evicted
+    LEXICAL_INDEX_REFRESH_SECONDS: float = 30.0  # A chat's BM25 index is re-checked against its documents' fingerprints after this long
+    RRF_K: int = 60  # Reciprocal-rank fusion constant; larger values flatten the rank weighting
+    BM25_K1: float = 1.2
+    BM25_B: float = 0.75
+    MMR_ENABLED: bool = True  # Re-rank over-fetched candidates for diversity (maximal marginal relevance); local/ivf backends only
+    MMR_LAMBDA: float = 0.7  # 1.0 ranks purely by relevance; lower values favour diversity
+    MMR_FETCH_FACTOR: int = 4  # Candidates fetched per returned chunk before re-ranking
+    TABLE_WINDOW_SIZE: int = 5  # Chunks either side of the best match searched for a table on the same page
+    TABLE_INDEX_MAX_DOCUMENTS: int = 1024  # Documents whose table positions are kept in memory per process
+    TABLE_INDEX_REFRESH_SECONDS: float = 30.0  # A document's tables are re-checked against its fingerprint after this long
+    QUERY_COALESCING_ENABLED: bool = True  # Identical concurrent queries share one retrieval and generation
+    QUERY_COALESCE_GRACE_SECONDS: float = 2.0  # A finished query's result also serves identical requests this long after
+    QUERY_BATCH_MAX_QUESTIONS: int = 100  # Questions accepted by one POST /query/batch
+    QUERY_BATCH_CONCURRENCY: int = 4  # Answers generated at once per batch
+
     # Unstructured API Configuration
     UNSTRUCTURED_API_KEY: str
     UNSTRUCTURED_API_URL: str
+    EXTRACTION_BACKEND: str = "api"  # "api" (hosted Unstructured) or "local" (unstructured[pdf] in a process pool)
+    LOCAL_EXTRACTION_WORKERS: Optional[int] = None  # Defaults to the CPU count
+    LOCAL_EXTRACTION_MAX_TASKS_PER_WORKER: int = 20  # Replace a worker after this many partitions to cap memory; 0 disables
     
+    # Bump when extraction or chunking changes so re-ingestion does not reuse stale chunks
+    EXTRACTION_CONFIG_VERSION: str = "unstructured-hi_res-v3"
+    CHUNK_MAX_TOKENS: int = 400  # Budget for merging consecutive text elements into one chunk; 0 keeps one per element
+    CHUNK_OVERLAP_TOKENS: int = 50  # Tail of a full chunk repeated at the start of the next one on the same page
+
+    # Shared HTTP connection pool (downloads and Unstructured API)
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0  # Seconds an idle connection is kept open
+    HTTP_TIMEOUT: float = 300.0  # Hi-res partitioning of large PDFs can take minutes
+
     # Processing Configuration
-    MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10MB
+    MAX_FILE_SIZE: int = 500 * 1024 * 1024  # 500MB; downloads are streamed to disk
+    DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024  # Bytes read from the network per iteration
+    DOWNLOAD_SPOOL_MAX_BYTES: int = 8 * 1024 * 1024  # Larger downloads spill to a temp file
+    DOWNLOAD_TEMP_DIR: Optional[str] = None  # Defaults to the system temp directory
     ALLOWED_EXTENSIONS: set = {"pdf"}
+    INGESTION_CONCURRENCY: int = 3  # Ingestion workers per process, shared by all requests
+    JOB_QUEUE_PATH: str = "data/jobs.db"
+    JOB_QUEUE_POLL_INTERVAL: float = 5.0  # Seconds an idle worker waits before re-checking the queue
+    JOB_QUEUE_LEASE_SECONDS: float = 60.0  # A running document whose process stops renewing this long is re-queued
+
+    # Ingestion pipeline: page batches stream through extraction, embedding and storage
+    PIPELINE_PAGES_PER_BATCH: int = 10  # Pages partitioned per extraction request
+    EXTRACTION_FANOUT: int = 8  # Page ranges partitioned concurrently per document
+    EXTRACTION_ROUTING: bool = False  # Take plain text pages from the PDF text layer; only scanned/table pages use hi_res
+    EXTRACTION_MIN_TEXT_CHARS: int = 100  # Pages with less embedded text are treated as scanned
+    EXTRACTION_TABLE_MIN_ROWS: int = 3  # Lines with 2+ figures (e.g. two periods) that mark a page as holding a table
+    PIPELINE_QUEUE_SIZE: int = 4  # Batches buffered between stages before the upstream stage waits
+    PIPELINE_EMBED_CONCURRENCY: int = 2
+    PIPELINE_STORE_CONCURRENCY: int = 2
     
     class Config:
         env_file = ".env"
@@ -16,6 +16,14 @@ class ProcessingStatus(str, Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    PARTIAL = "partial"
+    FAILED = "failed"
+
 # Table Data Models
 
 
@@ -50,6 +58,23 @@ class QueryResponse(BaseModel):
     source_references: List[SourceReference]
 
 
+class BatchQueryRequest(BaseModel):
+    queries: conlist(str, min_length=1)
+    chat_id: UUID4
+    document_ids: Optional[List[int]] = None
+
+
+class BatchQueryResult(BaseModel):
+    query: str
+    response: Optional[str] = None
+    source_references: List[SourceReference]
+    error: Optional[str] = None
+
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchQueryResult]
+
+
 class ProcessingResponse(BaseModel):
     filename: str
     status: str = Field(default="success")
@@ -78,6 +103,25 @@ class ProcessingResponse(BaseModel):
             error=error
         )
 
+# Ingestion Job Models
+
+
+class JobDocumentStatus(BaseModel):
+    document_id: int
+    status: str
+    stage: str
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    updated_at: datetime
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    chat_id: str
+    created_at: datetime
+    status: JobStatus
+    documents: List[JobDocumentStatus]
+
 # Database Models
 
 
@@ -89,6 +133,7 @@ class Document(BaseModel):
     page_count: Optional[int]
     file_path: str
     processing_status: ProcessingStatus
+    content_fingerprint: Optional[str] = None
 
     class Config:
         from_attributes = True
@@ -102,6 +147,9 @@ class Chunk(BaseModel):
     text: str
     page_number: int
     table_data: Optional[Dict] = None
+    # Range of extracted elements merged into this chunk
+    element_start: Optional[int] = None
+    element_end: Optional[int] = None
     # Validate embedding dimension
     embedding: conlist(float, min_length=768, max_length=768)
 
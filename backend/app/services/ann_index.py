@@ -0,0 +1,269 @@
+import asyncio
+import json
+import logging
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from .vector_index import ChatVectorIndex
+
+logger = logging.getLogger(__name__)
+
+
+class IVFChatIndex(ChatVectorIndex):
+    """Inverted-file approximate index over one chat's chunk embeddings.
+
+    Vectors are partitioned by spherical k-means into ``nlist`` cells; a
+    query scores only the rows in the ``nprobe`` cells whose centroids are
+    closest, then applies the usual threshold/top-k on exact similarities.
+    Raising ``nprobe`` trades latency for recall. Until the index holds
+    ``min_train_size`` vectors it behaves as an exact index.
+
+    Inserts never train the index themselves; the owner checks
+    ``needs_training`` and runs ``train_in_background``, which fits on a
+    worker thread while the index keeps serving and swaps the new cells in
+    at once.
+    """
+
+    def __init__(
+        self,
+        dimension: int = 768,
+        dtype: str = "float32",
+        nprobe: int = 16,
+        nlist: Optional[int] = None,
+        min_train_size: int = 10000,
+        kmeans_iterations: int = 10,
+        seed: int = 0
+    ):
+        super().__init__(dimension=dimension, dtype=dtype)
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.min_train_size = min_train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.empty(0, dtype=np.int32)
+        self._lists: Optional[List[np.ndarray]] = None
+        self._trained_size = 0
+        self._generation = 0  # Bumped by removals, which renumber rows
+        self._written: Optional[List[np.ndarray]] = None  # Rows written while a fit is in flight
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def upsert(self, document_id: int, document_name: Optional[str], chunks: List[Dict]) -> np.ndarray:
+        positions = super().upsert(document_id, document_name, chunks)
+        if self.trained and len(positions):
+            missing = len(self.rows) - len(self.assignments)
+            if missing > 0:
+                self.assignments = np.concatenate([self.assignments, np.full(missing, -1, dtype=np.int32)])
+            self.assignments[positions] = self._assign(self.vectors[positions])
+            self._lists = None
+        if self._written is not None:
+            self._written.append(positions)
+        return positions
+
+    def remove(self, document_id: int, from_index: int = 0) -> Optional[np.ndarray]:
+        keep = super().remove(document_id, from_index)
+        if keep is not None:
+            self._generation += 1
+            if self.trained:
+                self.assignments = self.assignments[keep]
+                self._lists = None
+        return keep
+
+    def needs_training(self) -> bool:
+        """Large enough to train, or grown enough to refit, with no fit in flight"""
+        if self._written is not None:
+            return False
+        n = len(self.rows)
+        if not self.trained:
+            return n >= self.min_train_size
+        # Cells drift as the chat grows; refit once it has quadrupled
+        return n >= 4 * self._trained_size
+
+    def train(self):
+        """Fit centroids and assign every row, blocking the caller"""
+        n = len(self.rows)
+        self._install(*self._fit(self.vectors, self.scales), n)
+
+    async def train_in_background(self) -> bool:
+        """Fit on a worker thread, then swap the new cells in on the event loop.
+
+        The fit reads the rows present when it starts; rows written while it
+        runs are assigned to the new cells when they are swapped in. A removal
+        renumbers rows, so the result is discarded and False returned.
+        """
+        generation, n = self._generation, len(self.rows)
+        self._written = []
+        try:
+            centroids, assignments = await asyncio.to_thread(self._fit, self.vectors, self.scales)
+            if generation != self._generation:
+                logger.info("IVF index changed during training, discarding the fit")
+                return False
+            written = np.unique(np.concatenate(self._written)) if self._written else np.empty(0, dtype=np.int64)
+            self._install(centroids, assignments, n, written)
+            return True
+        finally:
+            self._written = None
+
+    def _install(
+        self,
+        centroids: np.ndarray,
+        assignments: np.ndarray,
+        trained_size: int,
+        written: Optional[np.ndarray] = None
+    ):
+        """Swap in fitted cells; rows added or rewritten since the fit are assigned now"""
+        assignments = np.concatenate([assignments, np.full(len(self.rows) - trained_size, -1, dtype=np.int32)])
+        stale = np.union1d(
+            written if written is not None else np.empty(0, dtype=np.int64),
+            np.arange(trained_size, len(self.rows))
+        ).astype(np.int64)
+        if len(stale):
+            assignments[stale] = self._assign(self.vectors[stale], centroids)
+        self.centroids, self.assignments = centroids, assignments
+        self._lists = None
+        self._trained_size = trained_size
+        logger.info(f"Trained IVF index: {trained_size} vectors, {len(centroids)} lists")
+
+    def _fit(self, vectors: np.ndarray, scales: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Spherical k-means on a sample of the rows; returns (centroids, row assignments).
+
+        Only reads its arguments, so it can run off the event loop.
+        """
+        n = len(vectors)
+        nlist = min(n, self.nlist or max(1, int(math.sqrt(n))))
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(n, nlist * 64)
+        rows = rng.choice(n, sample_size, replace=False)
+        sample = vectors[rows].astype(np.float32)
+        if self.dtype == np.int8:
+            sample *= scales[rows][:, None]
+
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind='stable')
+            counts = np.bincount(labels, minlength=nlist)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            non_empty = counts > 0
+            sums = np.zeros_like(centroids)
+            sums[non_empty] = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+            # Re-seed empty cells with random sample points
+            sums[~non_empty] = sample[rng.choice(sample_size, int((~non_empty).sum()))]
+            centroids = self._normalize(sums)
+
+        centroids = centroids.astype(np.float32)
+        return centroids, self._assign(vectors, centroids)
+
+    def _assign(self, vectors: np.ndarray, centroids: Optional[np.ndarray] = None) -> np.ndarray:
+        """Nearest cell of each stored vector (int8 scales are positive, so they can be skipped)"""
+        centroids = self.centroids if centroids is None else centroids
+        block = 8192
+        return np.concatenate([
+            np.argmax(vectors[i:i + block].astype(np.float32) @ centroids.T, axis=1)
+            for i in range(0, len(vectors), block)
+        ]).astype(np.int32) if len(vectors) else np.empty(0, dtype=np.int32)
+
+    def _inverted_lists(self) -> List[np.ndarray]:
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind='stable')
+            counts = np.bincount(self.assignments, minlength=len(self.centroids))
+            self._lists = np.split(order, np.cumsum(counts)[:-1])
+        return self._lists
+
+    def search_many(
+        self,
+        embeddings: List[List[float]],
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[List[Dict]]:
+        if not self.trained:
+            return super().search_many(embeddings, document_ids=document_ids, threshold=threshold, limit=limit)
+        # Each query probes its own cells, so there is no shared candidate set to score at once
+        return [
+            self.search(embedding, document_ids=document_ids, threshold=threshold, limit=limit)
+            for embedding in embeddings
+        ]
+
+    def _candidates(self, query: np.ndarray, document_ids: Optional[List[int]]) -> Optional[np.ndarray]:
+        if not self.trained:
+            return super()._candidates(query, document_ids)
+
+        lists = self._inverted_lists()
+        scores = self.centroids @ query
+        if self.nprobe < len(scores):
+            probe = np.argpartition(-scores, self.nprobe - 1)[:self.nprobe]
+        else:
+            probe = np.arange(len(scores))
+        rows = np.concatenate([lists[i] for i in probe])
+        if document_ids:
+            rows = rows[np.isin(self.document_ids[rows], document_ids)]
+        return rows
+
+    def save(self, path: str, metadata: Optional[Dict] = None):
+        """Write arrays to ``path``.npz and rows plus metadata to ``path``.json"""
+        self.write(path, self.snapshot(metadata))
+
+    def snapshot(self, metadata: Optional[Dict] = None) -> Dict:
+        """The index's current contents for ``write``; cheap enough for the event loop"""
+        return {
+            "arrays": {
+                "vectors": self.vectors,
+                "scales": self.scales,
+                "document_ids": self.document_ids,
+                "centroids": self.centroids if self.trained else np.empty((0, self.dimension), dtype=np.float32),
+                "assignments": self.assignments.copy(),
+            },
+            "rows": list(self.rows),
+            "trained_size": self._trained_size,
+            "metadata": metadata or {},
+        }
+
+    @staticmethod
+    def write(path: str, snapshot: Dict):
+        """Write a ``snapshot`` to disk; safe to run on a worker thread"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.npz.tmp", "wb") as f:
+            np.savez(f, **snapshot["arrays"])
+        with open(f"{path}.json.tmp", "w") as f:
+            json.dump({key: snapshot[key] for key in ("rows", "trained_size", "metadata")}, f)
+        os.replace(f"{path}.npz.tmp", f"{path}.npz")
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    @classmethod
+    def load(cls, path: str, **params) -> Optional[Tuple["IVFChatIndex", Dict]]:
+        """Load an index saved with save(); returns (index, metadata) or None"""
+        if not (os.path.exists(f"{path}.npz") and os.path.exists(f"{path}.json")):
+            return None
+        try:
+            arrays = np.load(f"{path}.npz")
+            with open(f"{path}.json") as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading IVF index from {path}: {str(e)}")
+            return None
+
+        index = cls(**params)
+        if arrays["vectors"].dtype != index.dtype:
+            logger.info(f"Persisted index at {path} uses {arrays['vectors'].dtype}, rebuilding")
+            return None
+        index.vectors = arrays["vectors"]
+        index.scales = arrays["scales"]
+        index.document_ids = arrays["document_ids"]
+        index.rows = stored["rows"]
+        index._positions = {
+            (row['document_id'], row['chunk_index']): position
+            for position, row in enumerate(index.rows)
+        }
+        index._rebuild_document_rows()
+        if len(arrays["centroids"]):
+            index.centroids = arrays["centroids"]
+            index.assignments = arrays["assignments"]
+            index._trained_size = stored["trained_size"]
+        return index, stored["metadata"]
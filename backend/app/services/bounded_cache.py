@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedCache(ABC):
+    """In-process LRU bounded by the byte size of its values, with an optional SQLite tier.
+
+    Entries are keyed by a hash of a model name and the whitespace-
+    normalized input text. When ``db_path`` is set every entry is also
+    written to a SQLite file so the cache stays warm across restarts; its
+    reads and writes run on worker threads, off the event loop. With
+    ``ttl_seconds`` entries expire (the table then has an ``expires_at``
+    column); 0 keeps them until evicted.
+
+    Subclasses name their table and value column, size values with
+    ``_size`` and convert them to and from what is stored with ``_to_db``
+    and ``_from_db``.
+    """
+
+    TABLE = ""
+    COLUMN = ""
+    COLUMN_TYPE = "BLOB"
+    EXPIRES = False  # Whether the table stores an expiry time per entry
+    LOAD_BATCH_KEYS = 500  # Keys per SELECT ... IN, below SQLite's bound-parameter limit
+
+    def __init__(self, max_bytes: int, db_path: Optional[str] = None, ttl_seconds: float = 0):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.current_bytes = 0
+        # key -> (value, expires_at, size)
+        self._entries: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()  # One statement at a time on the shared connection
+        self._db: Optional[sqlite3.Connection] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.expirations = 0
+        self.evictions = 0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str):
+        """Open (and create if needed) the persistent SQLite tier"""
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+            f"(key TEXT PRIMARY KEY, {self.COLUMN} {self.COLUMN_TYPE} NOT NULL"
+            f"{', expires_at REAL NOT NULL' if self.EXPIRES else ''})"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Collapse whitespace so trivially different copies share an entry"""
+        return " ".join(text.split()) if text else ""
+
+    @classmethod
+    def make_key(cls, model: str, text: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(model.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(cls.normalize(text).encode("utf-8"))
+        return digest.hexdigest()
+
+    @abstractmethod
+    def _size(self, value: Any) -> int:
+        """Bytes a value counts against ``max_bytes``"""
+
+    def _to_db(self, value: Any) -> Any:
+        return value
+
+    def _from_db(self, stored: Any) -> Any:
+        return stored
+
+    async def _get(self, key: str) -> Optional[Any]:
+        """The live value for ``key`` from memory or disk, or None"""
+        return (await self._get_many([key]))[0]
+
+    async def _get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """Live values for ``keys`` (None where missing); memory misses are read from disk in one query"""
+        now = time.time()
+        values: List[Optional[Any]] = [None] * len(keys)
+        missing: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    if entry[1] > now:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        values[i] = entry[0]
+                        continue
+                    self._remove(key)
+                    self.expirations += 1
+                missing.setdefault(key, []).append(i)
+
+        loaded = {}
+        if missing and self._db is not None:
+            loaded = await asyncio.to_thread(self._load_many, list(missing), now)
+        with self._lock:
+            for key, positions in missing.items():
+                entry = loaded.get(key)
+                if entry is None:
+                    self.misses += len(positions)
+                    continue
+                self.hits += len(positions)
+                self.disk_hits += len(positions)
+                self._insert(key, *entry)
+                for i in positions:
+                    values[i] = entry[0]
+        return values
+
+    async def _put(self, items: List[Tuple[str, Any]]):
+        """Store (key, value) pairs in memory and, if enabled, on disk"""
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds else float("inf")
+        with self._lock:
+            for key, value in items:
+                self._insert(key, value, expires_at)
+        if self._db is not None:
+            await asyncio.to_thread(self._store, [(key, self._to_db(value), expires_at) for key, value in items])
+
+    def _insert(self, key: str, value: Any, expires_at: float):
+        size = self._size(value)
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (value, expires_at, size)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        existing = self._entries.pop(key, None)
+        if existing is not None:
+            self.current_bytes -= existing[2]
+
+    def _load_many(self, keys: List[str], now: float) -> Dict[str, Tuple[Any, float]]:
+        """Read live entries from disk, ``LOAD_BATCH_KEYS`` per query; runs on a worker thread"""
+        entries: Dict[str, Tuple[Any, float]] = {}
+        expiry = "expires_at" if self.EXPIRES else "NULL"
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    return entries
+                for start in range(0, len(keys), self.LOAD_BATCH_KEYS):
+                    batch = keys[start:start + self.LOAD_BATCH_KEYS]
+                    query = (
+                        f"SELECT key, {self.COLUMN}, {expiry} FROM {self.TABLE} "
+                        f"WHERE key IN ({', '.join('?' * len(batch))})"
+                    )
+                    if self.EXPIRES:
+                        rows = self._db.execute(query + " AND expires_at > ?", (*batch, now))
+                    else:
+                        rows = self._db.execute(query, batch)
+                    for key, stored, expires_at in rows:
+                        entries[key] = self._from_db(stored), expires_at if expires_at is not None else float("inf")
+        except sqlite3.Error as e:
+            logger.error(f"Error reading {self.TABLE} cache: {str(e)}")
+        return entries
+
+    def _store(self, rows: List[Tuple[str, Any, float]]):
+        """Write (key, stored value, expires_at) rows in one transaction; runs on a worker thread"""
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    return
+                if self.EXPIRES:
+                    self._db.executemany(
+                        f"INSERT OR REPLACE INTO {self.TABLE} (key, {self.COLUMN}, expires_at) VALUES (?, ?, ?)",
+                        rows
+                    )
+                else:
+                    self._db.executemany(
+                        f"INSERT OR REPLACE INTO {self.TABLE} (key, {self.COLUMN}) VALUES (?, ?)",
+                        [(key, value) for key, value, _ in rows]
+                    )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error writing {self.TABLE} cache: {str(e)}")
+
+    def stats(self) -> Dict:
+        """Hit/miss/eviction counters and current memory usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,30 +1,73 @@
+import io
 import os
+import re
 import json
 import logging
-from typing import Dict, List, Any
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, BinaryIO, Deque, Dict, List, Any, Optional, Tuple
 from ..config import Settings
 from fastapi import UploadFile
 import asyncio
+import httpx
+import tempfile
+from pypdf import PdfReader, PdfWriter
+from pypdf.errors import PdfReadError
 from unstructured_client import UnstructuredClient
 from unstructured_client.models.shared import Strategy, ChunkingStrategy
+from .local_extractor import LocalPartitioner
+from ..utils.chunking import assemble_chunks, shift_element_ranges
+from ..utils.tables import parse_table_html
+from ..utils.metrics import timed
 
 logger = logging.getLogger(__name__)
 
+# A figure in a table column: 1,234  (56.7)  -12%  $3.50  $ 29,965
+FIGURE = re.compile(r"(?<!\S)\(?[-+]?(?:[$€£]\s?)?\d(?:[\d,]*\d)?(?:\.\d+)?%?\)?(?!\S)")
+
 class DocumentExtractor:
-    def __init__(self, settings: Settings):
+    def __init__(self, settings: Settings, http_client: Optional[httpx.AsyncClient] = None):
         self.api_key = settings.UNSTRUCTURED_API_KEY
         self.api_url = settings.UNSTRUCTURED_API_URL
+        self.temp_dir = settings.DOWNLOAD_TEMP_DIR
+        self.spool_max_bytes = settings.DOWNLOAD_SPOOL_MAX_BYTES
+        self.pages_per_batch = max(1, settings.PIPELINE_PAGES_PER_BATCH)
+        self.fanout = max(1, settings.EXTRACTION_FANOUT)
+        self.routing = settings.EXTRACTION_ROUTING
+        self.min_text_chars = settings.EXTRACTION_MIN_TEXT_CHARS
+        self.table_min_rows = settings.EXTRACTION_TABLE_MIN_ROWS
+        self.chunk_max_tokens = settings.CHUNK_MAX_TOKENS
+        self.chunk_overlap_tokens = settings.CHUNK_OVERLAP_TOKENS
         self.client = UnstructuredClient(
             api_key_auth=self.api_key,
-            server_url=self.api_url
+            server_url=self.api_url,
+            async_client=http_client
         )
+        self.local_partitioner = None
+        if settings.EXTRACTION_BACKEND == "local":
+            self.local_partitioner = LocalPartitioner(
+                workers=settings.LOCAL_EXTRACTION_WORKERS,
+                max_tasks_per_worker=settings.LOCAL_EXTRACTION_MAX_TASKS_PER_WORKER
+            )
+        elif settings.EXTRACTION_BACKEND != "api":
+            raise ValueError(f"Unknown extraction backend: {settings.EXTRACTION_BACKEND}")
+
+    def close(self):
+        """Stop the local extraction workers, if any"""
+        if self.local_partitioner is not None:
+            self.local_partitioner.close()
 
     def _clean_text(self, text: str) -> str:
         """Clean and normalize text content."""
         return " ".join(text.split()).strip() if text else ""
 
     def _process_response(self, response_elements: List[Dict], filename: str) -> Dict:
-        """Process the response from Unstructured API."""
+        """Process the response from Unstructured API.
+
+        Consecutive text elements are merged into chunks of up to
+        CHUNK_MAX_TOKENS; each chunk records its source element range.
+        """
         elements = []
         total_pages = 0
         
@@ -41,18 +84,21 @@ class DocumentExtractor:
                 text = self._clean_text(element.get("text", ""))
                 html = element.get("metadata", {}).get("text_as_html", "")
                 
-                # Create table data structure
+                # Create table data structure; parsed once here so queries need no LLM conversion
                 table_data = {
                     "text": text,
                     "html": html,
-                    "page_number": page_number
+                    "page_number": page_number,
+                    "structured": self._parse_table(html, filename, page_number)
                 }
                 
                 elements.append({
                     "text": text,
                     "page_number": page_number,
                     "chunk_type": "table",
-                    "table_data": json.dumps(table_data)  # Store as JSON string for database
+                    "table_data": json.dumps(table_data),  # Store as JSON string for database
+                    "element_index": len(elements),
+                    "element_type": element_type
                 })
             elif element_type in ["text", "title", "narrativetext", "uncategorizedtext", "compositeelement"]:
                 cleaned_text = self._clean_text(element.get("text", ""))
@@ -61,9 +107,26 @@ class DocumentExtractor:
                         "text": cleaned_text, 
                         "page_number": page_number,
                         "chunk_type": "text",
-                        "table_data": None
+                        "table_data": None,
+                        "element_index": len(elements),
+                        "element_type": element_type
                     })
 
+        element_count = len(elements)
+        elements = assemble_chunks(elements, self.chunk_max_tokens, self.chunk_overlap_tokens)
+        return self._build_result(elements, filename, total_pages, element_count)
+
+    def _parse_table(self, html: str, filename: str, page_number: int) -> Optional[Dict]:
+        """Structured table data, or None if the HTML cannot be parsed"""
+        if not html:
+            return None
+        try:
+            return parse_table_html(html)
+        except Exception as e:
+            logger.error(f"Error parsing table on page {page_number} of {filename}: {str(e)}")
+            return None
+
+    def _build_result(self, elements: List[Dict], filename: str, total_pages: int, element_count: int) -> Dict:
         text_chunks = [e for e in elements if e["chunk_type"] == "text"]
         tables = [e for e in elements if e["chunk_type"] == "table"]
 
@@ -75,20 +138,32 @@ class DocumentExtractor:
                 "filename": filename,
                 "total_pages": total_pages,
                 "chunk_count": len(elements),
+                "element_count": element_count,
             },
         }
 
-    async def process_file(self, file: UploadFile) -> Dict:
-        """Process single PDF file using unstructured API with title strategy"""
-        try:
-            content = await file.read()
-            logger.info(f"Processing file {file.filename} with Unstructured API SDK (async)")
+    async def _partition(
+        self,
+        content: BinaryIO,
+        file_name: str,
+        starting_page_number: Optional[int] = None
+    ) -> List[Dict]:
+        """Partition a file with the API, or the local process pool when configured.
+
+        ``starting_page_number`` marks ``content`` as a page range cut out
+        locally: the SDK's own page splitting is turned off and page numbers
+        are offset so they stay absolute.
+        """
+        if self.local_partitioner is not None:
+            with timed('extract.partition_local'):
+                return await self.local_partitioner.partition(content, file_name, starting_page_number)
 
+        with self._sdk_content(content) as upload:
             req = {
                 "partition_parameters": {
                     "files": {
-                        "content": content,
-                        "file_name": file.filename,
+                        "content": upload,
+                        "file_name": file_name,
                     },
 
                     "strategy": Strategy.HI_RES,
@@ -98,17 +173,229 @@ class DocumentExtractor:
                     "hierarchy": True,
                     "add_document_metadata": True,
                     "include_table_data": True,
-                    "output_format": "application/json"
+                    "output_format": "application/json",
+                    # Page splits are cached on disk instead of in memory
+                    "split_pdf_cache_tmp_data": True,
+                    **({"split_pdf_cache_tmp_data_dir": self.temp_dir} if self.temp_dir else {}),
+                    **({
+                        "split_pdf_page": False,
+                        "starting_page_number": starting_page_number
+                    } if starting_page_number else {})
                 }
             }
 
-            res = await self.client.general.partition_async(request=req)
-            logger.info(f"Type of res.elements: {type(res.elements)}")
-            logger.info(f"First element in res.elements: {res.elements[0]}")
+            with timed('extract.partition_async'):
+                res = await self.client.general.partition_async(request=req)
+        return res.elements or []
 
-            response_elements = res.elements
-            
-            processed_result = self._process_response(response_elements, file.filename)
+    @contextmanager
+    def _sdk_content(self, content: BinaryIO):
+        """Adapt a file handle to what the SDK accepts (bytes or a BufferedReader).
+
+        Files backed by a descriptor, including spooled temp files, are
+        re-opened read-only so the upload streams from disk rather than
+        from a bytes copy; anything else is read into memory.
+        """
+        content.seek(0)
+        try:
+            fd = os.dup(content.fileno())
+        except (io.UnsupportedOperation, AttributeError):
+            yield content.read()
+            return
+        content.flush()
+        with os.fdopen(fd, "rb") as reader:
+            reader.seek(0)
+            yield reader
+
+    def _read_pdf(self, file: UploadFile) -> Tuple[Optional[PdfReader], int]:
+        """Open the upload as a PDF and count its pages; (None, 0) when it cannot be read as one"""
+        try:
+            file.file.seek(0)
+            reader = PdfReader(file.file)
+            return reader, len(reader.pages)
+        except (PdfReadError, ValueError) as e:
+            logger.info(f"Could not read {file.filename} as a PDF: {str(e)}")
+            return None, 0
+
+    def _extract_pages(self, reader: PdfReader, first: int, last: int) -> BinaryIO:
+        """Write pages first..last (1-based, inclusive) to a new spooled PDF"""
+        writer = PdfWriter()
+        for page in reader.pages[first - 1:last]:
+            writer.add_page(page)
+        content = tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes, dir=self.temp_dir)
+        writer.write(content)
+        content.seek(0)
+        return content
+
+    async def _partition_pages(self, content: BinaryIO, file_name: str, first: int, last: int) -> Dict:
+        start = time.perf_counter()
+        try:
+            response_elements = await self._partition(content, file_name, starting_page_number=first)
+        except Exception as e:
+            logger.error(f"Error processing pages {first}-{last} of {file_name}: {e}", exc_info=True)
+            raise
+        finally:
+            content.close()
+
+        result = self._process_response(response_elements, file_name)
+        result["metadata"].update(page_range=[first, last], strategy="hi_res", seconds=time.perf_counter() - start)
+        logger.info(
+            f"Processed pages {first}-{last} of {file_name}: "
+            f"{result['metadata']['chunk_count']} elements"
+        )
+        return result
+
+    def _route_pages(self, reader: PdfReader) -> Tuple[List[str], List[str]]:
+        """Read each page's text layer and pick "fast" or "hi_res" for it"""
+        texts, strategies = [], []
+        for page in reader.pages:
+            try:
+                text = page.extract_text() or ""
+            except Exception as e:
+                # Malformed content streams are left to the hi-res model
+                logger.info(f"Could not read text layer of page {len(texts) + 1}: {str(e)}")
+                text = ""
+            texts.append(text)
+            strategies.append(self._page_strategy(text))
+        return texts, strategies
+
+    def _page_strategy(self, text: str) -> str:
+        """Scanned pages (little or no text layer) and likely tables need hi-res"""
+        if len("".join(text.split())) < self.min_text_chars:
+            return "hi_res"
+        numeric_rows = sum(
+            1 for line in text.splitlines()
+            if len(FIGURE.findall(line)) >= 2
+        )
+        return "hi_res" if numeric_rows >= self.table_min_rows else "fast"
+
+    def _segments(self, strategies: List[str]) -> List[Tuple[int, int, str]]:
+        """Split pages into (first, last, strategy) runs of one strategy, at most PIPELINE_PAGES_PER_BATCH long"""
+        segments = []
+        for page_number, strategy in enumerate(strategies, start=1):
+            if segments:
+                first, last, current = segments[-1]
+                if current == strategy and last - first + 1 < self.pages_per_batch:
+                    segments[-1] = (first, page_number, strategy)
+                    continue
+            segments.append((page_number, page_number, strategy))
+        return segments
+
+    async def _text_layer_pages(self, texts: List[str], file_name: str, first: int, last: int) -> Dict:
+        """Build elements for plain text pages from their embedded text layer"""
+        start = time.perf_counter()
+        response_elements = []
+        for page_number in range(first, last + 1):
+            paragraph: List[str] = []
+            for line in texts[page_number - 1].splitlines() + [""]:
+                line = line.strip()
+                if line:
+                    paragraph.append(line)
+                # Paragraphs end at blank lines or at a line that ends a sentence
+                if paragraph and (not line or line.endswith((".", "!", "?", ":"))):
+                    response_elements.append({
+                        "type": "NarrativeText",
+                        "text": " ".join(paragraph),
+                        "metadata": {"page_number": page_number},
+                    })
+                    paragraph = []
+
+        result = self._process_response(response_elements, file_name)
+        result["metadata"].update(page_range=[first, last], strategy="fast", seconds=time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    def strategy_report(batches: List[Dict]) -> Dict:
+        """Per-document strategy mix from the metadata of iter_page_batches results.
+
+        Time saved is estimated as the hi-res seconds per page observed in
+        this document applied to the pages taken from the text layer instead.
+        """
+        pages = {"fast": 0, "hi_res": 0}
+        seconds = {"fast": 0.0, "hi_res": 0.0}
+        for metadata in batches:
+            strategy = metadata.get("strategy", "hi_res")
+            first, last = metadata["page_range"]
+            pages[strategy] += last - first + 1
+            seconds[strategy] += metadata.get("seconds", 0.0)
+
+        saved = None
+        if pages["hi_res"] and pages["fast"]:
+            saved = round(pages["fast"] * seconds["hi_res"] / pages["hi_res"] - seconds["fast"], 3)
+        return {
+            "pages": pages,
+            "seconds": {strategy: round(value, 3) for strategy, value in seconds.items()},
+            "estimated_seconds_saved": saved,
+        }
+
+    async def iter_page_batches(self, file: UploadFile) -> AsyncIterator[Dict]:
+        """Partition a PDF in page ranges, in page order.
+
+        With EXTRACTION_ROUTING each page is first classified from its text
+        layer: plain text pages become elements locally and only scanned or
+        table pages are sent to hi-res partitioning. Ranges hold at most
+        PIPELINE_PAGES_PER_BATCH pages of one strategy, and up to
+        EXTRACTION_FANOUT ranges are in flight at once. Each range is yielded
+        as one processed result (same structure as process_file) with
+        ``metadata.page_range``, ``strategy`` and ``seconds`` set, as soon as
+        it and every earlier range are done.
+        """
+        # Parsing the xref table and page tree of a large PDF takes a while
+        reader, page_count = await asyncio.to_thread(self._read_pdf, file)
+        if self.routing and page_count:
+            texts, strategies = await asyncio.to_thread(self._route_pages, reader)
+        else:
+            texts, strategies = [], ["hi_res"] * page_count
+
+        if page_count <= self.pages_per_batch and "fast" not in strategies:
+            start = time.perf_counter()
+            response_elements = await self._partition(file.file, file.filename)
+            result = self._process_response(response_elements, file.filename)
+            result["metadata"].update(
+                page_range=[1, max(page_count, result["metadata"]["total_pages"])],
+                strategy="hi_res",
+                seconds=time.perf_counter() - start
+            )
+            yield result
+            return
+
+        pending: Deque[asyncio.Task] = deque()
+        try:
+            for first, last, strategy in self._segments(strategies):
+                if strategy == "fast":
+                    task = self._text_layer_pages(texts, file.filename, first, last)
+                else:
+                    # Page ranges are cut one at a time; only the API calls overlap
+                    content = await asyncio.to_thread(self._extract_pages, reader, first, last)
+                    task = self._partition_pages(content, file.filename, first, last)
+                pending.append(asyncio.create_task(task))
+                if len(pending) >= self.fanout:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def process_file(self, file: UploadFile) -> Dict:
+        """Process single PDF file using unstructured API with title strategy
+
+        Large PDFs are partitioned as concurrent page ranges and merged back
+        in page order.
+        """
+        try:
+            logger.info(f"Processing file {file.filename} with Unstructured API SDK (async)")
+
+            elements, batches, total_pages, element_count = [], [], 0, 0
+            async for batch in self.iter_page_batches(file):
+                elements.extend(shift_element_ranges(batch["elements"], element_count))
+                batches.append(batch["metadata"])
+                total_pages = max(total_pages, batch["metadata"]["total_pages"])
+                element_count += batch["metadata"]["element_count"]
+
+            processed_result = self._build_result(elements, file.filename, total_pages, element_count)
+            processed_result["metadata"]["extraction"] = self.strategy_report(batches)
 
             logger.info(
                 f"Processed {file.filename}: "
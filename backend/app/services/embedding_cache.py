@@ -0,0 +1,56 @@
+from array import array
+from functools import lru_cache
+from typing import List, Optional
+from .bounded_cache import BoundedCache
+
+
+class EmbeddingCache(BoundedCache):
+    """Content-addressed embedding cache.
+
+    Vectors are keyed by embedding model and text and held as float32
+    arrays, so ``max_bytes`` bounds the memory their values use. They never
+    expire: an embedding only changes with the model, which is part of the key.
+    """
+
+    TABLE = "embeddings"
+    COLUMN = "vector"
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, db_path: Optional[str] = None):
+        super().__init__(max_bytes=max_bytes, db_path=db_path)
+
+    async def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Return the cached embedding for ``text`` or None"""
+        vector = await self._get(self.make_key(model, text))
+        return vector.tolist() if vector is not None else None
+
+    async def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Cached embeddings for ``texts`` in order, None where missing"""
+        vectors = await self._get_many([self.make_key(model, text) for text in texts])
+        return [vector.tolist() if vector is not None else None for vector in vectors]
+
+    async def put(self, model: str, text: str, embedding: List[float]):
+        """Store an embedding in memory and, if enabled, on disk"""
+        await self._put([(self.make_key(model, text), array("f", embedding))])
+
+    async def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        await self._put([
+            (self.make_key(model, text), array("f", embedding))
+            for text, embedding in zip(texts, embeddings)
+        ])
+
+    def _size(self, vector: array) -> int:
+        return len(vector) * vector.itemsize
+
+    def _to_db(self, vector: array) -> bytes:
+        return vector.tobytes()
+
+    def _from_db(self, stored: bytes) -> array:
+        vector = array("f")
+        vector.frombytes(stored)
+        return vector
+
+
+@lru_cache()
+def get_embedding_cache(max_bytes: int, db_path: Optional[str] = None) -> EmbeddingCache:
+    """Process-wide cache shared by every GeminiService instance"""
+    return EmbeddingCache(max_bytes=max_bytes, db_path=db_path)
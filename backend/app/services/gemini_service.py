@@ -2,32 +2,74 @@ import google.generativeai as genai
 import logging
 from ..config import Settings
 from .supabase_service import SupabaseService
-from typing import List, Dict
+from .embedding_cache import EmbeddingCache, get_embedding_cache
+from .response_cache import get_response_cache
+from .table_index import TableAdjacencyIndex
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 import asyncio
+import threading
 from functools import partial
 import json
-from bs4 import BeautifulSoup
+import time
+from ..utils.metrics import record_duration, timed
+from ..utils.tables import structured_statement
 
 logger = logging.getLogger(__name__)
 
 class GeminiService:
-    def __init__(self, settings: Settings, supabase_service: SupabaseService):
+    def __init__(
+        self,
+        settings: Settings,
+        supabase_service: SupabaseService,
+        table_index: Optional[TableAdjacencyIndex] = None
+    ):
         genai.configure(api_key=settings.GOOGLE_API_KEY)
-        self.model = genai.GenerativeModel('gemini-pro')
-        self.supabase = supabase_service.client
+        self.model_name = 'gemini-pro'
+        self.model = genai.GenerativeModel(self.model_name)
+        self.supabase = supabase_service
+        self.table_index = table_index or TableAdjacencyIndex(
+            supabase_service,
+            settings.TABLE_WINDOW_SIZE,
+            max_documents=settings.TABLE_INDEX_MAX_DOCUMENTS,
+            refresh_seconds=settings.TABLE_INDEX_REFRESH_SECONDS
+        )
+        self.embedding_model = settings.EMBEDDING_MODEL
+        self.embedding_batch_size = max(1, settings.EMBEDDING_BATCH_SIZE)
+        self.max_concurrent_batches = max(1, settings.EMBEDDING_MAX_CONCURRENT_BATCHES)
+        self.embedding_cache = None
+        if settings.EMBEDDING_CACHE_ENABLED:
+            self.embedding_cache = get_embedding_cache(
+                settings.EMBEDDING_CACHE_MAX_BYTES,
+                settings.EMBEDDING_CACHE_PATH
+            )
+        self.response_cache = None
+        if settings.RESPONSE_CACHE_ENABLED:
+            self.response_cache = get_response_cache(
+                settings.RESPONSE_CACHE_MAX_BYTES,
+                settings.RESPONSE_CACHE_TTL_SECONDS,
+                settings.RESPONSE_CACHE_PATH
+            )
 
     async def generate_embedding(self, text: str) -> List[float]:
         """Generate embeddings for text asynchronously"""
         try:
+            if self.embedding_cache is not None:
+                cached = await self.embedding_cache.get(self.embedding_model, text)
+                if cached is not None:
+                    return cached
+
             loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None,
-                partial(genai.embed_content, 
-                    model="models/text-embedding-004", 
-                    content=text)
-            )
+            with timed('gemini.embed_content'):
+                result = await loop.run_in_executor(
+                    None,
+                    partial(genai.embed_content, 
+                        model=self.embedding_model, 
+                        content=text)
+                )
             
             if isinstance(result, dict) and 'embedding' in result:
+                if self.embedding_cache is not None:
+                    await self.embedding_cache.put(self.embedding_model, text, result['embedding'])
                 return result['embedding']
                 
             raise ValueError(f"Unexpected embedding structure: {result}")
@@ -36,134 +78,247 @@ class GeminiService:
             logger.error(f"Error generating embedding: {str(e)}")
             raise
 
-    async def generate_response(self, query: str, source_references: List[Dict]) -> str:
+    async def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for many texts using batched, concurrent requests.
+
+        Texts are split into batches of ``EMBEDDING_BATCH_SIZE`` and at most
+        ``EMBEDDING_MAX_CONCURRENT_BATCHES`` batches are in flight at once.
+        The returned embeddings are in the same order as ``texts``. Cached
+        texts are served from the embedding cache and duplicate texts are only
+        sent once.
+        """
+        if not texts:
+            return []
+
         try:
-            # Find text chunk with highest similarity score
-            best_match = None
-            best_match_index = -1
-            highest_similarity = -1
-            
-            for i, chunk in enumerate(source_references):
-                if chunk['chunk_type'] == 'text':
-                    similarity = chunk.get('similarity', 0)
-                    if similarity > highest_similarity:
-                        highest_similarity = similarity
-                        best_match = chunk
-                        best_match_index = i
-            
-            if best_match is None:
-                raise ValueError(f"Could not find relevant section for: {query}")
-                
-            # Get chunk index from best match
-            chunk_index = best_match.get('chunk_index')
-            document_id = best_match.get('document_id')
-            page_number = best_match.get('page_number')
-            window_size = 5
-            
-            # Query Supabase for nearby chunks from same document and page
-            window_chunks = self.supabase.table('chunks').select('*')\
-                .eq('document_id', document_id)\
-                .eq('page_number', page_number)\
-                .gte('chunk_index', chunk_index - window_size)\
-                .lte('chunk_index', chunk_index + window_size)\
-                .execute()
-            
-            # Find nearest table on same page
-            nearest_table = None
-            for chunk in window_chunks.data:
-                if (chunk['chunk_type'] == 'table' and 
-                    chunk['page_number'] == best_match['page_number']):
-                    nearest_table = chunk
-                    break
-            logger.info(f"Nearest table: {chunk}")
-            if nearest_table is None:
-                raise ValueError("No relevant tables found near the matching section")
+            embeddings: List[List[float]] = [None] * len(texts)
+            if self.embedding_cache is not None:
+                embeddings = await self.embedding_cache.get_many(self.embedding_model, texts)
 
-            try:
-                table_data = json.loads(nearest_table['table_data'])
-                logger.info(f"Table data: {table_data['html']}")
-                
-                # Generate a more flexible prompt focused on financial data structure
-                prompt = (
-                    f"You are analyzing a financial statement table. Context: {best_match['text']}\n\n"
-                    f"Table HTML: {table_data['html']}\n\n"
-                    "Convert this financial data to JSON following these guidelines:\n"
-                    "1. Identify the financial statement type (Balance Sheet, Income Statement, Cash Flow, etc)\n"
-                    "2. Preserve the hierarchical structure of the financial statement\n"
-                    "3. Include all time periods/columns as separate data points\n"
-                    "4. Maintain parent-child relationships between line items\n"
-                    "5. Keep subtotals and totals separate from individual line items\n"
-                    "6. Parse numerical values consistently, handling negatives in parentheses\n"
-                    "7. Preserve any relevant notes or references\n\n"
-                    "Return a clean, structured JSON with at minimum:\n"
-                    "- statement_type: type of financial statement\n"
-                    "- periods: array of time periods\n"
-                    "- line_items: array of entries with name, values, and any parent/child relationships\n"
-                    "- subtotals: identified subtotal sections\n"
-                    "Only return valid JSON, no other text."
-                )
-                
-                return await self._generate_response(prompt)
-                    
-            except json.JSONDecodeError:
-                raise ValueError("Failed to parse table data")
+            # Group positions by normalized text so each distinct miss is embedded once
+            pending: Dict[str, List[int]] = {}
+            for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+                if embedding is None:
+                    pending.setdefault(EmbeddingCache.normalize(text), []).append(i)
+
+            if not pending:
+                return embeddings
+
+            missing = [texts[positions[0]] for positions in pending.values()]
+            semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+            batches = [
+                missing[i:i + self.embedding_batch_size]
+                for i in range(0, len(missing), self.embedding_batch_size)
+            ]
+
+            async def embed_with_semaphore(batch: List[str]) -> List[List[float]]:
+                async with semaphore:
+                    return await self._embed_batch(batch)
+
+            results = await asyncio.gather(*[embed_with_semaphore(batch) for batch in batches])
+            generated = [embedding for batch_result in results for embedding in batch_result]
+            logger.info(
+                f"Generated {len(generated)} embeddings in {len(batches)} batches "
+                f"({len(texts) - sum(len(p) for p in pending.values())} cached)"
+            )
+
+            for positions, embedding in zip(pending.values(), generated):
+                for i in positions:
+                    embeddings[i] = embedding
+
+            if self.embedding_cache is not None:
+                await self.embedding_cache.put_many(self.embedding_model, missing, generated)
+
+            return embeddings
+
+        except Exception as e:
+            logger.error(f"Error generating batch embeddings: {str(e)}")
+            raise
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed a single batch of texts with one batchEmbedContents request"""
+        loop = asyncio.get_event_loop()
+        with timed('gemini.embed_batch'):
+            result = await loop.run_in_executor(
+                None,
+                partial(genai.embed_content,
+                    model=self.embedding_model,
+                    content=list(texts))
+            )
+
+        if not isinstance(result, dict) or 'embedding' not in result:
+            raise ValueError(f"Unexpected embedding structure: {result}")
+
+        embeddings = result['embedding']
+        if len(embeddings) != len(texts):
+            raise ValueError(
+                f"Expected {len(texts)} embeddings in batch, got {len(embeddings)}"
+            )
+        return embeddings
+
+    async def generate_response(self, query: str, source_references: List[Dict]) -> str:
+        try:
+            answer, prompt = await self._prepare_response(query, source_references)
+            if answer is not None:
+                return answer
+            return await self._generate_response(prompt)
 
         except Exception as e:
             logger.error(f"Error generating response: {str(e)}")
             raise
 
-    def _parse_table_html(self, html: str) -> Dict:
-        """Parse HTML table into structured data"""
+    async def generate_response_stream(self, query: str, source_references: List[Dict]) -> AsyncIterator[str]:
+        """Like generate_response, but yields the model's text as it is generated"""
         try:
-            soup = BeautifulSoup(html, 'html.parser')
-            table = soup.find('table')
-            if not table:
-                raise ValueError("No table found in HTML content")
-
-            # Extract headers (handling colspan)
-            headers = []
-            for row in table.find_all('tr')[:3]:  # First three rows usually contain headers
-                row_headers = []
-                for cell in row.find_all(['th', 'td']):
-                    colspan = int(cell.get('colspan', 1))
-                    text = cell.get_text(strip=True)
-                    row_headers.extend([text] * colspan)
-                if any(row_headers):  # Only add non-empty header rows
-                    headers.append(row_headers)
-
-            # Process data rows
-            data_rows = []
-            for row in table.find_all('tr')[3:]:  # Skip header rows
-                cells = row.find_all(['th', 'td'])
-                if not cells:
-                    continue
-
-                row_data = []
-                for cell in cells:
-                    colspan = int(cell.get('colspan', 1))
-                    text = cell.get_text(strip=True)
-                    row_data.extend([text] * colspan)
-                    
-                if row_data and any(row_data):  # Skip empty rows
-                    data_rows.append(row_data)
-
-            return {
-                "headers": headers,
-                "rows": data_rows
-            }
+            answer, prompt = await self._prepare_response(query, source_references)
+            if answer is not None:
+                yield answer
+                return
+            async for text in self._stream_response(prompt):
+                yield text
+
         except Exception as e:
-            logger.error(f"Error parsing table HTML: {str(e)}")
+            logger.error(f"Error streaming response: {str(e)}")
             raise
 
+    async def _prepare_response(self, query: str, source_references: List[Dict]) -> Tuple[Optional[str], Optional[str]]:
+        """Return (answer, None) when the table was parsed at ingest, else (None, prompt) for the model"""
+        # Find text chunk with highest (fused, when hybrid retrieval is on) similarity score
+        best_match = None
+        highest_similarity = -1
+
+        for chunk in source_references:
+            if chunk['chunk_type'] == 'text':
+                similarity = chunk.get('fusion_score', chunk.get('similarity', 0))
+                if similarity > highest_similarity:
+                    highest_similarity = similarity
+                    best_match = chunk
+
+        if best_match is None:
+            raise ValueError(f"Could not find relevant section for: {query}")
+
+        # Find nearest table on same page from the in-memory adjacency index
+        with timed('table_index.nearest_table'):
+            nearest_table = await self.table_index.nearest_table(
+                document_id=best_match.get('document_id'),
+                page_number=best_match.get('page_number'),
+                chunk_index=best_match.get('chunk_index')
+            )
+        logger.info(f"Nearest table: {nearest_table}")
+        if nearest_table is None:
+            raise ValueError("No relevant tables found near the matching section")
+
+        try:
+            table_data = json.loads(nearest_table['table_data'])
+        except json.JSONDecodeError:
+            raise ValueError("Failed to parse table data")
+        logger.info(f"Table data: {table_data['html']}")
+
+        # Tables ingested with a parsed structure are answered without a model call
+        if table_data.get('structured'):
+            return json.dumps(structured_statement(table_data['structured'], best_match['text'])), None
+
+        # Generate a more flexible prompt focused on financial data structure
+        prompt = (
+            f"You are analyzing a financial statement table. Context: {best_match['text']}\n\n"
+            f"Table HTML: {table_data['html']}\n\n"
+            "Convert this financial data to JSON following these guidelines:\n"
+            "1. Identify the financial statement type (Balance Sheet, Income Statement, Cash Flow, etc)\n"
+            "2. Preserve the hierarchical structure of the financial statement\n"
+            "3. Include all time periods/columns as separate data points\n"
+            "4. Maintain parent-child relationships between line items\n"
+            "5. Keep subtotals and totals separate from individual line items\n"
+            "6. Parse numerical values consistently, handling negatives in parentheses\n"
+            "7. Preserve any relevant notes or references\n\n"
+            "Return a clean, structured JSON with at minimum:\n"
+            "- statement_type: type of financial statement\n"
+            "- periods: array of time periods\n"
+            "- line_items: array of entries with name, values, and any parent/child relationships\n"
+            "- subtotals: identified subtotal sections\n"
+            "Only return valid JSON, no other text."
+        )
+        return None, prompt
+
     async def _generate_response(self, prompt: str) -> str:
-        """Generate response using Gemini model"""
+        """Generate response using Gemini model, served from the response cache when possible"""
         try:
-            loop = asyncio.get_event_loop()
+            if self.response_cache is not None:
+                return await self.response_cache.get_or_generate(
+                    self.model_name, prompt, partial(self._call_model, prompt)
+                )
+            return await self._call_model(prompt)
+        except Exception as e:
+            logger.error(f"Error in _generate_response: {str(e)}")
+            raise
+
+    async def _stream_response(self, prompt: str) -> AsyncIterator[str]:
+        """Stream a Gemini completion; cached responses arrive as one piece.
+
+        The model's latency is timed where it is generated, independent of
+        how fast the consumer reads: ``gemini.stream_first_piece`` up to the
+        first piece and ``gemini.generate_content_stream`` up to the last.
+        Only complete responses are cached; a stream the consumer abandons
+        stops the model call at its next piece and caches nothing, so no
+        later request is answered from a truncated response.
+        """
+        if self.response_cache is not None:
+            cached = await self.response_cache.get(self.model_name, prompt)
+            if cached is not None:
+                yield cached
+                return
+
+        # The SDK's stream is a blocking iterator, so it is drained on a worker
+        # thread that hands each piece to the event loop
+        loop = asyncio.get_event_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+        done = object()
+
+        def produce():
+            start = time.perf_counter()
+            first = True
+            try:
+                for part in self.model.generate_content(prompt, stream=True):
+                    if stopped.is_set():
+                        return
+                    if part.text:
+                        if first:
+                            record_duration('gemini.stream_first_piece', time.perf_counter() - start)
+                            first = False
+                        loop.call_soon_threadsafe(queue.put_nowait, part.text)
+                record_duration('gemini.generate_content_stream', time.perf_counter() - start)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except Exception as e:
+                record_duration('gemini.generate_content_stream', time.perf_counter() - start, failed=True)
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        loop.run_in_executor(None, produce)
+        pieces = []
+        try:
+            while (item := await queue.get()) is not done:
+                if isinstance(item, Exception):
+                    raise item
+                pieces.append(item)
+                yield item
+        finally:
+            # Stop the worker at its next piece if the consumer went away mid-stream
+            stopped.set()
+
+        if self.response_cache is not None:
+            await self.response_cache.put(self.model_name, prompt, "".join(pieces))
+
+    async def _call_model(self, prompt: str) -> str:
+        loop = asyncio.get_event_loop()
+        with timed('gemini.generate_content'):
             response = await loop.run_in_executor(
                 None,
                 lambda: self.model.generate_content(prompt)
             )
-            return response.text
-        except Exception as e:
-            logger.error(f"Error in _generate_response: {str(e)}")
-            raise
\ No newline at end of file
+        return response.text
+
+    def cache_stats(self) -> Dict:
+        """Hit-rate counters of the embedding and response caches"""
+        return {
+            "embeddings": self.embedding_cache.stats() if self.embedding_cache is not None else None,
+            "responses": self.response_cache.stats() if self.response_cache is not None else None,
+        }
\ No newline at end of file
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+from ..config import Settings
+from .service_integrator import ServiceIntegrator
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_documents (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs(id),
+    document_id INTEGER NOT NULL,
+    file_path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    updated_at TEXT NOT NULL,
+    owner TEXT,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_job_documents_status ON job_documents(status, seq);
+CREATE INDEX IF NOT EXISTS idx_job_documents_job ON job_documents(job_id);
+"""
+
+# Columns added to job_documents after the first release, created on open
+MIGRATIONS = {
+    'owner': "ALTER TABLE job_documents ADD COLUMN owner TEXT",
+    'heartbeat_at': "ALTER TABLE job_documents ADD COLUMN heartbeat_at REAL",
+}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class IngestionJobQueue:
+    """Persistent ingestion queue drained by a fixed pool of async workers.
+
+    Jobs and their documents are stored in SQLite so queued work survives
+    restarts. Several processes (e.g. uvicorn workers) may share one queue
+    file: a document is claimed with a conditional UPDATE, so only one
+    process runs it, and its owner renews a lease on it while it runs.
+    Documents whose lease lapses (their process died) are re-queued; those
+    of a process that stops cleanly are re-queued at once. The number of
+    workers is the ingestion concurrency limit of each process.
+
+    Every statement runs on one dedicated thread, in the order it was
+    issued, so a write waiting on another process's lock never blocks the
+    event loop and a document's stage updates land before its final status.
+    """
+
+    def __init__(self, settings: Settings, service: ServiceIntegrator):
+        self.service = service
+        self.worker_count = max(1, settings.INGESTION_CONCURRENCY)
+        self.poll_interval = settings.JOB_QUEUE_POLL_INTERVAL
+        self.lease_seconds = settings.JOB_QUEUE_LEASE_SECONDS
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._heartbeat: Optional[asyncio.Task] = None
+
+        directory = os.path.dirname(settings.JOB_QUEUE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(settings.JOB_QUEUE_PATH, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        columns = {row['name'] for row in self._db.execute("PRAGMA table_info(job_documents)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self._db.execute(statement)
+        self._db.commit()
+
+    async def start(self):
+        """Start the worker pool and the lease renewal of claimed documents"""
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"ingestion-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+        self._heartbeat = asyncio.create_task(self._renew_leases(), name="ingestion-heartbeat")
+        logger.info(f"Started {self.worker_count} ingestion workers ({self.owner})")
+
+    async def stop(self):
+        """Cancel workers and hand the documents they were processing back to the queue"""
+        tasks = self._workers + ([self._heartbeat] if self._heartbeat else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers, self._heartbeat = [], None
+        await self._run(self._release)
+        await self._run(self._db.close)
+        self._executor.shutdown()
+
+    async def _run(self, function: Callable, *args, **kwargs) -> Any:
+        """Run a database call on the queue's thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(function, *args, **kwargs)
+        )
+
+    def _release(self):
+        with self._lock:
+            self._db.execute(
+                "UPDATE job_documents SET status = 'queued', stage = 'queued', owner = NULL, updated_at = ? "
+                "WHERE status = 'running' AND owner = ?",
+                (_now(), self.owner)
+            )
+            self._db.commit()
+
+    async def enqueue(self, chat_id: str, documents: List[Dict]) -> str:
+        """Persist a job and return its id immediately"""
+        job_id = await self._run(self._insert_job, chat_id, documents)
+        self._wakeup.set()
+        logger.info(f"Enqueued job {job_id} with {len(documents)} documents for chat {chat_id}")
+        return job_id
+
+    def _insert_job(self, chat_id: str, documents: List[Dict]) -> str:
+        job_id = str(uuid.uuid4())
+        now = _now()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, chat_id, created_at) VALUES (?, ?, ?)",
+                (job_id, str(chat_id), now)
+            )
+            self._db.executemany(
+                "INSERT INTO job_documents (job_id, document_id, file_path, status, stage, updated_at) "
+                "VALUES (?, ?, ?, 'queued', 'queued', ?)",
+                [(job_id, doc['id'], doc['file_path'], now) for doc in documents]
+            )
+            self._db.commit()
+        return job_id
+
+    async def get_job(self, job_id: str) -> Optional[Dict]:
+        """Return job status with per-document progress, or None if unknown"""
+        return await self._run(self._read_job, job_id)
+
+    def _read_job(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._db.execute(
+                "SELECT id, chat_id, created_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            rows = self._db.execute(
+                "SELECT document_id, status, stage, result, error, updated_at "
+                "FROM job_documents WHERE job_id = ? ORDER BY seq",
+                (job_id,)
+            ).fetchall()
+
+        documents = [
+            {
+                'document_id': row['document_id'],
+                'status': row['status'],
+                'stage': row['stage'],
+                'result': json.loads(row['result']) if row['result'] else None,
+                'error': row['error'],
+                'updated_at': row['updated_at'],
+            }
+            for row in rows
+        ]
+        statuses = {doc['status'] for doc in documents}
+        if statuses <= {'completed'}:
+            status = 'completed'
+        elif statuses <= {'completed', 'failed'}:
+            status = 'failed' if statuses == {'failed'} else 'partial'
+        elif statuses == {'queued'}:
+            status = 'queued'
+        else:
+            status = 'running'
+
+        return {
+            'job_id': job['id'],
+            'chat_id': job['chat_id'],
+            'created_at': job['created_at'],
+            'status': status,
+            'documents': documents,
+        }
+
+    def _claim_next(self) -> Optional[sqlite3.Row]:
+        with self._lock:
+            # Documents whose owner stopped renewing their lease were interrupted
+            recovered = self._db.execute(
+                "UPDATE job_documents SET status = 'queued', stage = 'queued', owner = NULL, updated_at = ? "
+                "WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (_now(), time.time() - self.lease_seconds)
+            ).rowcount
+            if recovered:
+                logger.info(f"Re-queued {recovered} interrupted ingestion documents")
+
+            while True:
+                row = self._db.execute(
+                    "SELECT d.seq, d.job_id, d.document_id, d.file_path, j.chat_id "
+                    "FROM job_documents d JOIN jobs j ON j.id = d.job_id "
+                    "WHERE d.status = 'queued' ORDER BY d.seq LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self._db.commit()
+                    return None
+                # Only one process can move the row out of 'queued'; a loser picks the next one
+                claimed = self._db.execute(
+                    "UPDATE job_documents SET status = 'running', stage = 'starting', owner = ?, "
+                    "heartbeat_at = ?, updated_at = ? WHERE seq = ? AND status = 'queued'",
+                    (self.owner, time.time(), _now(), row['seq'])
+                ).rowcount
+                self._db.commit()
+                if claimed:
+                    return row
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._run(self._renew)
+            except sqlite3.Error as e:
+                logger.error(f"Error renewing ingestion leases: {str(e)}")
+
+    def _renew(self):
+        with self._lock:
+            self._db.execute(
+                "UPDATE job_documents SET heartbeat_at = ? WHERE status = 'running' AND owner = ?",
+                (time.time(), self.owner)
+            )
+            self._db.commit()
+
+    def _update(self, seq: int, **fields):
+        fields['updated_at'] = _now()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        try:
+            with self._lock:
+                self._db.execute(
+                    f"UPDATE job_documents SET {assignments} WHERE seq = ? AND owner = ?",
+                    (*fields.values(), seq, self.owner)
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error updating ingestion document {seq}: {str(e)}")
+
+    async def _worker(self, worker_id: int):
+        while True:
+            row = await self._run(self._claim_next)
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            seq = row['seq']
+            logger.info(
+                f"Worker {worker_id} processing document {row['document_id']} of job {row['job_id']}"
+            )
+            try:
+                result = await self.service.process_document(
+                    doc_id=row['document_id'],
+                    file_path=row['file_path'],
+                    chat_id=row['chat_id'],
+                    # Queued behind earlier statements without waiting for them
+                    on_stage=lambda stage: self._executor.submit(self._update, seq, stage=stage)
+                )
+                await self._run(self._update, seq, status='completed', stage='completed', result=json.dumps(result))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing document {row['document_id']}: {str(e)}")
+                await self._run(self._update, seq, status='failed', stage='failed', error=str(e))
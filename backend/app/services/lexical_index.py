@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import math
+import re
+import time
+from array import array
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from ..config import Settings
+from .supabase_service import SupabaseService
+from .vector_index import RESULT_FIELDS
+from ..utils.metrics import instrumented
+
+logger = logging.getLogger(__name__)
+
+# Words, figures and decimals; thousands separators are dropped so 4,210 matches 4210
+TOKEN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+STOPWORDS = frozenset("""
+a an and are as at be by did do does for from had has have how in is it its of on or
+the their this to was were what when where which who why will with
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word and number tokens without stopwords"""
+    return [
+        token.replace(",", "")
+        for token in TOKEN.findall(text.lower() if text else "")
+        if token not in STOPWORDS
+    ]
+
+
+class ChatLexicalIndex:
+    """BM25 inverted index over one chat's chunk text.
+
+    Each term's postings are two packed arrays (row ids as int32, term
+    frequencies as uint16) that grow as chunks are added and are scored as
+    zero-copy NumPy views. Replaced or deleted rows are tombstoned and
+    skipped; the index is rebuilt once tombstones outnumber live rows.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._reset()
+
+    def _reset(self):
+        self.rows: List[Optional[Dict]] = []
+        self.lengths = array('I')
+        self.document_ids = array('q')
+        self.alive = bytearray()
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._positions: Dict[Tuple[int, int], int] = {}
+        self.live = 0
+        self.total_length = 0
+        self._norms: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return self.live
+
+    def upsert(self, document_id: int, document_name: Optional[str], chunks: List[Dict]):
+        """Add chunks, replacing any already indexed at the same chunk_index"""
+        for chunk in chunks:
+            key = (document_id, chunk['chunk_index'])
+            if key in self._positions:
+                self._delete(self._positions.pop(key))
+
+            position = len(self.rows)
+            tokens = tokenize(chunk.get('text', ''))
+            for term, count in Counter(tokens).items():
+                rows, frequencies = self._postings.setdefault(term, (array('i'), array('H')))
+                rows.append(position)
+                frequencies.append(min(count, 65535))
+
+            row = {field: chunk.get(field) for field in RESULT_FIELDS}
+            row['document_id'] = document_id
+            row['document_name'] = document_name
+            self.rows.append(row)
+            self.lengths.append(len(tokens))
+            self.document_ids.append(document_id)
+            self.alive.append(1)
+            self._positions[key] = position
+            self.live += 1
+            self.total_length += len(tokens)
+        self._norms = None
+        self._maybe_compact()
+
+    def remove(self, document_id: int, from_index: int = 0):
+        """Drop a document's chunks with chunk_index >= from_index"""
+        for key in [k for k in self._positions if k[0] == document_id and k[1] >= from_index]:
+            self._delete(self._positions.pop(key))
+        self._maybe_compact()
+
+    def _delete(self, position: int):
+        self.alive[position] = 0
+        self._norms = None
+        self.live -= 1
+        self.total_length -= self.lengths[position]
+
+    def _maybe_compact(self):
+        if len(self.rows) - self.live > max(1024, self.live):
+            self._compact()
+
+    def _compact(self):
+        """Rebuild without tombstoned rows"""
+        rows = [row for row, alive in zip(self.rows, self.alive) if alive]
+        self._reset()
+        by_document: Dict[int, List[Dict]] = {}
+        for row in rows:
+            by_document.setdefault(row['document_id'], []).append(row)
+        for document_id, chunks in by_document.items():
+            self.upsert(document_id, chunks[0]['document_name'], chunks)
+
+    def _length_norms(self) -> np.ndarray:
+        """BM25 document-length term k1 * (1 - b + b * length / average), cached until the index changes"""
+        if self._norms is None or len(self._norms) != len(self.rows):
+            lengths = np.frombuffer(self.lengths, dtype=np.uint32).astype(np.float32)
+            average = self.total_length / self.live if self.live else 1.0
+            self._norms = self.k1 * (1 - self.b + self.b * lengths / (average or 1.0))
+        return self._norms
+
+    def search(self, query: str, document_ids: Optional[List[int]] = None, limit: int = 10) -> List[Dict]:
+        """Top ``limit`` chunks by BM25 score, each with a ``bm25_score``"""
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self._postings]
+        if not terms or not self.live or limit <= 0:
+            return []
+
+        tombstones = len(self.rows) > self.live
+        alive = np.frombuffer(self.alive, dtype=np.uint8).astype(bool) if tombstones else None
+        norms = self._length_norms()
+        scores = np.zeros(len(self.rows), dtype=np.float32)
+        for term in terms:
+            rows, frequencies = self._postings[term]
+            rows = np.frombuffer(rows, dtype=np.int32)
+            frequencies = np.frombuffer(frequencies, dtype=np.uint16).astype(np.float32)
+            frequency = int(alive[rows].sum()) if tombstones else len(rows)
+            if not frequency:
+                continue
+            idf = math.log(1 + (self.live - frequency + 0.5) / (frequency + 0.5))
+            # Each row appears once per term's postings, so fancy-index accumulation is safe
+            scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norms[rows])
+
+        if tombstones:
+            scores[~alive] = 0
+        if document_ids:
+            scores[~np.isin(np.frombuffer(self.document_ids, dtype=np.int64), document_ids)] = 0
+        matches = np.flatnonzero(scores > 0)
+        if len(matches) > limit:
+            matches = matches[np.argpartition(-scores[matches], limit - 1)[:limit]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+        return [dict(self.rows[position], bm25_score=float(scores[position])) for position in matches]
+
+
+class LexicalIndex:
+    """One ChatLexicalIndex per chat, loaded on first query and kept in sync by ingestion.
+
+    At most ``LEXICAL_INDEX_MAX_CHATS`` indexes are kept, evicting the least
+    recently queried. Other processes ingest too, so an index last checked
+    more than ``LEXICAL_INDEX_REFRESH_SECONDS`` ago is compared with the
+    chat's document ids and content fingerprints before it is searched;
+    added or re-ingested documents are reloaded and removed ones dropped.
+    """
+
+    def __init__(self, settings: Settings, supabase_service: SupabaseService):
+        self.supabase = supabase_service
+        self.k1 = settings.BM25_K1
+        self.b = settings.BM25_B
+        self.max_chats = max(1, settings.LEXICAL_INDEX_MAX_CHATS)
+        self.refresh_seconds = settings.LEXICAL_INDEX_REFRESH_SECONDS
+        self._indexes: "OrderedDict[str, ChatLexicalIndex]" = OrderedDict()
+        # chat id -> the document ids and fingerprints its index was loaded from, and when they were checked
+        self._fingerprints: Dict[str, Dict[int, Optional[str]]] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+
+    @instrumented('retrieval.lexical')
+    async def search(
+        self,
+        query: str,
+        chat_id: str,
+        document_ids: Optional[List[int]] = None,
+        limit: int = 10
+    ) -> List[Dict]:
+        try:
+            index = await self._get_index(str(chat_id))
+            return index.search(query, document_ids=document_ids, limit=limit)
+        except Exception as e:
+            logger.error(f"Error searching lexical index: {str(e)}")
+            raise
+
+    def on_chunks_stored(self, chat_id: str, document_id: int, chunks: List[Dict], document_name: Optional[str] = None):
+        index = self._indexes.get(str(chat_id))
+        if index is not None:
+            index.upsert(document_id, document_name, chunks)
+
+    def on_chunks_deleted(self, chat_id: str, document_id: int, from_index: int = 0):
+        index = self._indexes.get(str(chat_id))
+        if index is not None:
+            index.remove(document_id, from_index)
+
+    def _is_stale(self, chat_id: str) -> bool:
+        checked_at = self._checked_at.get(chat_id)
+        return checked_at is None or time.monotonic() - checked_at >= self.refresh_seconds
+
+    async def _get_index(self, chat_id: str) -> ChatLexicalIndex:
+        if chat_id not in self._indexes or self._is_stale(chat_id):
+            lock = self._load_locks.setdefault(chat_id, asyncio.Lock())
+            async with lock:
+                if chat_id not in self._indexes or self._is_stale(chat_id):
+                    await self._refresh(chat_id)
+
+        self._indexes.move_to_end(chat_id)
+        while len(self._indexes) > self.max_chats:
+            evicted, _ = self._indexes.popitem(last=False)
+            self._fingerprints.pop(evicted, None)
+            self._checked_at.pop(evicted, None)
+            self._load_locks.pop(evicted, None)
+        return self._indexes[chat_id]
+
+    async def _refresh(self, chat_id: str):
+        """Load documents added or re-ingested since the last check and drop deleted ones"""
+        documents = await self.supabase.get_chat_documents(chat_id)
+        fingerprints = {document['id']: document.get('content_fingerprint') for document in documents}
+        known = self._fingerprints.get(chat_id, {})
+        removed = known.keys() - fingerprints.keys()
+        changed = [
+            document for document in documents
+            if document['id'] not in known or known[document['id']] != fingerprints[document['id']]
+        ]
+        texts = await asyncio.gather(*[
+            self.supabase.get_document_texts(document['id']) for document in changed
+        ])
+
+        index = self._indexes.get(chat_id)
+        if index is None:
+            index = ChatLexicalIndex(k1=self.k1, b=self.b)
+        for document_id in removed:
+            index.remove(document_id)
+        for document, chunks in zip(changed, texts):
+            index.remove(document['id'])
+            index.upsert(document['id'], document.get('name'), chunks)
+
+        if chat_id not in self._indexes:
+            logger.info(f"Loaded lexical index for chat {chat_id}: {len(index)} chunks, {len(index._postings)} terms")
+        elif changed or removed:
+            logger.info(f"Refreshed lexical index for chat {chat_id}: {len(changed)} documents reloaded, {len(removed)} dropped")
+        self._indexes[chat_id] = index
+        self._fingerprints[chat_id] = fingerprints
+        self._checked_at[chat_id] = time.monotonic()
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict]], k: int = 60, limit: int = 10) -> List[Dict]:
+    """Merge ranked chunk lists by summed 1 / (k + rank).
+
+    Chunks are matched on (document_id, chunk_index); the merged row keeps
+    every field from the lists it appeared in and gains ``fusion_score``.
+    """
+    fused: Dict[Tuple[int, int], Dict] = {}
+    for results in result_lists:
+        for rank, row in enumerate(results, start=1):
+            key = (row['document_id'], row['chunk_index'])
+            merged = fused.setdefault(key, {'fusion_score': 0.0})
+            merged.update({field: value for field, value in row.items() if field not in merged})
+            merged['fusion_score'] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda row: -row['fusion_score'])[:limit]
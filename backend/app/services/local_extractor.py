@@ -0,0 +1,76 @@
+import asyncio
+import importlib.util
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def partition_pdf_bytes(data: bytes, file_name: str, starting_page_number: int = 1) -> List[Dict]:
+    """Partition PDF bytes with unstructured; returns element dicts shaped like the API's"""
+    # Imported in the worker so the API backend never loads the models
+    from unstructured.partition.pdf import partition_pdf
+    from unstructured.staging.base import elements_to_dicts
+
+    elements = partition_pdf(
+        file=io.BytesIO(data),
+        metadata_filename=file_name,
+        strategy="hi_res",
+        infer_table_structure=True,
+        include_page_breaks=True,
+        starting_page_number=starting_page_number,
+    )
+    return elements_to_dicts(elements)
+
+
+class LocalPartitioner:
+    """Runs unstructured's PDF partitioning in a pool of worker processes.
+
+    Partitioning is CPU-bound and its models grow the worker's memory, so
+    it runs outside the event loop's process. Workers are replaced after
+    ``max_tasks_per_worker`` partitions to cap that growth.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_tasks_per_worker: int = 0,
+        partition_func: Callable[..., List[Dict]] = partition_pdf_bytes
+    ):
+        if partition_func is partition_pdf_bytes and importlib.util.find_spec("unstructured") is None:
+            raise ImportError("EXTRACTION_BACKEND=local requires the unstructured[pdf] package")
+        self.workers = workers or os.cpu_count() or 1
+        self.partition_func = partition_func
+        # Worker recycling needs spawned (not forked) processes, which are
+        # also the safe choice from a threaded server
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=max_tasks_per_worker or None
+        )
+        logger.info(
+            f"Started local extraction pool: {self.workers} workers, "
+            f"recycled every {max_tasks_per_worker or 'unlimited'} tasks"
+        )
+
+    async def partition(
+        self,
+        content: BinaryIO,
+        file_name: str,
+        starting_page_number: Optional[int] = None
+    ) -> List[Dict]:
+        content.seek(0)
+        data = content.read()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(self.partition_func, data, file_name, starting_page_number or 1)
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
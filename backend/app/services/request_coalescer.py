@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCoalescer:
+    """Single-flight execution of identical concurrent requests.
+
+    The first caller for a key starts the work; callers arriving while it
+    runs await the same task, and for ``grace_seconds`` after it succeeds
+    its result is handed to stragglers as well. Failures reach every
+    waiting caller and are never reused. A caller that is cancelled only
+    stops waiting; the shared work is cancelled once no caller is left.
+    """
+
+    def __init__(self, grace_seconds: float = 0.0):
+        self.grace_seconds = grace_seconds
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self._recent: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+
+        self.executions = 0
+        self.coalesced = 0
+        self.grace_hits = 0
+        self.errors = 0
+        self.cancellations = 0
+
+    async def run(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Any:
+        """Result of ``work()``, shared with identical requests in flight or just finished"""
+        self._expire(time.monotonic())
+        recent = self._recent.get(key)
+        if recent is not None:
+            self.grace_hits += 1
+            return recent[0]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.executions += 1
+            task = asyncio.ensure_future(work())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # Shielded so one caller going away does not cancel the others' request
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                # Later callers start fresh rather than joining the cancelled request
+                self._in_flight.pop(key, None)
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _finished(self, key: Hashable, done: asyncio.Future):
+        if self._in_flight.get(key) is done:
+            del self._in_flight[key]
+        if done.cancelled():
+            self.cancellations += 1
+        elif done.exception() is not None:
+            self.errors += 1
+        elif self.grace_seconds > 0:
+            self._recent[key] = (done.result(), time.monotonic() + self.grace_seconds)
+            self._recent.move_to_end(key)
+
+    def _expire(self, now: float):
+        # Every entry gets the same grace period, so the oldest expire first
+        while self._recent:
+            key, (_, expires_at) = next(iter(self._recent.items()))
+            if expires_at > now:
+                break
+            del self._recent[key]
+
+    def stats(self) -> Dict:
+        """Counts of executed, coalesced and grace-window requests"""
+        served = self.coalesced + self.grace_hits
+        total = self.executions + served
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "grace_hits": self.grace_hits,
+            "errors": self.errors,
+            "cancellations": self.cancellations,
+            "coalesced_rate": served / total if total else 0.0,
+            "in_flight": len(self._in_flight),
+            "recent": len(self._recent),
+        }
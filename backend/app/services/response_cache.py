@@ -0,0 +1,60 @@
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Optional
+from .bounded_cache import BoundedCache
+from .request_coalescer import RequestCoalescer
+
+
+class ResponseCache(BoundedCache):
+    """Cache of generated model responses with single-flight generation.
+
+    Responses are keyed by model and prompt, so the same template, table
+    and context map to the same entry, and expire after ``ttl_seconds``.
+    Concurrent requests for a prompt that is already being generated wait
+    for that call instead of starting another (see RequestCoalescer).
+    """
+
+    TABLE = "responses"
+    COLUMN = "response"
+    COLUMN_TYPE = "TEXT"
+    EXPIRES = True
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, ttl_seconds: float = 0, db_path: Optional[str] = None):
+        super().__init__(max_bytes=max_bytes, db_path=db_path, ttl_seconds=ttl_seconds)
+        self._coalescer = RequestCoalescer()
+
+    async def get(self, model: str, prompt: str) -> Optional[str]:
+        """Return the cached response for ``prompt`` or None"""
+        return await self._get(self.make_key(model, prompt))
+
+    async def put(self, model: str, prompt: str, response: str):
+        """Store a response in memory and, if enabled, on disk"""
+        await self._put([(self.make_key(model, prompt), response)])
+
+    async def get_or_generate(self, model: str, prompt: str, generate: Callable[[], Awaitable[str]]) -> str:
+        """Return the cached response, or generate it once for all concurrent callers"""
+        cached = await self.get(model, prompt)
+        if cached is not None:
+            return cached
+
+        async def generate_and_store() -> str:
+            response = await generate()
+            await self.put(model, prompt, response)
+            return response
+
+        return await self._coalescer.run(self.make_key(model, prompt), generate_and_store)
+
+    def _size(self, response: str) -> int:
+        return len(response.encode("utf-8"))
+
+    def stats(self) -> Dict:
+        """Cache counters plus single-flight coalescing"""
+        stats = super().stats()
+        coalescing = self._coalescer.stats()
+        stats.update(coalesced=coalescing["coalesced"], in_flight=coalescing["in_flight"])
+        return stats
+
+
+@lru_cache()
+def get_response_cache(max_bytes: int, ttl_seconds: float = 0, db_path: Optional[str] = None) -> ResponseCache:
+    """Process-wide cache shared by every GeminiService instance"""
+    return ResponseCache(max_bytes=max_bytes, ttl_seconds=ttl_seconds, db_path=db_path)
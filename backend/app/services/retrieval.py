@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+import numpy as np
+from ..config import Settings
+from .supabase_service import SupabaseService
+from .vector_index import ChatVectorIndex
+from .ann_index import IVFChatIndex
+from ..utils.metrics import instrumented
+
+logger = logging.getLogger(__name__)
+
+# Quantized scores can sit slightly below the exact ones; widen the threshold
+# by this much when collecting candidates for exact re-ranking
+RERANK_THRESHOLD_MARGIN = 0.02
+
+
+class SupabaseRetriever:
+    """Retrieval through the match_documents RPC (the default backend)"""
+
+    # match_documents returns no vectors; re-ranking by them would cost an extra round trip
+    has_embeddings = False
+
+    def __init__(self, supabase_service: SupabaseService):
+        self.supabase = supabase_service
+
+    async def find_similar_chunks(
+        self,
+        embedding: List[float],
+        chat_id: Optional[str] = None,
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[Dict]:
+        return await self.supabase.find_similar_chunks(
+            embedding=embedding,
+            chat_id=chat_id,
+            document_ids=document_ids,
+            threshold=threshold,
+            limit=limit
+        )
+
+    async def find_similar_chunks_many(
+        self,
+        embeddings: List[List[float]],
+        chat_id: Optional[str] = None,
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[List[Dict]]:
+        """find_similar_chunks for each embedding; the RPCs share the Supabase worker pool"""
+        return await asyncio.gather(*[
+            self.find_similar_chunks(
+                embedding, chat_id=chat_id, document_ids=document_ids, threshold=threshold, limit=limit
+            )
+            for embedding in embeddings
+        ])
+
+    def on_chunks_stored(self, chat_id: str, document_id: int, chunks: List[Dict], document_name: Optional[str] = None):
+        pass
+
+    def on_chunks_deleted(self, chat_id: str, document_id: int, from_index: int = 0):
+        pass
+
+    async def flush(self):
+        pass
+
+
+class LocalVectorIndex:
+    """In-process retrieval backend with one index per chat.
+
+    A chat's index is loaded from Supabase on its first query and then kept
+    in sync as ingestion stores or deletes chunks. With ``index_type="ivf"``
+    each chat uses an IVFChatIndex that is persisted under IVF_INDEX_DIR and
+    reused on restart when the chat's documents are unchanged.
+
+    When the index is quantized (LOCAL_INDEX_DTYPE or the compact
+    EMBEDDING_STORAGE_FORMAT), the top ``limit * QUANTIZED_RERANK_FACTOR``
+    candidates are re-scored with exact embeddings fetched by chunk id.
+    """
+
+    has_embeddings = True
+
+    def __init__(self, settings: Settings, supabase_service: SupabaseService, index_type: str = "flat"):
+        self.supabase = supabase_service
+        self.index_type = index_type
+        self.dtype = settings.LOCAL_INDEX_DTYPE
+        self.dimension = settings.EMBEDDING_DIMENSION
+        self.load_concurrency = max(1, settings.LOCAL_INDEX_LOAD_CONCURRENCY)
+        self.compact = settings.EMBEDDING_STORAGE_FORMAT != "float"
+        self.rerank_factor = settings.QUANTIZED_RERANK_FACTOR if (
+            self.compact or self.dtype != "float32"
+        ) else 0
+        self._indexes: Dict[str, ChatVectorIndex] = {}
+        self._document_names: Dict[int, str] = {}
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        self._dirty: set = set()
+        self._training: set = set()  # In-flight background IVF fits
+        if index_type == "ivf":
+            self.persist_dir = settings.IVF_INDEX_DIR
+            self.ivf_params = {
+                'nprobe': settings.IVF_NPROBE,
+                'nlist': settings.IVF_NLIST,
+                'min_train_size': settings.IVF_MIN_TRAIN_SIZE,
+            }
+
+    @instrumented('retrieval.local_vector')
+    async def find_similar_chunks(
+        self,
+        embedding: List[float],
+        chat_id: Optional[str] = None,
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[Dict]:
+        """Same contract as SupabaseService.find_similar_chunks, answered in memory"""
+        try:
+            index = await self._get_index(str(chat_id))
+            if not self.rerank_factor:
+                return index.search(embedding, document_ids=document_ids, threshold=threshold, limit=limit)
+
+            candidates = index.search(
+                embedding,
+                document_ids=document_ids,
+                threshold=threshold - RERANK_THRESHOLD_MARGIN,
+                limit=limit * self.rerank_factor
+            )
+            return await self._rerank(embedding, candidates, threshold, limit)
+        except Exception as e:
+            logger.error(f"Error searching local vector index: {str(e)}")
+            raise
+
+    @instrumented('retrieval.local_vector_many')
+    async def find_similar_chunks_many(
+        self,
+        embeddings: List[List[float]],
+        chat_id: Optional[str] = None,
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[List[Dict]]:
+        """find_similar_chunks for each embedding, scored against the index in one pass"""
+        try:
+            index = await self._get_index(str(chat_id))
+            if not self.rerank_factor:
+                return index.search_many(embeddings, document_ids=document_ids, threshold=threshold, limit=limit)
+
+            candidates = index.search_many(
+                embeddings,
+                document_ids=document_ids,
+                threshold=threshold - RERANK_THRESHOLD_MARGIN,
+                limit=limit * self.rerank_factor
+            )
+            return await asyncio.gather(*[
+                self._rerank(embedding, rows, threshold, limit)
+                for embedding, rows in zip(embeddings, candidates)
+            ])
+        except Exception as e:
+            logger.error(f"Error searching local vector index: {str(e)}")
+            raise
+
+    async def get_embeddings(self, chat_id: str, chunks: List[Dict]) -> np.ndarray:
+        """Embeddings of result rows read from the chat's index; zero rows where unavailable"""
+        index = await self._get_index(str(chat_id))
+        positions = [index._positions.get((row['document_id'], row['chunk_index'])) for row in chunks]
+        found = [position for position in positions if position is not None]
+        vectors = iter(index.float_vectors(np.asarray(found, dtype=np.int64)) if found else [])
+        return _stack([next(vectors) if position is not None else None for position in positions])
+
+    async def _rerank(self, embedding: List[float], candidates: List[Dict], threshold: float, limit: int) -> List[Dict]:
+        """Re-score quantized candidates with exact cosine similarity"""
+        exact = await self.supabase.get_chunk_embeddings([row['id'] for row in candidates])
+        candidates = [row for row in candidates if exact.get(row['id']) is not None]
+        if not candidates:
+            return []
+
+        query = ChatVectorIndex._normalize(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        vectors = ChatVectorIndex._normalize(
+            np.asarray([exact[row['id']] for row in candidates], dtype=np.float32)
+        )
+        similarities = vectors @ query
+        order = np.argsort(-similarities, kind='stable')
+        return [
+            dict(candidates[i], similarity=float(similarities[i]))
+            for i in order[:limit]
+            if similarities[i] > threshold
+        ]
+
+    def on_chunks_stored(self, chat_id: str, document_id: int, chunks: List[Dict], document_name: Optional[str] = None):
+        if document_name:
+            self._document_names[document_id] = document_name
+        index = self._indexes.get(str(chat_id))
+        if index is not None:
+            index.upsert(document_id, self._document_names.get(document_id), chunks)
+            self._dirty.add(str(chat_id))
+            if self.index_type == "ivf" and index.needs_training():
+                task = asyncio.create_task(self._train(str(chat_id), index))
+                self._training.add(task)
+                task.add_done_callback(self._training.discard)
+
+    def on_chunks_deleted(self, chat_id: str, document_id: int, from_index: int = 0):
+        index = self._indexes.get(str(chat_id))
+        if index is not None:
+            index.remove(document_id, from_index)
+            self._dirty.add(str(chat_id))
+
+    async def flush(self):
+        """Persist IVF indexes changed since they were loaded"""
+        if self.index_type != "ivf":
+            return
+        if self._training:
+            await asyncio.gather(*self._training, return_exceptions=True)
+        for chat_id in list(self._dirty):
+            try:
+                documents = await self.supabase.get_chat_documents(chat_id)
+                # Changes made while the file is written mark the chat dirty again
+                self._dirty.discard(chat_id)
+                await self._save(chat_id, self._indexes[chat_id], documents)
+            except Exception as e:
+                self._dirty.add(chat_id)
+                logger.error(f"Error persisting vector index for chat {chat_id}: {str(e)}")
+
+    async def _train(self, chat_id: str, index: IVFChatIndex):
+        try:
+            if await index.train_in_background():
+                self._dirty.add(chat_id)
+        except Exception as e:
+            logger.error(f"Error training vector index for chat {chat_id}: {str(e)}")
+
+    async def _get_index(self, chat_id: str) -> ChatVectorIndex:
+        index = self._indexes.get(chat_id)
+        if index is not None:
+            return index
+
+        lock = self._load_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            index = self._indexes.get(chat_id)
+            if index is None:
+                index = await self._load(chat_id)
+                self._indexes[chat_id] = index
+            return index
+
+    async def _load(self, chat_id: str) -> ChatVectorIndex:
+        documents = await self.supabase.get_chat_documents(chat_id)
+        for document in documents:
+            self._document_names[document['id']] = document.get('name')
+
+        if self.index_type == "ivf":
+            loaded = await asyncio.to_thread(IVFChatIndex.load, self._path(chat_id), **self._index_params())
+            if loaded is not None and loaded[1].get('documents') == self._signature(documents):
+                logger.info(f"Loaded persisted vector index for chat {chat_id}: {len(loaded[0])} chunks")
+                return loaded[0]
+
+        semaphore = asyncio.Semaphore(self.load_concurrency)
+
+        async def fetch(document: Dict) -> List[Dict]:
+            async with semaphore:
+                return await self.supabase.get_document_chunks(document['id'], compact=self.compact)
+
+        # Fetch concurrently, but insert in document order so row positions are stable
+        index = self._new_index()
+        for document, chunks in zip(documents, await asyncio.gather(*[fetch(document) for document in documents])):
+            index.upsert(document['id'], document.get('name'), chunks)
+        logger.info(
+            f"Loaded local vector index for chat {chat_id}: "
+            f"{len(index)} chunks, {index.nbytes() / 1024 / 1024:.1f} MB"
+        )
+        if self.index_type == "ivf":
+            if index.needs_training():
+                await index.train_in_background()
+            await self._save(chat_id, index, documents)
+        return index
+
+    def _new_index(self) -> ChatVectorIndex:
+        if self.index_type == "ivf":
+            return IVFChatIndex(**self._index_params())
+        return ChatVectorIndex(dimension=self.dimension, dtype=self.dtype)
+
+    def _index_params(self) -> Dict:
+        return dict(self.ivf_params, dimension=self.dimension, dtype=self.dtype)
+
+    def _path(self, chat_id: str) -> str:
+        return os.path.join(self.persist_dir, chat_id)
+
+    async def _save(self, chat_id: str, index: IVFChatIndex, documents: List[Dict]):
+        """Snapshot the index on the event loop and write it on a worker thread"""
+        snapshot = index.snapshot(metadata={'documents': self._signature(documents)})
+        await asyncio.to_thread(IVFChatIndex.write, self._path(chat_id), snapshot)
+
+    @staticmethod
+    def _signature(documents: List[Dict]) -> Dict[str, Optional[str]]:
+        """Document ids and content fingerprints a persisted index was built from"""
+        return {str(document['id']): document.get('content_fingerprint') for document in documents}
+
+
+def _stack(embeddings: List[Optional[List[float]]]) -> np.ndarray:
+    """Stack embeddings into a float32 matrix, with zero rows for missing ones"""
+    dimension = next((len(embedding) for embedding in embeddings if embedding is not None), 0)
+    matrix = np.zeros((len(embeddings), dimension), dtype=np.float32)
+    for i, embedding in enumerate(embeddings):
+        if embedding is not None:
+            matrix[i] = embedding
+    return matrix
+
+
+def create_retriever(settings: Settings, supabase_service: SupabaseService):
+    """Build the retrieval backend selected by RETRIEVAL_BACKEND"""
+    if settings.RETRIEVAL_BACKEND == "local":
+        return LocalVectorIndex(settings, supabase_service)
+    if settings.RETRIEVAL_BACKEND == "ivf":
+        return LocalVectorIndex(settings, supabase_service, index_type="ivf")
+    if settings.RETRIEVAL_BACKEND == "supabase":
+        return SupabaseRetriever(supabase_service)
+    raise ValueError(f"Unknown retrieval backend: {settings.RETRIEVAL_BACKEND}")
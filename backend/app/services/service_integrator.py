@@ -1,95 +1,186 @@
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 from fastapi import UploadFile
 from .document_extractor import DocumentExtractor 
 from .gemini_service import GeminiService
 from .supabase_service import SupabaseService
+from .retrieval import create_retriever
+from .table_index import TableAdjacencyIndex
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .request_coalescer import RequestCoalescer
 from ..config import Settings
+from ..utils.chunking import shift_element_ranges
+from ..utils.fingerprint import chunk_hash, content_fingerprint, normalize_text
+from ..utils.metrics import timed
+from ..utils.mmr import mmr_select
+from ..utils.timing import StageTimings
 import logging
 import asyncio
+import hashlib
 import httpx
 import json
-from io import BytesIO
+import numpy as np
+import tempfile
 
 logger = logging.getLogger(__name__)
 
 class ServiceIntegrator:
     def __init__(self, settings: Settings):
         self.settings = settings
-        self.supabase = SupabaseService()
-        self.gemini = GeminiService(settings, self.supabase)
-        self.document_extractor = DocumentExtractor(settings)
+        # One keep-alive pool shared by file downloads and the Unstructured API
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(settings.HTTP_TIMEOUT, connect=10.0)
+        )
+        self.supabase = SupabaseService(settings)
+        self.table_index = TableAdjacencyIndex(
+            self.supabase,
+            settings.TABLE_WINDOW_SIZE,
+            max_documents=settings.TABLE_INDEX_MAX_DOCUMENTS,
+            refresh_seconds=settings.TABLE_INDEX_REFRESH_SECONDS
+        )
+        self.lexical_index = LexicalIndex(settings, self.supabase) if settings.HYBRID_RETRIEVAL else None
+        self.gemini = GeminiService(settings, self.supabase, self.table_index)
+        self.document_extractor = DocumentExtractor(settings, http_client=self.http_client)
+        self.retriever = create_retriever(settings, self.supabase)
+        # Chunks are only reusable when produced by the same extractor, chunking and embedding setup
+        self.pipeline_version = (
+            f"{settings.EXTRACTION_CONFIG_VERSION}|"
+            f"chunks-{settings.CHUNK_MAX_TOKENS}-{settings.CHUNK_OVERLAP_TOKENS}|"
+            f"{settings.EMBEDDING_MODEL}"
+        )
+        # Dashboards refreshing at once send the same query many times within milliseconds
+        self.query_coalescer = RequestCoalescer(settings.QUERY_COALESCE_GRACE_SECONDS) if (
+            settings.QUERY_COALESCING_ENABLED
+        ) else None
+        # Work started by requests that must not delay their response (e.g. storing queries)
+        self._background_tasks: set = set()
+
+    async def aclose(self):
+        """Release pooled connections; called once at application shutdown"""
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self.retriever.flush()
+        await self.http_client.aclose()
+        self.document_extractor.close()
+        self.supabase.close()
         
-    async def download_file(self, file_path: str) -> UploadFile:
-        """Download file from Supabase storage"""
+    async def download_file(self, file_path: str) -> Tuple[UploadFile, str]:
+        """Download file from Supabase storage, returning it with its SHA-256 hex digest"""
         try:
             storage_path = file_path
             logger.info(f"Getting signed URL for: {storage_path}")
             
             # Get signed URL
-            result = self.supabase.client.storage \
-                .from_('pdfs') \
-                .create_signed_url(storage_path, 60)
+            result = await self.supabase.create_signed_url('pdfs', storage_path, 60)
 
             if 'signedURL' not in result:
                 raise ValueError(f"Invalid signed URL response: {result}")
 
-            # Download file using signed URL
-            async with httpx.AsyncClient() as client:
-                response = await client.get(result['signedURL'])
-                response.raise_for_status()
-                
-                return UploadFile(
-                    filename=storage_path.split('/')[-1],
-                    file=BytesIO(response.content)
-                )
+            # Stream the file over the shared connection pool into a spooled
+            # temp file so large PDFs never sit fully in memory
+            spool = tempfile.SpooledTemporaryFile(
+                max_size=self.settings.DOWNLOAD_SPOOL_MAX_BYTES,
+                dir=self.settings.DOWNLOAD_TEMP_DIR
+            )
+            try:
+                size = 0
+                digest = hashlib.sha256()
+                async with self.http_client.stream('GET', result['signedURL']) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.settings.DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.settings.MAX_FILE_SIZE:
+                            raise ValueError(
+                                f"File {storage_path} exceeds maximum size of "
+                                f"{self.settings.MAX_FILE_SIZE} bytes"
+                            )
+                        digest.update(chunk)
+                        spool.write(chunk)
+                spool.seek(0)
+            except Exception:
+                spool.close()
+                raise
+
+            logger.info(f"Downloaded {storage_path} ({size} bytes)")
+            return UploadFile(
+                filename=storage_path.split('/')[-1],
+                file=spool,
+                size=size
+            ), digest.hexdigest()
                     
         except Exception as e:
             logger.error(f"Error downloading file {file_path}: {str(e)}")
             raise
 
-    async def process_document(self, doc_id: int, file_path: str, chat_id: str) -> Dict:
-        """Process single document from storage path using natural document order"""
+    async def process_document(
+        self,
+        doc_id: int,
+        file_path: str,
+        chat_id: str,
+        on_stage: Optional[Callable[[str], None]] = None
+    ) -> Dict:
+        """Process single document from storage path using natural document order
+
+        Documents are fingerprinted by file hash and pipeline version. An
+        unchanged document is skipped, a file already processed as another
+        document has its chunks cloned, and otherwise only chunks whose
+        content changed are re-embedded and written.
+
+        ``on_stage`` is called with the name of each stage as it starts
+        (downloading, extracting, embedding, storing). The result includes
+        per-stage timings.
+        """
         logger.info(f"Processing document {doc_id} from chat {chat_id}")
+        report_stage = on_stage or (lambda stage: None)
+        timings = StageTimings(on_start=report_stage)
         try:
             await self.supabase.update_document(doc_id, {
                 'processing_status': 'processing'
             })
             
             try:
-                file = await self.download_file(file_path)
-                extracted_content = await self.document_extractor.process_file(file)
-                
-                chunks = []
+                with timings.measure('downloading'):
+                    file, file_hash = await self.download_file(file_path)
+                try:
+                    fingerprint = content_fingerprint(file_hash, self.pipeline_version)
+                    document = await self.supabase.get_document_metadata(doc_id) or {}
 
-                for chunk_index, element in enumerate(extracted_content.get('elements', [])):
-                    embedding = await self.gemini.generate_embedding(element['text'])
-                    
-                    chunks.append({
-                        'document_id': doc_id,
-                        'chunk_index': chunk_index,
-                        'chunk_type': element['chunk_type'],
-                        'text': element['text'],
-                        'page_number': element['page_number'],
-                        'table_data': element['table_data'],
-                        'embedding': embedding
-                    })
+                    if document.get('content_fingerprint') == fingerprint:
+                        logger.info(f"Document {doc_id} is unchanged, skipping")
+                        return await self._complete_document(
+                            doc_id, chat_id, fingerprint, document.get('page_count'),
+                            mode='unchanged', chunks_processed=0, chunks_embedded=0, timings=timings
+                        )
 
-                if chunks:
-                    logger.info(f"Storing {len(chunks)} chunks for document {doc_id}")
-                    await self.supabase.store_chunks(doc_id, chunks)
+                    source = await self.supabase.find_document_by_fingerprint(fingerprint, exclude_id=doc_id)
+                    if source is not None:
+                        with timings.measure('storing'):
+                            result = await self._clone_document(
+                                doc_id, chat_id, fingerprint, source, document.get('name')
+                            )
+                        return dict(result, timings=timings.report())
 
-                await self.supabase.update_document(doc_id, {
-                    'page_count': extracted_content['metadata']['total_pages'],
-                    'processing_status': 'completed'
-                })
+                    existing_chunks = await self.supabase.get_document_chunks(doc_id)
+                    self.table_index.reset(doc_id, existing_chunks)
+                    stats = await self._run_pipeline(doc_id, chat_id, file, document, existing_chunks, timings)
+                finally:
+                    await file.close()
 
-                return {
-                    'document_id': doc_id,
-                    'chat_id': chat_id,
-                    'chunks_processed': len(chunks),
-                    'page_count': extracted_content['metadata']['total_pages'],
-                    'status': 'success'
-                }
+                if any(chunk['chunk_index'] >= stats['elements'] for chunk in existing_chunks):
+                    await self.supabase.delete_chunks(doc_id, from_index=stats['elements'])
+                    self._on_chunks_deleted(chat_id, doc_id, from_index=stats['elements'])
+
+                result = await self._complete_document(
+                    doc_id, chat_id, fingerprint, stats['pages'],
+                    mode='incremental' if existing_chunks else 'full',
+                    chunks_processed=stats['chunks'], chunks_embedded=stats['embedded'], timings=timings
+                )
+                result['extraction'] = stats['extraction']
+                return result
                     
             except Exception as e:
                 logger.error(f"Error processing document {doc_id} in chat {chat_id}: {str(e)}")
@@ -102,54 +193,205 @@ class ServiceIntegrator:
             logger.error(f"Error in document processing for chat {chat_id}: {str(e)}")
             raise
 
-    async def process_documents(self, chat_id: str, documents: List[Dict]) -> List[Dict]:
-        """Process multiple documents with controlled concurrency"""
-        semaphore = asyncio.Semaphore(3)  # Process up to 3 files simultaneously
-        
-        async def process_with_semaphore(doc):
-            async with semaphore:
-                try:
-                    return await self.process_document(
-                        doc_id=doc['id'],
-                        file_path=doc['file_path'],
-                        chat_id=chat_id
-                    )
-                except Exception as e:
-                    logger.error(f"Error processing document {doc['id']}: {str(e)}")
-                    return {
-                        'document_id': doc['id'],
-                        'status': 'error',
-                        'error': str(e)
+    async def _run_pipeline(
+        self,
+        doc_id: int,
+        chat_id: str,
+        file: UploadFile,
+        document: Dict,
+        existing_chunks: List[Dict],
+        timings: StageTimings
+    ) -> Dict:
+        """Stream page batches through extraction, embedding and storage.
+
+        Stages are connected by bounded queues, so later pages are partitioned
+        while earlier ones are embedded and stored, and a slow stage makes the
+        ones before it wait. Only chunks whose content differs from the stored
+        row at the same position are written, and only new texts are embedded.
+        """
+        existing_by_index = {chunk['chunk_index']: chunk for chunk in existing_chunks}
+        embeddings_by_text = {
+            normalize_text(chunk['text']): chunk['embedding']
+            for chunk in existing_chunks if chunk.get('embedding')
+        }
+        embed_workers = max(1, self.settings.PIPELINE_EMBED_CONCURRENCY)
+        store_workers = max(1, self.settings.PIPELINE_STORE_CONCURRENCY)
+        embed_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, self.settings.PIPELINE_QUEUE_SIZE))
+        store_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, self.settings.PIPELINE_QUEUE_SIZE))
+        stats = {'elements': 0, 'source_elements': 0, 'pages': 0, 'chunks': 0, 'embedded': 0}
+        batch_metadata = []
+
+        async def extract():
+            batches = self.document_extractor.iter_page_batches(file)
+            while True:
+                with timings.measure('extracting'):
+                    batch = await anext(batches, None)
+                if batch is None:
+                    break
+                stats['pages'] = max(stats['pages'], batch['metadata']['page_range'][1])
+                batch_metadata.append(batch['metadata'])
+                changed = []
+                # Element ranges come back per batch; make them document-wide
+                elements = shift_element_ranges(batch['elements'], stats['source_elements'])
+                stats['source_elements'] += batch['metadata'].get('element_count', len(batch['elements']))
+                for element in elements:
+                    chunk_index = stats['elements']
+                    stats['elements'] += 1
+                    if (chunk_index not in existing_by_index
+                            or chunk_hash(existing_by_index[chunk_index]) != chunk_hash(element)):
+                        changed.append((chunk_index, element))
+                if changed:
+                    await embed_queue.put(changed)
+            for _ in range(embed_workers):
+                await embed_queue.put(None)
+
+        async def embed():
+            while (changed := await embed_queue.get()) is not None:
+                with timings.measure('embedding'):
+                    to_embed = list(dict.fromkeys(
+                        normalize_text(element['text'])
+                        for _, element in changed
+                        if normalize_text(element['text']) not in embeddings_by_text
+                    ))
+                    if to_embed:
+                        embeddings = await self.gemini.generate_embeddings(to_embed)
+                        embeddings_by_text.update(zip(to_embed, embeddings))
+                        stats['embedded'] += len(to_embed)
+                await store_queue.put([
+                    {
+                        'document_id': doc_id,
+                        'chunk_index': chunk_index,
+                        'chunk_type': element['chunk_type'],
+                        'text': element['text'],
+                        'page_number': element['page_number'],
+                        'table_data': element['table_data'],
+                        'element_start': element.get('element_start'),
+                        'element_end': element.get('element_end'),
+                        'embedding': embeddings_by_text[normalize_text(element['text'])]
                     }
+                    for chunk_index, element in changed
+                ])
 
+        async def embed_stage():
+            await asyncio.gather(*[embed() for _ in range(embed_workers)])
+            for _ in range(store_workers):
+                await store_queue.put(None)
+
+        async def store():
+            while (chunks := await store_queue.get()) is not None:
+                with timings.measure('storing'):
+                    # Upsert so a batch retried after a partial failure is idempotent
+                    stored = await self.supabase.store_chunks(doc_id, chunks, upsert=True)
+                # The stored rows carry the chunk ids the local index re-ranks by
+                self._on_chunks_stored(chat_id, doc_id, stored, document.get('name'))
+                stats['chunks'] += len(chunks)
+
+        tasks = [
+            asyncio.create_task(extract()),
+            asyncio.create_task(embed_stage()),
+            *[asyncio.create_task(store()) for _ in range(store_workers)],
+        ]
         try:
-            tasks = [process_with_semaphore(doc) for doc in documents]
-            results = await asyncio.gather(*tasks)
-            return results
-            
-        except Exception as e:
-            logger.error(f"Error in batch processing: {str(e)}")
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
             raise
 
+        stats['extraction'] = DocumentExtractor.strategy_report(batch_metadata)
+        logger.info(
+            f"Stored {stats['chunks']} of {stats['elements']} chunks for document {doc_id} "
+            f"({stats['embedded']} newly embedded); extraction pages {stats['extraction']['pages']}"
+        )
+        return stats
+
+    async def _clone_document(
+        self,
+        doc_id: int,
+        chat_id: str,
+        fingerprint: str,
+        source: Dict,
+        document_name: Optional[str] = None
+    ) -> Dict:
+        """Copy the chunks of an identical, already processed document"""
+        logger.info(f"Document {doc_id} matches document {source['id']}, cloning chunks")
+        source_chunks = await self.supabase.get_document_chunks(source['id'])
+        chunks = [
+            {
+                'chunk_index': chunk['chunk_index'],
+                'chunk_type': chunk['chunk_type'],
+                'text': chunk['text'],
+                'page_number': chunk['page_number'],
+                'table_data': chunk['table_data'],
+                'element_start': chunk.get('element_start'),
+                'element_end': chunk.get('element_end'),
+                'embedding': chunk['embedding']
+            }
+            for chunk in source_chunks
+        ]
+        await self.supabase.delete_chunks(doc_id)
+        self._on_chunks_deleted(chat_id, doc_id)
+        if chunks:
+            stored = await self.supabase.store_chunks(doc_id, chunks)
+            self._on_chunks_stored(chat_id, doc_id, stored, document_name)
+        return await self._complete_document(
+            doc_id, chat_id, fingerprint, source.get('page_count'),
+            mode='cloned', chunks_processed=len(chunks), chunks_embedded=0
+        )
+
+    async def _complete_document(
+        self,
+        doc_id: int,
+        chat_id: str,
+        fingerprint: str,
+        page_count: Optional[int],
+        mode: str,
+        chunks_processed: int,
+        chunks_embedded: int,
+        timings: Optional[StageTimings] = None
+    ) -> Dict:
+        await self.supabase.update_document(doc_id, {
+            'page_count': page_count,
+            'content_fingerprint': fingerprint,
+            'processing_status': 'completed'
+        })
+
+        result = {
+            'document_id': doc_id,
+            'chat_id': chat_id,
+            'chunks_processed': chunks_processed,
+            'chunks_embedded': chunks_embedded,
+            'page_count': page_count,
+            'ingestion_mode': mode,
+            'status': 'success'
+        }
+        if timings is not None:
+            result['timings'] = timings.report()
+        return result
+
     async def query_documents(
         self,
         query: str,
         chat_id: str,
         document_ids: Optional[List[int]] = None
+    ) -> Dict:
+        """Answer a query; identical concurrent queries are answered (and stored) once"""
+        if self.query_coalescer is None:
+            return await self._query_documents(query, chat_id, document_ids)
+
+        key = (query, str(chat_id), tuple(sorted(document_ids)) if document_ids else None)
+        result = await self.query_coalescer.run(key, lambda: self._query_documents(query, chat_id, document_ids))
+        return dict(result)
+
+    async def _query_documents(
+        self,
+        query: str,
+        chat_id: str,
+        document_ids: Optional[List[int]] = None
     ) -> Dict:
         try:
-            # Generate query embedding
-            query_embedding = await self.gemini.generate_embedding(query)
-            
-            # Find similar chunks with adjusted threshold
-            chunks = await self.supabase.find_similar_chunks(
-                embedding=query_embedding,
-                chat_id=chat_id,
-                document_ids=document_ids,
-                threshold=0.35,  
-                limit=5  # Get more context
-            )
-            logger.info(f"Found chunks: {json.dumps(chunks, indent=2)}")
+            chunks = await self._find_chunks(query, chat_id, document_ids)
             # Generate response with enhanced formatting
             response = await self.gemini.generate_response(query, chunks)
 
@@ -168,4 +410,231 @@ class ServiceIntegrator:
             
         except Exception as e:
             logger.error(f"Error in query processing: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+    async def query_documents_stream(
+        self,
+        query: str,
+        chat_id: str,
+        document_ids: Optional[List[int]] = None
+    ) -> AsyncIterator[Dict]:
+        """Stream a query's answer as events: 'sources' once retrieval is done,
+        then one 'token' per generated piece and a final 'done'.
+
+        The query is stored in the background after the last token. If the
+        client disconnects mid-stream, the pieces it was sent are stored
+        instead; a failed generation is not stored.
+        """
+        pieces: List[str] = []
+        finished = failed = False
+        try:
+            chunks = await self._find_chunks(query, chat_id, document_ids)
+            yield {'event': 'sources', 'data': chunks}
+
+            async for text in self.gemini.generate_response_stream(query, chunks):
+                pieces.append(text)
+                yield {'event': 'token', 'data': text}
+            finished = True
+            yield {'event': 'done', 'data': None}
+
+        except Exception as e:
+            failed = True
+            logger.error(f"Error in streaming query processing: {str(e)}")
+            raise
+
+        finally:
+            # Also reached through GeneratorExit when the client goes away
+            if not failed and (finished or pieces):
+                self._run_in_background(self.supabase.store_query(
+                    chat_id=chat_id,
+                    query_text=query,
+                    response_text="".join(pieces),
+                    source_references=chunks
+                ))
+
+    async def query_documents_batch(
+        self,
+        queries: List[str],
+        chat_id: str,
+        document_ids: Optional[List[int]] = None
+    ) -> List[Dict]:
+        """Answer many questions against one chat.
+
+        The questions are embedded in batched requests and retrieved in one
+        pass over the index; answers are generated QUERY_BATCH_CONCURRENCY at
+        a time and the query history is stored with a single insert. A
+        question whose generation fails gets an ``error`` instead of a
+        response without failing the rest.
+        """
+        try:
+            chunk_lists = await self._find_chunks_many(queries, chat_id, document_ids)
+            semaphore = asyncio.Semaphore(max(1, self.settings.QUERY_BATCH_CONCURRENCY))
+
+            async def answer(query: str, chunks: List[Dict]) -> Dict:
+                async with semaphore:
+                    try:
+                        response = await self.gemini.generate_response(query, chunks)
+                        return {'query': query, 'response': response, 'source_references': chunks, 'error': None}
+                    except Exception as e:
+                        logger.error(f"Error answering batch query {query!r}: {str(e)}")
+                        return {'query': query, 'response': None, 'source_references': chunks, 'error': str(e)}
+
+            results = await asyncio.gather(*[
+                answer(query, chunks) for query, chunks in zip(queries, chunk_lists)
+            ])
+
+            await self.supabase.store_queries(chat_id, [
+                {
+                    'query_text': result['query'],
+                    'response_text': result['response'],
+                    'source_references': result['source_references']
+                }
+                for result in results if result['error'] is None
+            ])
+            logger.info(
+                f"Answered batch of {len(queries)} queries "
+                f"({sum(result['error'] is not None for result in results)} failed)"
+            )
+            return results
+
+        except Exception as e:
+            logger.error(f"Error in batch query processing: {str(e)}")
+            raise
+
+    def _retrieval_limits(self) -> Tuple[int, int, int]:
+        """(chunks returned, candidates kept before MMR, candidates per vector/BM25 list)"""
+        limit = 5  # Get more context
+        # MMR needs candidate vectors, which only the in-process indexes hold
+        mmr = self.settings.MMR_ENABLED and self.retriever.has_embeddings
+        fetch = limit * max(1, self.settings.MMR_FETCH_FACTOR) if mmr else limit
+        candidates = max(fetch, self.settings.HYBRID_CANDIDATES) if self.lexical_index is not None else fetch
+        return limit, fetch, candidates
+
+    async def _find_chunks(self, query: str, chat_id: str, document_ids: Optional[List[int]]) -> List[Dict]:
+        """Vector matches, fused with BM25 keyword matches when HYBRID_RETRIEVAL is on.
+
+        With MMR_ENABLED and a local retrieval backend, limit * MMR_FETCH_FACTOR
+        candidates are fetched and re-ranked so near-duplicate fragments do not crowd out the top results.
+        """
+        limit, fetch, candidates = self._retrieval_limits()
+
+        async def vector_search() -> List[Dict]:
+            # Generate query embedding
+            query_embedding = await self.gemini.generate_embedding(query)
+
+            # Find similar chunks with adjusted threshold
+            return await self.retriever.find_similar_chunks(
+                embedding=query_embedding,
+                chat_id=chat_id,
+                document_ids=document_ids,
+                threshold=0.35,
+                limit=candidates
+            )
+
+        if self.lexical_index is None:
+            vector_chunks, lexical_chunks = await vector_search(), None
+        else:
+            # Keyword search needs no embedding, so it runs while the query is embedded
+            vector_chunks, lexical_chunks = await asyncio.gather(
+                vector_search(),
+                self.lexical_index.search(query, chat_id, document_ids=document_ids, limit=candidates)
+            )
+
+        chunks = await self._select_chunks(vector_chunks, lexical_chunks, chat_id, limit, fetch)
+        logger.info(f"Found chunks: {json.dumps(chunks, indent=2)}")
+        return chunks
+
+    async def _find_chunks_many(
+        self,
+        queries: List[str],
+        chat_id: str,
+        document_ids: Optional[List[int]]
+    ) -> List[List[Dict]]:
+        """_find_chunks for many questions with batched embedding and one retrieval pass"""
+        limit, fetch, candidates = self._retrieval_limits()
+
+        async def vector_search() -> List[List[Dict]]:
+            embeddings = await self.gemini.generate_embeddings(queries)
+            return await self.retriever.find_similar_chunks_many(
+                embeddings=embeddings,
+                chat_id=chat_id,
+                document_ids=document_ids,
+                threshold=0.35,
+                limit=candidates
+            )
+
+        async def lexical_search() -> List[List[Dict]]:
+            return [
+                await self.lexical_index.search(query, chat_id, document_ids=document_ids, limit=candidates)
+                for query in queries
+            ]
+
+        if self.lexical_index is None:
+            vector_lists, lexical_lists = await vector_search(), [None] * len(queries)
+        else:
+            vector_lists, lexical_lists = await asyncio.gather(vector_search(), lexical_search())
+
+        chunk_lists = await asyncio.gather(*[
+            self._select_chunks(vector_chunks, lexical_chunks, chat_id, limit, fetch)
+            for vector_chunks, lexical_chunks in zip(vector_lists, lexical_lists)
+        ])
+        logger.info(f"Found chunks for {len(queries)} queries: {sum(len(chunks) for chunks in chunk_lists)} total")
+        return chunk_lists
+
+    async def _select_chunks(
+        self,
+        vector_chunks: List[Dict],
+        lexical_chunks: Optional[List[Dict]],
+        chat_id: str,
+        limit: int,
+        fetch: int
+    ) -> List[Dict]:
+        """Fuse the candidate lists (when there are keyword matches) and diversify down to limit"""
+        if lexical_chunks is None:
+            chunks = vector_chunks[:fetch]
+        else:
+            chunks = reciprocal_rank_fusion([vector_chunks, lexical_chunks], k=self.settings.RRF_K, limit=fetch)
+            for chunk in chunks:
+                # Keyword-only matches have no vector similarity
+                chunk.setdefault('similarity', 0.0)
+
+        if len(chunks) > limit:
+            chunks = await self._diversify(chunks, chat_id, limit)
+        return chunks
+
+    async def _diversify(self, chunks: List[Dict], chat_id: str, limit: int) -> List[Dict]:
+        """Pick limit of the ranked candidates by maximal marginal relevance"""
+        vectors = await self.retriever.get_embeddings(chat_id, chunks)
+        relevance = np.array(
+            [chunk.get('fusion_score', chunk.get('similarity', 0.0)) for chunk in chunks], dtype=np.float32
+        )
+        # Scale to a best score of 1 so MMR_LAMBDA means the same for cosine and fused scores
+        relevance /= relevance.max() if relevance.max() > 0 else 1.0
+        with timed('retrieval.mmr'):
+            order = mmr_select(relevance, vectors, limit, self.settings.MMR_LAMBDA)
+        return [chunks[i] for i in order]
+
+    def _on_chunks_stored(self, chat_id: str, doc_id: int, chunks: List[Dict], document_name: Optional[str] = None):
+        """Keep the in-memory retrieval indexes in sync with stored chunks"""
+        self.retriever.on_chunks_stored(chat_id, doc_id, chunks, document_name)
+        self.table_index.on_chunks_stored(doc_id, chunks)
+        if self.lexical_index is not None:
+            self.lexical_index.on_chunks_stored(chat_id, doc_id, chunks, document_name)
+
+    def _on_chunks_deleted(self, chat_id: str, doc_id: int, from_index: int = 0):
+        self.retriever.on_chunks_deleted(chat_id, doc_id, from_index=from_index)
+        self.table_index.on_chunks_deleted(doc_id, from_index=from_index)
+        if self.lexical_index is not None:
+            self.lexical_index.on_chunks_deleted(chat_id, doc_id, from_index=from_index)
+
+    def _run_in_background(self, coroutine):
+        """Run work off the request path; failures are logged, and aclose waits for it"""
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+
+        def finished(done: asyncio.Task):
+            self._background_tasks.discard(done)
+            if not done.cancelled() and done.exception() is not None:
+                logger.error(f"Error in background task: {str(done.exception())}")
+
+        task.add_done_callback(finished)
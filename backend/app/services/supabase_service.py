@@ -1,19 +1,90 @@
-from supabase import create_client
-from typing import Dict, List, Optional
+from supabase import ClientOptions, create_client
+from typing import Any, Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
 import logging
-from app.config import settings
+import time
+from app.config import Settings, settings
+from app.utils.metrics import instrumented
+from app.utils.quantization import decode_embedding, encode_embedding
 import json
 
 logger = logging.getLogger(__name__)
 
+# chunks columns other than the float embedding, for compact reads
+COMPACT_CHUNK_COLUMNS = (
+    'id,document_id,chunk_index,chunk_type,text,page_number,table_data,element_start,element_end,embedding_q'
+)
+
 
 class SupabaseService:
-    def __init__(self):
+    def __init__(self, settings: Settings = settings):
+        # The HTTP timeout is what ends a hung call and frees its executor thread
         self.client = create_client(
             settings.SUPABASE_URL,
-            settings.SUPABASE_SERVICE_KEY
+            settings.SUPABASE_SERVICE_KEY,
+            options=ClientOptions(
+                postgrest_client_timeout=settings.SUPABASE_TIMEOUT,
+                storage_client_timeout=settings.SUPABASE_TIMEOUT
+            )
+        )
+        self.timeout = settings.SUPABASE_TIMEOUT
+        self.embedding_storage_format = settings.EMBEDDING_STORAGE_FORMAT
+        self.insert_batch_rows = max(1, settings.CHUNK_INSERT_BATCH_ROWS)
+        self.insert_batch_bytes = settings.CHUNK_INSERT_BATCH_BYTES
+        self.insert_concurrency = max(1, settings.CHUNK_INSERT_CONCURRENCY)
+        self.insert_max_retries = settings.CHUNK_INSERT_MAX_RETRIES
+        self.insert_retry_backoff = settings.CHUNK_INSERT_RETRY_BACKOFF
+        self.read_page_rows = max(1, settings.CHUNK_READ_PAGE_ROWS)
+        self._write_stats = {'rows': 0, 'bytes': 0, 'batches': 0, 'retries': 0, 'failures': 0, 'seconds': 0.0}
+        # supabase-py is synchronous; run every round trip on a dedicated,
+        # bounded pool so a slow query never blocks the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.SUPABASE_MAX_WORKERS,
+            thread_name_prefix="supabase"
+        )
+
+    async def _run(self, func: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """Run a blocking supabase-py call on the executor.
+
+        The client's HTTP timeout fails a call that stops responding, which
+        ends its thread, so a retry never overlaps the attempt it replaces.
+        httpx applies that timeout per read, though, so a response that keeps
+        trickling in can outlast it; ``wait_for`` abandons those at twice
+        the timeout. An abandoned thread runs on until the response ends,
+        so at most SUPABASE_MAX_WORKERS such calls can pile up before later
+        calls queue behind them.
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(self.executor, func),
+            timeout=2 * (timeout or self.timeout)
         )
 
+    async def _execute(self, query, timeout: Optional[float] = None) -> Any:
+        """Execute a query builder off the event loop"""
+        return await self._run(query.execute, timeout)
+
+    async def _select_all(self, build: Callable[[], Any]) -> List[Dict]:
+        """Run a select built by ``build`` page by page until a short page.
+
+        PostgREST truncates any single response at its max-rows limit, so
+        reads that can exceed it are paged with ``.range()``.
+        """
+        rows, offset = [], 0
+        while True:
+            result = await self._execute(build().range(offset, offset + self.read_page_rows - 1))
+            rows.extend(result.data)
+            if len(result.data) < self.read_page_rows:
+                return rows
+            offset += self.read_page_rows
+
+    def close(self):
+        """Stop the executor; in-flight calls are allowed to finish"""
+        self.executor.shutdown(wait=False)
+
+    @instrumented('supabase.store_document')
     async def store_document(self, metadata: Dict) -> Dict:
         """Store initial document metadata"""
         try:
@@ -24,45 +95,50 @@ class SupabaseService:
                 'upload_date': 'NOW()',
                 'processing_status': 'processing'
             }
-            result = self.client.table('documents').insert(data).execute()
+            result = await self._execute(self.client.table('documents').insert(data))
             return result.data[0]
         except Exception as e:
             logger.error(f"Error storing document: {str(e)}")
             raise
 
+    @instrumented('supabase.update_document')
     async def update_document(self, document_id: int, updates: Dict):
         """Update document metadata"""
         try:
-            self.client.table('documents')\
-                .update(updates)\
-                .eq('id', document_id)\
-                .execute()
+            await self._execute(
+                self.client.table('documents')
+                .update(updates)
+                .eq('id', document_id)
+            )
         except Exception as e:
             logger.error(f"Error updating document: {str(e)}")
             raise
 
-    async def store_chunks(self, document_id: int, chunks: List[Dict]) -> List[Dict]:
-        """Store document chunks with embeddings"""
+    @instrumented('supabase.store_chunks')
+    async def store_chunks(self, document_id: int, chunks: List[Dict], upsert: bool = False) -> List[Dict]:
+        """Store document chunks with embeddings
+
+        Chunks keep their ``chunk_index`` when present. With ``upsert`` rows
+        replace existing ones on (document_id, chunk_index).
+
+        Rows are sent in batches bounded by CHUNK_INSERT_BATCH_ROWS and
+        CHUNK_INSERT_BATCH_BYTES, up to CHUNK_INSERT_CONCURRENCY at a time.
+        A failed batch is retried as an upsert on (document_id, chunk_index),
+        so a retry after a write that did land cannot duplicate rows.
+
+        Returns the stored rows, ids included.
+        """
         try:
             formatted_chunks = []
             for idx, chunk in enumerate(chunks):
-                # Ensure table_data is properly JSON encoded if present
-                table_data = None
-                if chunk.get("table_data"):
-                    if isinstance(chunk["table_data"], str):
-                        # If it's already a JSON string, verify it's valid
-                        try:
-                            json.loads(chunk["table_data"])
-                            table_data = chunk["table_data"]
-                        except json.JSONDecodeError:
-                            table_data = json.dumps(chunk["table_data"])
-                    else:
-                        # If it's a dict/object, convert to JSON string
-                        table_data = json.dumps(chunk["table_data"])
+                # table_data is stored as a JSON string; strings are passed through as is
+                table_data = chunk.get("table_data") or None
+                if table_data is not None and not isinstance(table_data, str):
+                    table_data = json.dumps(table_data)
 
                 formatted_chunk = {
                     "document_id": document_id,
-                    "chunk_index": idx,
+                    "chunk_index": chunk.get("chunk_index", idx),
                     "chunk_type": chunk["chunk_type"],
                     "text": chunk["text"],
                     "page_number": chunk["page_number"],
@@ -70,17 +146,198 @@ class SupabaseService:
                     # Make sure embedding is included
                     "embedding": chunk.get("embedding")
                 }
+                if chunk.get("element_start") is not None:
+                    formatted_chunk["element_start"] = chunk["element_start"]
+                    formatted_chunk["element_end"] = chunk["element_end"]
+                if self.embedding_storage_format != "float" and chunk.get("embedding") is not None:
+                    formatted_chunk["embedding_q"] = encode_embedding(
+                        chunk["embedding"], self.embedding_storage_format
+                    )
                 formatted_chunks.append(formatted_chunk)
 
-            if formatted_chunks:
-                result = self.client.table('chunks').insert(
-                    formatted_chunks).execute()
-                return result.data
-            return []
+            if not formatted_chunks:
+                return []
+
+            batches = self._split_batches(formatted_chunks)
+            semaphore = asyncio.Semaphore(self.insert_concurrency)
+
+            async def write(batch: List[Dict], size: int) -> List[Dict]:
+                async with semaphore:
+                    return await self._write_chunk_batch(batch, size, upsert)
+
+            start = time.perf_counter()
+            try:
+                results = await asyncio.gather(*[write(batch, size) for batch, size in batches])
+            finally:
+                # Wall time of the call: batches overlap, so their durations do not add up
+                elapsed = time.perf_counter() - start
+                self._write_stats['seconds'] += elapsed
+            total_bytes = sum(size for _, size in batches)
+            logger.info(
+                f"Stored {len(formatted_chunks)} chunks for document {document_id} in "
+                f"{len(batches)} batches, {elapsed:.2f}s "
+                f"({len(formatted_chunks) / max(elapsed, 1e-6):.0f} rows/s, "
+                f"{total_bytes / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s)"
+            )
+            rows = [row for result in results for row in result]
+            for row in rows:
+                # pgvector columns come back from PostgREST as "[0.1,0.2,...]"
+                if isinstance(row.get('embedding'), str):
+                    row['embedding'] = json.loads(row['embedding'])
+            return rows
         except Exception as e:
             logger.error(f"Error storing chunks: {str(e)}")
             raise
 
+    def _split_batches(self, rows: List[Dict]) -> List[tuple]:
+        """Group rows into (batch, estimated bytes) under the row and byte limits"""
+        batches, batch, batch_bytes = [], [], 0
+        for row in rows:
+            size = self._estimate_row_bytes(row)
+            if batch and (len(batch) >= self.insert_batch_rows or batch_bytes + size > self.insert_batch_bytes):
+                batches.append((batch, batch_bytes))
+                batch, batch_bytes = [], 0
+            batch.append(row)
+            batch_bytes += size
+        if batch:
+            batches.append((batch, batch_bytes))
+        return batches
+
+    @staticmethod
+    def _estimate_row_bytes(row: Dict) -> int:
+        """Approximate JSON size of a chunk row without serializing it"""
+        embedding = row.get("embedding")
+        return (
+            len(row["text"]) + len(row["table_data"] or "") + len(row.get("embedding_q") or "")
+            # A float from the embedding API serializes to ~20 characters
+            + (20 * len(embedding) if embedding is not None else 0)
+            + 200
+        )
+
+    async def _write_chunk_batch(self, batch: List[Dict], size: int, upsert: bool) -> List[Dict]:
+        attempt = 0
+        while True:
+            try:
+                table = self.client.table('chunks')
+                if upsert or attempt > 0:
+                    query = table.upsert(batch, on_conflict='document_id,chunk_index')
+                else:
+                    query = table.insert(batch)
+                result = await self._execute(query)
+            except Exception as e:
+                if attempt >= self.insert_max_retries:
+                    self._write_stats['failures'] += 1
+                    raise
+                attempt += 1
+                self._write_stats['retries'] += 1
+                logger.info(
+                    f"Retrying chunk batch {batch[0]['chunk_index']}-{batch[-1]['chunk_index']} "
+                    f"(attempt {attempt}): {str(e)}"
+                )
+                await asyncio.sleep(self.insert_retry_backoff * 2 ** (attempt - 1))
+                continue
+
+            self._write_stats['rows'] += len(batch)
+            self._write_stats['bytes'] += size
+            self._write_stats['batches'] += 1
+            return result.data
+
+    def write_stats(self) -> Dict:
+        """Cumulative chunk write counters and throughput over the wall time of store_chunks calls"""
+        stats = dict(self._write_stats)
+        seconds = stats['seconds']
+        stats['rows_per_second'] = stats['rows'] / seconds if seconds else 0.0
+        stats['bytes_per_second'] = stats['bytes'] / seconds if seconds else 0.0
+        return stats
+
+    @instrumented('supabase.get_document_chunks')
+    async def get_document_chunks(self, document_id: int, compact: bool = False) -> List[Dict]:
+        """Get all chunks of a document, embeddings included, in chunk order
+
+        With ``compact`` and a quantized EMBEDDING_STORAGE_FORMAT, embeddings
+        are read from the embedding_q blobs (decoded to float32 arrays)
+        instead of the much larger JSON float column. Documents stored before
+        blobs were enabled fall back to the full column.
+        """
+        try:
+            if compact and self.embedding_storage_format != "float":
+                chunks = await self._select_all(lambda: (
+                    self.client.table('chunks')
+                    .select(COMPACT_CHUNK_COLUMNS)
+                    .eq('document_id', document_id)
+                    .order('chunk_index')
+                ))
+                if all(chunk.get('embedding_q') for chunk in chunks):
+                    for chunk in chunks:
+                        chunk['embedding'] = decode_embedding(chunk.pop('embedding_q'))
+                    return chunks
+
+            chunks = await self._select_all(lambda: (
+                self.client.table('chunks')
+                .select('*')
+                .eq('document_id', document_id)
+                .order('chunk_index')
+            ))
+            for chunk in chunks:
+                # pgvector columns come back from PostgREST as "[0.1,0.2,...]"
+                if isinstance(chunk.get('embedding'), str):
+                    chunk['embedding'] = json.loads(chunk['embedding'])
+            return chunks
+        except Exception as e:
+            logger.error(f"Error getting document chunks: {str(e)}")
+            raise
+
+    @instrumented('supabase.get_chunk_embeddings')
+    async def get_chunk_embeddings(self, chunk_ids: List[int]) -> Dict[int, List[float]]:
+        """Get the full-precision embeddings of the given chunks by id"""
+        try:
+            if not chunk_ids:
+                return {}
+            result = await self._execute(
+                self.client.table('chunks')
+                .select('id,embedding')
+                .in_('id', chunk_ids)
+            )
+            embeddings = {}
+            for row in result.data:
+                embedding = row['embedding']
+                embeddings[row['id']] = json.loads(embedding) if isinstance(embedding, str) else embedding
+            return embeddings
+        except Exception as e:
+            logger.error(f"Error getting chunk embeddings: {str(e)}")
+            raise
+
+    @instrumented('supabase.delete_chunks')
+    async def delete_chunks(self, document_id: int, from_index: int = 0):
+        """Delete a document's chunks with chunk_index >= from_index"""
+        try:
+            await self._execute(
+                self.client.table('chunks')
+                .delete()
+                .eq('document_id', document_id)
+                .gte('chunk_index', from_index)
+            )
+        except Exception as e:
+            logger.error(f"Error deleting chunks: {str(e)}")
+            raise
+
+    @instrumented('supabase.find_document_by_fingerprint')
+    async def find_document_by_fingerprint(self, fingerprint: str, exclude_id: Optional[int] = None) -> Optional[Dict]:
+        """Find a completed document whose content fingerprint matches"""
+        try:
+            query = self.client.table('documents')\
+                .select('*')\
+                .eq('content_fingerprint', fingerprint)\
+                .eq('processing_status', 'completed')
+            if exclude_id is not None:
+                query = query.neq('id', exclude_id)
+            result = await self._execute(query.limit(1))
+            return result.data[0] if result.data else None
+        except Exception as e:
+            logger.error(f"Error finding document by fingerprint: {str(e)}")
+            raise
+
+    @instrumented('supabase.match_documents')
     async def find_similar_chunks(
         self,
         embedding: List[float],
@@ -103,77 +360,142 @@ class SupabaseService:
             Query embedding length: {len(embedding)}
             Doc IDs filter: {document_ids}
             """)
-            result = self.client.rpc('match_documents', params).execute()
+            result = await self._execute(self.client.rpc('match_documents', params))
             return result.data
         except Exception as e:
             logger.error(f"Error finding similar chunks: {str(e)}")
             raise
 
+    @instrumented('supabase.store_query')
     async def store_query(self, chat_id: str, query_text: str, response_text: str, source_references: List[Dict]):
         """Store query and response"""
         try:
-            processed_references = []
-            for ref in source_references:
-                processed_ref = {
-                    'document_id': int(ref.get('document_id')),
-                    'document_name': str(ref.get('document_name')),
-                    'page_number': int(ref.get('page_number')),
-                    'text': str(ref.get('text')),
-                    'chunk_type': str(ref.get('chunk_type', 'text')),
-                    'similarity': float(ref.get('similarity', 0.0))
-                }
+            data = self._query_row(chat_id, query_text, response_text, source_references)
+            result = await self._execute(self.client.table('queries').insert(data))
+            return result.data[0]
+        except Exception as e:
+            logger.error(f"Error storing query: {str(e)}")
+            raise
 
-                # Handle table_data properly
-                if 'table_data' in ref and ref['table_data']:
-                    if isinstance(ref['table_data'], str):
-                        try:
-                            # Verify it's valid JSON if it's a string
-                            json.loads(ref['table_data'])
-                            processed_ref['table_data'] = ref['table_data']
-                        except json.JSONDecodeError:
-                            processed_ref['table_data'] = json.dumps(
-                                ref['table_data'])
-                    else:
+    @instrumented('supabase.store_queries')
+    async def store_queries(self, chat_id: str, queries: List[Dict]) -> List[Dict]:
+        """Store many queries with one insert; each item has query_text, response_text and source_references"""
+        if not queries:
+            return []
+        try:
+            rows = [
+                self._query_row(chat_id, item['query_text'], item['response_text'], item['source_references'])
+                for item in queries
+            ]
+            result = await self._execute(self.client.table('queries').insert(rows))
+            return result.data
+        except Exception as e:
+            logger.error(f"Error storing queries: {str(e)}")
+            raise
+
+    @staticmethod
+    def _query_row(chat_id: str, query_text: str, response_text: str, source_references: List[Dict]) -> Dict:
+        """Row for the queries table, with source references reduced to their stored fields"""
+        processed_references = []
+        for ref in source_references:
+            processed_ref = {
+                'document_id': int(ref.get('document_id')),
+                'document_name': str(ref.get('document_name')),
+                'page_number': int(ref.get('page_number')),
+                'text': str(ref.get('text')),
+                'chunk_type': str(ref.get('chunk_type', 'text')),
+                'similarity': float(ref.get('similarity', 0.0))
+            }
+
+            # Handle table_data properly
+            if 'table_data' in ref and ref['table_data']:
+                if isinstance(ref['table_data'], str):
+                    try:
+                        # Verify it's valid JSON if it's a string
+                        json.loads(ref['table_data'])
+                        processed_ref['table_data'] = ref['table_data']
+                    except json.JSONDecodeError:
                         processed_ref['table_data'] = json.dumps(
                             ref['table_data'])
+                else:
+                    processed_ref['table_data'] = json.dumps(
+                        ref['table_data'])
 
-                processed_references.append(processed_ref)
-
-            data = {
-                'chat_id': str(chat_id),
-                'query_text': query_text,
-                'response_text': response_text,
-                'source_references': processed_references,
-                'timestamp': 'NOW()'
-            }
+            processed_references.append(processed_ref)
 
-            result = self.client.table('queries').insert(data).execute()
-            return result.data[0]
-        except Exception as e:
-            logger.error(f"Error storing query: {str(e)}")
-            raise
+        return {
+            'chat_id': str(chat_id),
+            'query_text': query_text,
+            'response_text': response_text,
+            'source_references': processed_references,
+            'timestamp': 'NOW()'
+        }
 
+    @instrumented('supabase.get_document_metadata')
     async def get_document_metadata(self, document_id: int) -> Dict:
         """Get document metadata"""
         try:
-            result = self.client.table('documents')\
-                .select('*')\
-                .eq('id', document_id)\
-                .single()\
-                .execute()
+            result = await self._execute(
+                self.client.table('documents')
+                .select('*')
+                .eq('id', document_id)
+                .single()
+            )
             return result.data
         except Exception as e:
             logger.error(f"Error getting document metadata: {str(e)}")
             raise
 
+    @instrumented('supabase.get_chat_documents')
     async def get_chat_documents(self, chat_id: str) -> List[Dict]:
         """Get all documents for a chat"""
         try:
-            result = self.client.table('documents')\
-                .select('*')\
-                .eq('chat_id', chat_id)\
-                .execute()
+            result = await self._execute(
+                self.client.table('documents')
+                .select('*')
+                .eq('chat_id', chat_id)
+            )
             return result.data
         except Exception as e:
             logger.error(f"Error getting chat documents: {str(e)}")
             raise
+
+    @instrumented('supabase.get_document_texts')
+    async def get_document_texts(self, document_id: int) -> List[Dict]:
+        """Get a document's chunks without embeddings, in chunk order"""
+        try:
+            return await self._select_all(lambda: (
+                self.client.table('chunks')
+                .select('id,document_id,chunk_index,chunk_type,text,page_number,table_data')
+                .eq('document_id', document_id)
+                .order('chunk_index')
+            ))
+        except Exception as e:
+            logger.error(f"Error getting document texts: {str(e)}")
+            raise
+
+    @instrumented('supabase.get_document_tables')
+    async def get_document_tables(self, document_id: int) -> List[Dict]:
+        """Get a document's table chunks, without embeddings, in chunk order"""
+        try:
+            return await self._select_all(lambda: (
+                self.client.table('chunks')
+                .select('id,document_id,chunk_index,chunk_type,text,page_number,table_data')
+                .eq('document_id', document_id)
+                .eq('chunk_type', 'table')
+                .order('chunk_index')
+            ))
+        except Exception as e:
+            logger.error(f"Error getting document tables: {str(e)}")
+            raise
+
+    @instrumented('supabase.create_signed_url')
+    async def create_signed_url(self, bucket: str, path: str, expires_in: int) -> Dict:
+        """Create a signed URL for a storage object"""
+        try:
+            return await self._run(
+                partial(self.client.storage.from_(bucket).create_signed_url, path, expires_in)
+            )
+        except Exception as e:
+            logger.error(f"Error creating signed URL: {str(e)}")
+            raise
@@ -0,0 +1,144 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from .supabase_service import SupabaseService
+
+logger = logging.getLogger(__name__)
+
+TABLE_COLUMNS = ('id', 'document_id', 'chunk_index', 'chunk_type', 'text', 'page_number', 'table_data')
+UNKNOWN = object()  # Fingerprint of an entry seeded by this process's ingestion
+
+
+class TableAdjacencyIndex:
+    """In-memory map from a chunk's position to the nearest table on its page.
+
+    Holds only each document's table chunks, grouped by page and sorted by
+    chunk_index, so finding the table next to a retrieved chunk is a bisect
+    instead of a database query. Documents are seeded during ingestion and
+    kept in sync as chunks are stored or deleted; any other document is
+    loaded with one query the first time it is looked up.
+
+    At most ``max_documents`` documents are held, evicting the least
+    recently looked up. Other processes ingest too, so an entry checked
+    more than ``refresh_seconds`` ago is compared with the document's
+    content fingerprint on lookup and reloaded if it changed.
+    """
+
+    def __init__(
+        self,
+        supabase_service: SupabaseService,
+        window_size: int = 5,
+        max_documents: int = 1024,
+        refresh_seconds: float = 30.0
+    ):
+        self.supabase = supabase_service
+        self.window_size = window_size
+        self.max_documents = max(1, max_documents)
+        self.refresh_seconds = refresh_seconds
+        self._tables: "OrderedDict[int, Dict[int, Dict]]" = OrderedDict()
+        self._pages: Dict[int, Dict[int, List[int]]] = {}
+        self._fingerprints: Dict[int, object] = {}
+        self._checked_at: Dict[int, float] = {}
+        self._load_locks: Dict[int, asyncio.Lock] = {}
+
+    def reset(self, document_id: int, chunks: List[Dict]):
+        """Replace a document's entry with the tables among ``chunks``"""
+        self._set(document_id, UNKNOWN, chunks)
+
+    def _set(self, document_id: int, fingerprint: object, chunks: List[Dict]):
+        self._tables[document_id] = {}
+        self._pages.pop(document_id, None)
+        self._fingerprints[document_id] = fingerprint
+        self._checked_at[document_id] = time.monotonic()
+        self.on_chunks_stored(document_id, chunks)
+        self._evict(keep=document_id)
+
+    def _evict(self, keep: int):
+        self._tables.move_to_end(keep)
+        while len(self._tables) > self.max_documents:
+            document_id, _ = self._tables.popitem(last=False)
+            self._pages.pop(document_id, None)
+            self._fingerprints.pop(document_id, None)
+            self._checked_at.pop(document_id, None)
+            self._load_locks.pop(document_id, None)
+
+    def on_chunks_stored(self, document_id: int, chunks: List[Dict]):
+        tables = self._tables.get(document_id)
+        if tables is None:
+            return
+        for chunk in chunks:
+            if chunk['chunk_type'] == 'table':
+                tables[chunk['chunk_index']] = dict(
+                    {key: chunk.get(key) for key in TABLE_COLUMNS}, document_id=document_id
+                )
+            else:
+                tables.pop(chunk['chunk_index'], None)
+        self._pages.pop(document_id, None)
+
+    def on_chunks_deleted(self, document_id: int, from_index: int = 0):
+        if from_index == 0:
+            self.reset(document_id, [])
+            return
+        tables = self._tables.get(document_id)
+        if tables is not None:
+            for chunk_index in [i for i in tables if i >= from_index]:
+                del tables[chunk_index]
+            self._pages.pop(document_id, None)
+
+    async def nearest_table(
+        self,
+        document_id: int,
+        page_number: int,
+        chunk_index: int,
+        window_size: Optional[int] = None
+    ) -> Optional[Dict]:
+        """Closest table chunk on the same page within window_size chunks, or None"""
+        window_size = self.window_size if window_size is None else window_size
+        pages = await self._get_pages(document_id)
+        positions = pages.get(page_number)
+        if not positions:
+            return None
+
+        i = bisect.bisect_left(positions, chunk_index)
+        candidates = [p for p in positions[max(0, i - 1):i + 1] if abs(p - chunk_index) <= window_size]
+        if not candidates:
+            return None
+        # Ties go to the table before the chunk
+        nearest = min(candidates, key=lambda p: (abs(p - chunk_index), p))
+        return self._tables[document_id][nearest]
+
+    def _is_stale(self, document_id: int) -> bool:
+        checked_at = self._checked_at.get(document_id)
+        return checked_at is None or time.monotonic() - checked_at >= self.refresh_seconds
+
+    async def _get_pages(self, document_id: int) -> Dict[int, List[int]]:
+        if self._is_stale(document_id):
+            lock = self._load_locks.setdefault(document_id, asyncio.Lock())
+            async with lock:
+                if self._is_stale(document_id):
+                    await self._refresh(document_id)
+        self._evict(keep=document_id)
+
+        pages = self._pages.get(document_id)
+        if pages is None:
+            pages = {}
+            for chunk_index, table in sorted(self._tables[document_id].items()):
+                pages.setdefault(table['page_number'], []).append(chunk_index)
+            self._pages[document_id] = pages
+        return pages
+
+    async def _refresh(self, document_id: int):
+        """Reload a document's tables unless its fingerprint still matches the entry"""
+        # Read the fingerprint first: tables read after it are never older than it
+        document = await self.supabase.get_document_metadata(document_id) or {}
+        fingerprint = document.get('content_fingerprint')
+        if document_id in self._tables and self._fingerprints.get(document_id) == fingerprint:
+            self._checked_at[document_id] = time.monotonic()
+            return
+
+        tables = await self.supabase.get_document_tables(document_id)
+        self._set(document_id, fingerprint, tables)
+        logger.info(f"Loaded {len(tables)} table chunks of document {document_id}")
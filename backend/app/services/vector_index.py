@@ -0,0 +1,250 @@
+import logging
+from typing import Dict, List, Optional
+import numpy as np
+from ..utils.quantization import quantize_int8
+
+logger = logging.getLogger(__name__)
+
+# Columns returned for each match, mirroring the match_documents RPC
+RESULT_FIELDS = (
+    'id', 'document_id', 'document_name', 'chunk_index', 'page_number',
+    'chunk_type', 'text', 'table_data'
+)
+
+
+class ChatVectorIndex:
+    """Brute-force cosine index over one chat's chunk embeddings.
+
+    Embeddings are L2-normalized on insert and held in one contiguous
+    float32 matrix, or a float16 / int8 (with per-vector scale) matrix for
+    lower memory, so a query is a single matrix-vector product on the
+    stored form. The matrix is a buffer whose capacity doubles as it
+    fills, so inserting a batch costs the batch, not the whole index. Row
+    positions of each document are kept for ``document_ids`` filtering.
+    """
+
+    def __init__(self, dimension: int = 768, dtype: str = "float32"):
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.rows: List[Dict] = []
+        self.vectors = np.empty((0, dimension), dtype=self.dtype)
+        self.scales = np.empty(0, dtype=np.float32)  # Per-row dequantization scale (int8 only)
+        self.document_ids = np.empty(0, dtype=np.int64)
+        self._positions: Dict[tuple, int] = {}
+        self._document_rows: Dict[int, List[int]] = {}
+        self._document_arrays: Dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    # vectors / scales / document_ids are views of the filled part of their buffers
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vector_buffer[:len(self.rows)]
+
+    @vectors.setter
+    def vectors(self, value: np.ndarray):
+        self._vector_buffer = value
+
+    @property
+    def scales(self) -> np.ndarray:
+        return self._scale_buffer[:len(self.rows)]
+
+    @scales.setter
+    def scales(self, value: np.ndarray):
+        self._scale_buffer = value
+
+    @property
+    def document_ids(self) -> np.ndarray:
+        return self._document_id_buffer[:len(self.rows)]
+
+    @document_ids.setter
+    def document_ids(self, value: np.ndarray):
+        self._document_id_buffer = value
+
+    def upsert(self, document_id: int, document_name: Optional[str], chunks: List[Dict]) -> np.ndarray:
+        """Insert chunks, replacing any already indexed at the same chunk_index.
+
+        Returns the row positions that were written.
+        """
+        chunks = [chunk for chunk in chunks if chunk.get('embedding') is not None]
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+
+        vectors, scales = self._encode(
+            self._normalize(np.asarray([chunk['embedding'] for chunk in chunks], dtype=np.float32))
+        )
+        appended_rows, appended, written = [], [], []
+        for i, chunk in enumerate(chunks):
+            row = {field: chunk.get(field) for field in RESULT_FIELDS}
+            row['document_id'] = document_id
+            row['document_name'] = chunk.get('document_name') or document_name
+            key = (document_id, chunk.get('chunk_index'))
+            position = self._positions.get(key)
+            if position is not None:
+                self.rows[position] = row
+                self.vectors[position] = vectors[i]
+                self.scales[position] = scales[i]
+            else:
+                position = len(self.rows) + len(appended_rows)
+                self._positions[key] = position
+                appended_rows.append(row)
+                appended.append(i)
+            written.append(position)
+
+        if appended_rows:
+            start, end = len(self.rows), len(self.rows) + len(appended_rows)
+            self._reserve(end)
+            self._vector_buffer[start:end] = vectors[appended]
+            self._scale_buffer[start:end] = scales[appended]
+            self._document_id_buffer[start:end] = document_id
+            self.rows.extend(appended_rows)
+            self._document_rows.setdefault(document_id, []).extend(range(start, end))
+            self._document_arrays.pop(document_id, None)
+        return np.asarray(written, dtype=np.int64)
+
+    def remove(self, document_id: int, from_index: int = 0) -> Optional[np.ndarray]:
+        """Drop a document's chunks with chunk_index >= from_index.
+
+        Returns the mask of rows kept, or None when nothing was removed.
+        """
+        keep = np.array([
+            not (row['document_id'] == document_id and (row['chunk_index'] or 0) >= from_index)
+            for row in self.rows
+        ], dtype=bool)
+        if keep.all():
+            return None
+        self.vectors = self.vectors[keep]
+        self.scales = self.scales[keep]
+        self.document_ids = self.document_ids[keep]
+        self.rows = [row for row, kept in zip(self.rows, keep) if kept]
+        self._positions = {
+            (row['document_id'], row['chunk_index']): position
+            for position, row in enumerate(self.rows)
+        }
+        self._rebuild_document_rows()
+        return keep
+
+    def search(
+        self,
+        embedding: List[float],
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[Dict]:
+        """Rows with cosine similarity above threshold, best first, at most limit"""
+        if not self.rows or limit <= 0:
+            return []
+
+        query = self._normalize(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        candidates = self._candidates(query, document_ids)
+        return self._top(self._similarities(query, candidates), candidates, threshold, limit)
+
+    def search_many(
+        self,
+        embeddings: List[List[float]],
+        document_ids: Optional[List[int]] = None,
+        threshold: float = 0.3,
+        limit: int = 10
+    ) -> List[List[Dict]]:
+        """``search`` for several queries at once, scored with one matrix-matrix product"""
+        if not self.rows or limit <= 0:
+            return [[] for _ in embeddings]
+
+        queries = self._normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1))
+        candidates = self._candidates(None, document_ids)
+        similarities = self._similarities(queries, candidates)
+        return [self._top(column, candidates, threshold, limit) for column in similarities.T]
+
+    def _top(
+        self,
+        similarities: np.ndarray,
+        candidates: Optional[np.ndarray],
+        threshold: float,
+        limit: int
+    ) -> List[Dict]:
+        """Rows for the best scores above threshold, best first"""
+        matches = np.flatnonzero(similarities > threshold)
+        if len(matches) > limit:
+            matches = matches[np.argpartition(-similarities[matches], limit - 1)[:limit]]
+        matches = matches[np.argsort(-similarities[matches], kind='stable')]
+
+        positions = candidates[matches] if candidates is not None else matches
+        return [
+            dict(self.rows[position], similarity=float(similarities[match]))
+            for position, match in zip(positions, matches)
+        ]
+
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + (self.scales.nbytes if self.dtype == np.int8 else 0)
+
+    def float_vectors(self, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """Stored vectors (or a subset) decoded to float32"""
+        vectors = self.vectors if positions is None else self.vectors[positions]
+        vectors = vectors.astype(np.float32)
+        if self.dtype == np.int8:
+            vectors *= (self.scales if positions is None else self.scales[positions])[:, None]
+        return vectors
+
+    def _encode(self, vectors: np.ndarray):
+        """Convert normalized float32 vectors to the stored dtype, with scales"""
+        if self.dtype == np.int8:
+            return quantize_int8(vectors)
+        return vectors.astype(self.dtype), np.ones(len(vectors), dtype=np.float32)
+
+    def _candidates(self, query: np.ndarray, document_ids: Optional[List[int]]) -> Optional[np.ndarray]:
+        """Row positions to score, or None to score every row"""
+        if not document_ids:
+            return None
+        return np.concatenate([self._document_positions(doc_id) for doc_id in document_ids])
+
+    def _document_positions(self, document_id: int) -> np.ndarray:
+        positions = self._document_arrays.get(document_id)
+        if positions is None:
+            positions = np.asarray(self._document_rows.get(document_id, []), dtype=np.int64)
+            self._document_arrays[document_id] = positions
+        return positions
+
+    def _similarities(self, query: np.ndarray, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cosine scores of the rows for one query, or a (rows, queries) matrix for a stack of them"""
+        vectors = self.vectors if positions is None else self.vectors[positions]
+        if vectors.dtype == np.float32:
+            return vectors @ query.T
+        # BLAS has no float16/int8 kernels; upcast in blocks to bound temporary memory
+        block = 8192
+        similarities = np.concatenate([
+            vectors[i:i + block].astype(np.float32) @ query.T
+            for i in range(0, len(vectors), block)
+        ]) if len(vectors) else np.empty((0,) + query.shape[:-1], dtype=np.float32)
+        if self.dtype == np.int8:
+            scales = self.scales if positions is None else self.scales[positions]
+            similarities *= scales if query.ndim == 1 else scales[:, None]
+        return similarities
+
+    def _reserve(self, size: int):
+        """Grow the buffers, at least doubling their capacity, to hold ``size`` rows"""
+        capacity = len(self._vector_buffer)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 64)
+        filled = len(self.rows)
+        vectors = np.empty((capacity, self.dimension), dtype=self.dtype)
+        scales = np.empty(capacity, dtype=np.float32)
+        document_ids = np.empty(capacity, dtype=np.int64)
+        vectors[:filled] = self.vectors
+        scales[:filled] = self.scales
+        document_ids[:filled] = self.document_ids
+        self.vectors, self.scales, self.document_ids = vectors, scales, document_ids
+
+    def _rebuild_document_rows(self):
+        self._document_rows = {}
+        for position, doc_id in enumerate(self.document_ids.tolist()):
+            self._document_rows.setdefault(doc_id, []).append(position)
+        self._document_arrays = {}
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
@@ -0,0 +1,118 @@
+from typing import Dict, List, Optional, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token) without a tokenizer"""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def _split_words(text: str, max_tokens: int) -> List[str]:
+    """Split text longer than max_tokens into word-aligned pieces"""
+    pieces, words, tokens = [], [], 0
+    for word in text.split():
+        cost = estimate_tokens(word) + 1
+        if words and tokens + cost > max_tokens:
+            pieces.append(" ".join(words))
+            words, tokens = [], 0
+        words.append(word)
+        tokens += cost
+    if words:
+        pieces.append(" ".join(words))
+    return pieces
+
+
+def _tail(parts: List[str], max_tokens: int) -> Tuple[str, int]:
+    """Trailing words of the joined parts worth at most max_tokens, and the part they start in"""
+    words, tokens, first = [], 0, len(parts)
+    for i in range(len(parts) - 1, -1, -1):
+        for word in reversed(parts[i].split()):
+            tokens += estimate_tokens(word) + 1
+            if tokens > max_tokens:
+                return " ".join(reversed(words)), first
+            words.append(word)
+            first = i
+    return " ".join(reversed(words)), first
+
+
+def _chunk(text: str, page_number: int, start: int, end: int) -> Dict:
+    return {
+        "text": text,
+        "page_number": page_number,
+        "chunk_type": "text",
+        "table_data": None,
+        "element_start": start,
+        "element_end": end,
+    }
+
+
+def assemble_chunks(elements: List[Dict], max_tokens: int, overlap_tokens: int = 0) -> List[Dict]:
+    """Merge consecutive text elements into chunks of up to max_tokens.
+
+    Elements are _process_response dicts plus ``element_index`` and
+    ``element_type``. Text is merged within a page; a title starts a new
+    chunk and tables stay standalone. When a chunk is closed for size, the
+    next one on the same page starts with its last ``overlap_tokens``.
+    Every chunk records the elements it came from, including one whose
+    tail was carried over, as element_start and element_end. With ``max_tokens`` <= 0 each element is its own chunk.
+    """
+    chunks: List[Dict] = []
+    parts: List[str] = []
+    part_indices: List[int] = []
+    tokens = 0
+    page_number: Optional[int] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+    def flush():
+        nonlocal parts, part_indices, tokens, start
+        if start is not None:
+            chunks.append(_chunk(" ".join(parts), page_number, start, end))
+        parts, part_indices, tokens, start = [], [], 0, None
+
+    for element in elements:
+        index = element["element_index"]
+        if element["chunk_type"] != "text" or max_tokens <= 0:
+            flush()
+            chunk = {key: element[key] for key in ("text", "page_number", "chunk_type", "table_data")}
+            chunks.append(dict(chunk, element_start=index, element_end=index))
+            continue
+
+        text = element["text"]
+        cost = estimate_tokens(text) + 1
+        if cost > max_tokens:
+            flush()
+            for piece in _split_words(text, max_tokens):
+                chunks.append(_chunk(piece, element["page_number"], index, index))
+            continue
+
+        if start is not None and (element["page_number"] != page_number or element.get("element_type") == "title"):
+            flush()
+        elif start is not None and tokens + cost > max_tokens:
+            carry, first = _tail(parts, overlap_tokens) if overlap_tokens > 0 else ("", 0)
+            carried_from = part_indices[first] if carry else None
+            flush()
+            if carry and estimate_tokens(carry) + 1 + cost <= max_tokens:
+                # The chunk starts at the element its carried text came from
+                parts, part_indices, tokens = [carry], [carried_from], estimate_tokens(carry) + 1
+                start = carried_from
+
+        if start is None:
+            start, page_number = index, element["page_number"]
+        parts.append(text)
+        part_indices.append(index)
+        tokens += cost
+        end = index
+
+    flush()
+    return chunks
+
+
+def shift_element_ranges(chunks: List[Dict], offset: int) -> List[Dict]:
+    """Make batch-local element ranges document-wide by adding ``offset``"""
+    if not offset:
+        return chunks
+    return [
+        dict(chunk, element_start=chunk["element_start"] + offset, element_end=chunk["element_end"] + offset)
+        if chunk.get("element_start") is not None else chunk
+        for chunk in chunks
+    ]
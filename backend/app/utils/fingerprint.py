@@ -0,0 +1,41 @@
+import hashlib
+import json
+from typing import Dict
+
+
+def content_fingerprint(file_hash: str, config_version: str) -> str:
+    """Fingerprint of a document's bytes plus the pipeline that produced its chunks"""
+    return hashlib.sha256(f"{file_hash}|{config_version}".encode("utf-8")).hexdigest()
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so formatting-only differences hash the same"""
+    return " ".join(text.split()) if text else ""
+
+
+def _canonical_json(value) -> str:
+    """Serialize JSON strings and objects identically regardless of key order"""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return value
+    return json.dumps(value, sort_keys=True)
+
+
+def chunk_hash(chunk: Dict) -> str:
+    """Hash of the fields that determine a chunk's stored row and embedding"""
+    digest = hashlib.sha256()
+    for part in (
+        chunk.get("chunk_type", ""),
+        str(chunk.get("page_number", "")),
+        normalize_text(chunk.get("text", "")),
+        _canonical_json(chunk.get("table_data")),
+        # Source element range, so rows are rewritten when neighbours shift
+        f"{chunk.get('element_start')}-{chunk.get('element_end')}",
+    ):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
@@ -0,0 +1,189 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds in seconds, from a cache hit to a slow partition request
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic count per label set"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, as Prometheus expects"""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: per-bucket (non-cumulative) counts, with +Inf last, and the sum
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series is not None else 0
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total[0]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+STAGE_SECONDS = Histogram(
+    "pdfchat_stage_duration_seconds", "Time spent in an instrumented stage", ("stage",)
+)
+STAGE_ERRORS = Counter(
+    "pdfchat_stage_errors_total", "Instrumented stages that raised", ("stage",)
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "pdfchat_http_request_duration_seconds", "Time to the response headers per route", ("method", "route", "status")
+)
+METRICS = (STAGE_SECONDS, STAGE_ERRORS, HTTP_REQUEST_SECONDS)
+
+# Stage durations of the current request, set only when a Server-Timing header was asked for
+_request_timings: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("request_timings", default=None)
+
+
+def _record(stage: str, seconds: float, failed: bool):
+    STAGE_SECONDS.observe(seconds, stage)
+    if failed:
+        STAGE_ERRORS.inc(stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        entry = timings.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def timed(stage: str):
+    """Record the duration of the enclosed block under ``stage``; exceptions also count as errors.
+
+    Cancellation and generator exits are not errors, and a block left that
+    way is not timed.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        _record(stage, time.perf_counter() - start, True)
+        raise
+    _record(stage, time.perf_counter() - start, False)
+
+
+def record_duration(stage: str, seconds: float, failed: bool = False):
+    """Record a duration measured outside a ``timed`` block, e.g. on a worker thread"""
+    _record(stage, seconds, failed)
+
+
+def instrumented(stage: str) -> Callable:
+    """Decorator form of ``timed`` for coroutine functions"""
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                _record(stage, time.perf_counter() - start, True)
+                raise
+            _record(stage, time.perf_counter() - start, False)
+            return result
+        return wrapper
+    return decorate
+
+
+def start_request_timings() -> Dict[str, List[float]]:
+    """Collect stage timings for the current request (and tasks it starts) from here on"""
+    timings: Dict[str, List[float]] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings: Dict[str, List[float]], total_seconds: float) -> str:
+    """Server-Timing value: summed milliseconds per stage, with the call count when above one"""
+    entries = []
+    for stage, (seconds, calls) in timings.items():
+        entry = f"{stage};dur={seconds * 1000:.1f}"
+        if calls > 1:
+            entry += f';desc="x{calls}"'
+        entries.append(entry)
+    entries.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def render_metrics(extra: Sequence[Tuple[str, str, Dict[str, float]]] = ()) -> str:
+    """All metrics in the Prometheus text exposition format.
+
+    ``extra`` adds gauges from (name, help, {sample label value: number})
+    snapshots, e.g. cache counters kept by the services themselves.
+    """
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, help_text, samples in extra:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for key, value in sorted(samples.items()):
+            lines.append(f'{name}{{name="{_escape(key)}"}} {float(value)}')
+    return "\n".join(lines) + "\n"
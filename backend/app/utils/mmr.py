@@ -0,0 +1,35 @@
+from typing import List
+import numpy as np
+
+
+def mmr_select(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_: float = 0.7) -> List[int]:
+    """Pick k candidates by maximal marginal relevance.
+
+    Each step takes the candidate maximizing
+    ``lambda_ * relevance - (1 - lambda_) * max cosine to those already picked``.
+    The running max similarity is updated with one matrix-vector product per
+    pick, so the cost is O(k * n * d) without an n x n similarity matrix.
+    Rows of ``vectors`` that are all zero (no embedding) are never penalized.
+    Returns candidate positions in selection order.
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    relevance = np.asarray(relevance, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1.0)
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = vectors @ vectors[selected[0]]
+    scores = np.empty(n, dtype=np.float32)
+    for _ in range(1, k):
+        np.multiply(relevance, lambda_, out=scores)
+        scores -= (1 - lambda_) * max_similarity
+        scores[selected] = -np.inf
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        np.maximum(max_similarity, vectors @ vectors[pick], out=max_similarity)
+    return selected
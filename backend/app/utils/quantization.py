@@ -0,0 +1,48 @@
+import base64
+import struct
+from typing import Tuple
+import numpy as np
+
+# Blob layout: one format byte, then the payload.
+#   float16: float16[dimension]
+#   int8:    float32 scale, int8[dimension]  (value ~= code * scale)
+FORMAT_FLOAT16 = 1
+FORMAT_INT8 = 2
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-vector int8 quantization; returns (codes, scales)"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def encode_embedding(embedding, storage_format: str) -> str:
+    """Encode one embedding as a base64 blob in the given storage format"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    if storage_format == "float16":
+        payload = struct.pack("<B", FORMAT_FLOAT16) + vector.astype("<f2").tobytes()
+    elif storage_format == "int8":
+        codes, scales = quantize_int8(vector)
+        payload = struct.pack("<Bf", FORMAT_INT8, float(scales[0])) + codes[0].tobytes()
+    else:
+        raise ValueError(f"Unsupported embedding storage format: {storage_format}")
+    return base64.b64encode(payload).decode("ascii")
+
+
+def decode_embedding(blob: str) -> np.ndarray:
+    """Decode a blob written by encode_embedding back to float32"""
+    payload = base64.b64decode(blob)
+    storage_format = payload[0]
+    if storage_format == FORMAT_FLOAT16:
+        return np.frombuffer(payload, dtype="<f2", offset=1).astype(np.float32)
+    if storage_format == FORMAT_INT8:
+        (scale,) = struct.unpack_from("<f", payload, 1)
+        return np.frombuffer(payload, dtype=np.int8, offset=5).astype(np.float32) * scale
+    raise ValueError(f"Unknown embedding blob format: {storage_format}")
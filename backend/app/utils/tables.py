@@ -0,0 +1,147 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+# A header cell holding a fiscal year or period label rather than a figure
+YEAR = re.compile(r"^(19|20)\d{2}$")
+CURRENCY = "$€£¥"
+
+
+def _expand_row(row) -> List[str]:
+    """Cell texts of a <tr>, repeated across each cell's colspan"""
+    cells = []
+    for cell in row.find_all(['th', 'td']):
+        try:
+            colspan = max(1, int(cell.get('colspan', 1)))
+        except ValueError:
+            colspan = 1
+        cells.extend([" ".join(cell.get_text(" ", strip=True).split())] * colspan)
+    return cells
+
+
+def _is_header(row, cells: List[str], figures: List[bool]) -> bool:
+    """A leading row is a header if it uses <th>/<thead> or carries no figures besides years"""
+    if row.find_parent('thead') is not None or (row.find('th') and not row.find('td')):
+        return True
+    values = [(cell, figure) for cell, figure in zip(cells[1:], figures) if cell]
+    return bool(values) and not cells[0] and all(YEAR.match(cell) or not figure for cell, figure in values)
+
+
+def _header_count(rows: List[Tuple[Any, List[str]]], limit: int = 3) -> int:
+    """Number of leading rows (at most ``limit``) that are headers; their cells are parsed in one pass"""
+    leading = rows[:limit]
+    figures = normalize_numbers(
+        pd.Series([cell for _, cells in leading for cell in cells[1:]], dtype=object)
+    ).notna().tolist()
+    count = offset = 0
+    for row, cells in leading:
+        row_figures = figures[offset:offset + len(cells) - 1]
+        offset += len(cells) - 1
+        if not _is_header(row, cells, row_figures):
+            break
+        count += 1
+    return count
+
+
+def normalize_numbers(cells: pd.Series) -> pd.Series:
+    """Parse figures like 1,234  (56.7)  -12%  $3.50 into floats; anything else becomes NaN"""
+    text = cells.fillna("").astype(str).str.strip().str.replace("−", "-", regex=False)
+    negative = (
+        text.str.match(rf"^[{CURRENCY}]?\s*\(.*\)\s*%?$")
+        | text.str.match(rf"^-\s*[{CURRENCY}]?\s*\d")
+    )
+    cleaned = text.str.replace(rf"[(){CURRENCY},%\s]", "", regex=True).str.lstrip("-")
+    cleaned = cleaned.where(cleaned.str.match(r"^\d*\.?\d+$"), None)
+    numbers = pd.to_numeric(cleaned, errors="coerce").astype(float)
+    return numbers.where(~negative, -numbers)
+
+
+def parse_table_html(html: str) -> Optional[Dict]:
+    """Parse a table's HTML into columns and labelled rows with numeric values.
+
+    Header rows are expanded across colspans and stacked into one name per
+    column. Each body row keeps its raw cells alongside parsed ``values``
+    (None where a cell is not a figure). Returns None if there is no table
+    or it has no body rows.
+    """
+    table = BeautifulSoup(html or "", 'html.parser').find('table')
+    if table is None:
+        return None
+
+    rows = [(row, cells) for row in table.find_all('tr') if any(cells := _expand_row(row))]
+    headers = _header_count(rows)
+    header_rows = [cells for _, cells in rows[:headers]]
+    body = [cells for _, cells in rows[headers:]]
+    if not body:
+        return None
+
+    width = max((len(cells) for cells in header_rows + body), default=0)
+    header_rows = [cells + [""] * (width - len(cells)) for cells in header_rows]
+    body = [cells + [""] * (width - len(cells)) for cells in body]
+
+    columns = []
+    for column in range(width):
+        parts = []
+        for cells in header_rows:
+            if cells[column] and cells[column] not in parts:
+                parts.append(cells[column])
+        columns.append(" ".join(parts))
+
+    values = normalize_numbers(pd.Series([cell for cells in body for cell in cells[1:]], dtype=object))
+    values = values.astype(object).where(values.notna(), None).to_numpy().reshape(len(body), max(width - 1, 0))
+
+    return {
+        "columns": columns,
+        "header_rows": header_rows,
+        "rows": [
+            {"label": cells[0], "cells": cells[1:], "values": list(row_values)}
+            for cells, row_values in zip(body, values)
+        ],
+    }
+
+
+def statement_type(text: str) -> str:
+    """Guess the kind of financial statement from its labels and context"""
+    text = text.lower()
+    if "total assets" in text or "liabilities" in text or "balance sheet" in text:
+        return "Balance Sheet"
+    if "cash flow" in text or "operating activities" in text:
+        return "Cash Flow Statement"
+    if any(term in text for term in ("net income", "revenue", "net sales", "operating income", "earnings per share")):
+        return "Income Statement"
+    return "Table"
+
+
+def structured_statement(structured: Dict, context: str = "") -> Dict:
+    """Shape a parsed table as statement type, periods, line items and subtotals.
+
+    Rows with a label and no cells are section headings and become the
+    ``parent`` of the rows below them; rows labelled "Total ..." are
+    reported as subtotals.
+    """
+    periods = structured["columns"][1:]
+    line_items, subtotals = [], []
+    parent = None
+    for row in structured["rows"]:
+        if row["label"] and not any(row["cells"]):
+            parent = row["label"]
+            continue
+        item = {
+            "name": row["label"],
+            "values": {
+                period or f"column {i + 1}": value if value is not None else (cell or None)
+                for i, (period, cell, value) in enumerate(zip(periods, row["cells"], row["values"]))
+            },
+            "parent": parent,
+        }
+        (subtotals if row["label"].lower().startswith("total") else line_items).append(item)
+
+    labels = " ".join(row["label"] for row in structured["rows"])
+    return {
+        "statement_type": statement_type(f"{context} {labels}"),
+        "periods": periods,
+        "line_items": line_items,
+        "subtotals": subtotals,
+    }
@@ -0,0 +1,46 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+from .metrics import timed
+
+
+class StageTimings:
+    """Busy time and wall-clock span of named pipeline stages.
+
+    Busy time sums every measured interval of a stage (across concurrent
+    workers); the span runs from its first start to its last finish, so
+    overlapping stages show spans that add up to more than the total.
+    Each interval is also recorded in the ``ingest.<stage>`` latency metric.
+    """
+
+    def __init__(self, on_start: Optional[Callable[[str], None]] = None):
+        self.on_start = on_start
+        self.started = time.perf_counter()
+        self._busy: Dict[str, float] = {}
+        self._first: Dict[str, float] = {}
+        self._last: Dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        if stage not in self._first:
+            self._first[stage] = start
+            if self.on_start:
+                self.on_start(stage)
+        try:
+            with timed(f"ingest.{stage}"):
+                yield
+        finally:
+            end = time.perf_counter()
+            self._busy[stage] = self._busy.get(stage, 0.0) + end - start
+            self._last[stage] = end
+
+    def report(self) -> Dict:
+        stages = {
+            stage: {
+                'busy_seconds': round(self._busy[stage], 3),
+                'span_seconds': round(self._last[stage] - self._first[stage], 3),
+            }
+            for stage in self._first if stage in self._last
+        }
+        return {'stages': stages, 'total_seconds': round(time.perf_counter() - self.started, 3)}
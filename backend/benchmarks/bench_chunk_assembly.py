@@ -0,0 +1,128 @@
+"""Chunk counts and retrieval quality of token-budgeted chunk assembly.
+
+Runs DocumentExtractor._process_response over a recorded Unstructured
+element list (fixtures/annual_report_elements.json) at several
+CHUNK_MAX_TOKENS budgets and reports what ingestion would store: rows
+(one embedding call each), embedded characters, and mean tokens per
+chunk. Retrieval quality is approximated lexically: TF-IDF cosine over
+the chunks answers a set of questions whose answers are known
+substrings, and recall@k counts questions whose answer appears in a top
+k chunk. A budget of 0 is the old one-chunk-per-element behaviour:
+
+    python -m benchmarks.bench_chunk_assembly --budgets 0 200 400 800 --overlap 50 --k 3
+"""
+import argparse
+import json
+import math
+import os
+import re
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.services.document_extractor import DocumentExtractor
+from app.utils.chunking import estimate_tokens
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "annual_report_elements.json")
+
+# (question, substring of the passage that answers it)
+QUESTIONS = [
+    ("How many people does the company employ?", "approximately 9,800 people"),
+    ("What was voluntary turnover last year?", "Voluntary turnover was 7.4%"),
+    ("How concentrated is the customer base among the largest customers?", "ten largest customers represented 31%"),
+    ("What happens if the magnet supplier in Ningbo is disrupted?", "delay shipments for up to twelve weeks"),
+    ("How much did net sales grow and why?", "Net sales increased 12% to $4.2 billion"),
+    ("What was gross margin in fiscal 2023?", "Gross margin expanded 160 basis points to 41.3%"),
+    ("How much was spent on research and development?", "$265 million"),
+    ("What was the Sensing Solutions segment margin?", "Sensing Solutions segment margin declined to 16.2%"),
+    ("How much cash did operating activities provide?", "Cash provided by operating activities was $815 million"),
+    ("What is the dividend per share and how many shares were repurchased?", "paid dividends of $1.48 per share"),
+    ("When does the revolving credit facility mature?", "matures in March 2028"),
+    ("How much headroom does the Sensing Solutions goodwill test have?", "exceeded its carrying value by approximately 14%"),
+    ("What is the sensitivity of sales to a stronger US dollar?", "approximately $190 million"),
+    ("What are the emissions reduction targets?", "50% reduction in Scope 1 and 2 emissions by 2030"),
+    ("What share of electricity comes from renewable sources?", "Renewable electricity supplied 46%"),
+    ("What remediation accruals does the company carry?", "remediation accruals of $12 million"),
+]
+
+TOKEN = re.compile(r"[a-z0-9$%.,]+")
+
+
+def tokenize(text: str):
+    return [token.strip(".,") for token in TOKEN.findall(text.lower()) if token.strip(".,")]
+
+
+def tfidf_matrix(texts):
+    documents = [Counter(tokenize(text)) for text in texts]
+    vocabulary = {term: i for i, term in enumerate(sorted(set().union(*documents)))}
+    frequency = Counter(term for document in documents for term in document)
+    idf = np.zeros(len(vocabulary), dtype=np.float32)
+    for term, i in vocabulary.items():
+        idf[i] = math.log((1 + len(texts)) / (1 + frequency[term])) + 1
+    matrix = np.zeros((len(texts), len(vocabulary)), dtype=np.float32)
+    for row, document in enumerate(documents):
+        for term, count in document.items():
+            matrix[row, vocabulary[term]] = (1 + math.log(count)) * idf[vocabulary[term]]
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix, vocabulary, idf
+
+
+def recall_at_k(chunks, k):
+    texts = [chunk["text"] for chunk in chunks]
+    matrix, vocabulary, idf = tfidf_matrix(texts)
+    hits = 0
+    for question, answer in QUESTIONS:
+        query = np.zeros(len(vocabulary), dtype=np.float32)
+        for term, count in Counter(tokenize(question)).items():
+            if term in vocabulary:
+                query[vocabulary[term]] = (1 + math.log(count)) * idf[vocabulary[term]]
+        top = np.argsort(-(matrix @ query), kind="stable")[:k]
+        hits += any(answer in texts[i] for i in top)
+    return hits / len(QUESTIONS)
+
+
+def make_extractor(max_tokens: int, overlap: int) -> DocumentExtractor:
+    return DocumentExtractor(SimpleNamespace(
+        UNSTRUCTURED_API_KEY="unused",
+        UNSTRUCTURED_API_URL="http://localhost",
+        DOWNLOAD_TEMP_DIR=None,
+        DOWNLOAD_SPOOL_MAX_BYTES=0,
+        PIPELINE_PAGES_PER_BATCH=10,
+        EXTRACTION_FANOUT=1,
+        EXTRACTION_ROUTING=False,
+        EXTRACTION_MIN_TEXT_CHARS=0,
+        EXTRACTION_TABLE_MIN_ROWS=0,
+        EXTRACTION_BACKEND="api",
+        CHUNK_MAX_TOKENS=max_tokens,
+        CHUNK_OVERLAP_TOKENS=overlap,
+    ))
+
+
+def main(budgets, overlap: int, k: int):
+    with open(FIXTURE) as f:
+        response_elements = json.load(f)
+    missing = [answer for _, answer in QUESTIONS
+               if not any(answer in element.get("text", "") for element in response_elements)]
+    assert not missing, f"answers missing from fixture: {missing}"
+
+    print(f"{len(response_elements)} response elements, {len(QUESTIONS)} questions")
+    for budget in budgets:
+        result = make_extractor(budget, overlap if budget else 0)._process_response(
+            response_elements, "acme-annual-report-2023.pdf"
+        )
+        chunks = result["elements"]
+        characters = sum(len(chunk["text"]) for chunk in chunks)
+        mean_tokens = sum(estimate_tokens(chunk["text"]) for chunk in chunks) / len(chunks)
+        print(f"max_tokens={budget:<5} elements={result['metadata']['element_count']:<4} "
+              f"chunks={len(chunks):<4} embedded_chars={characters:<6} "
+              f"tokens/chunk={mean_tokens:6.1f}  recall@{k}={recall_at_k(chunks, k):.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budgets", type=int, nargs="+", default=[0, 200, 400, 800])
+    parser.add_argument("--overlap", type=int, default=50)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+    main(args.budgets, args.overlap, args.k)
@@ -0,0 +1,90 @@
+"""Latency of MMR re-ranking over an over-fetched candidate set.
+
+Times app.utils.mmr.mmr_select (one matrix-vector product per pick)
+against two references on 768-d candidates: a variant that first builds
+the full n x n similarity matrix, and a per-candidate Python loop. It
+also reports how many of the top k come from one cluster of near-duplicate
+fragments with and without MMR:
+
+    python -m benchmarks.bench_mmr --candidates 20 100 200 400 --k 5 10 --lambda 0.7
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from app.utils.mmr import mmr_select
+from benchmarks.eval_ann_recall import DIMENSION
+
+
+def mmr_full_matrix(relevance, vectors, k, lambda_):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    similarities = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    for _ in range(1, min(k, len(relevance))):
+        scores = lambda_ * relevance - (1 - lambda_) * similarities[:, selected].max(axis=1)
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return selected
+
+
+def mmr_python(relevance, vectors, k, lambda_):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(k, len(relevance)):
+        best, best_score = None, -np.inf
+        for i in range(len(relevance)):
+            if i in selected:
+                continue
+            redundancy = max(float(vectors[i] @ vectors[j]) for j in selected)
+            score = lambda_ * relevance[i] - (1 - lambda_) * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+    return selected
+
+
+def candidates(n: int, rng: np.random.Generator):
+    """A quarter of the candidates are near-duplicates of the best match, ranked first"""
+    duplicates = n // 4
+    base = rng.normal(size=DIMENSION).astype(np.float32)
+    vectors = np.concatenate([
+        base + 0.05 * rng.normal(size=(duplicates, DIMENSION)),
+        rng.normal(size=(n - duplicates, DIMENSION)),
+    ]).astype(np.float32)
+    relevance = np.linspace(1.0, 0.5, n).astype(np.float32)
+    return relevance, vectors, duplicates
+
+
+def median_us(func, *args, repeat: int = 200):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e6
+
+
+def main(sizes, ks, lambda_: float):
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        relevance, vectors, duplicates = candidates(n, rng)
+        for k in ks:
+            assert mmr_select(relevance, vectors, k, lambda_) == mmr_full_matrix(relevance, vectors, k, lambda_)
+            crowded = sum(i < duplicates for i in range(min(k, n)))
+            diverse = sum(i < duplicates for i in mmr_select(relevance, vectors, k, lambda_))
+            line = (f"n={n:<4} k={k:<3} mmr_select={median_us(mmr_select, relevance, vectors, k, lambda_):8.1f} us  "
+                    f"full_matrix={median_us(mmr_full_matrix, relevance, vectors, k, lambda_):8.1f} us")
+            if n <= 200:
+                line += f"  python_loop={median_us(mmr_python, relevance, vectors, k, lambda_, repeat=5):9.1f} us"
+            print(f"{line}  duplicates in top k: {crowded} -> {diverse}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--candidates", type=int, nargs="+", default=[20, 100, 200, 400])
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--lambda", dest="lambda_", type=float, default=0.7)
+    args = parser.parse_args()
+    main(args.candidates, args.k, args.lambda_)
@@ -0,0 +1,85 @@
+"""Memory, wire size, recall and latency of quantized chunk embeddings.
+
+Compares float32 / float16 / int8 ChatVectorIndex storage on synthetic
+clustered 768-d embeddings. Wire size is the per-chunk payload of the
+JSON float list (what store_chunks and PostgREST send today) against the
+base64 embedding_q blob. Recall@k is measured against exact float32
+search, both on the quantized scores alone and after exact re-ranking of
+the top k * factor candidates (QUANTIZED_RERANK_FACTOR):
+
+    python -m benchmarks.bench_quantization --chunks 100000 --k 10 --rerank-factor 4
+"""
+import argparse
+import json
+import statistics
+import time
+
+import numpy as np
+
+from app.services.vector_index import ChatVectorIndex
+from app.utils.quantization import encode_embedding
+from benchmarks.eval_ann_recall import DIMENSION, as_chunks, clustered_vectors
+
+
+def timed_search(index, queries, k):
+    results, timings = [], []
+    for query in queries:
+        start = time.perf_counter()
+        matches = index.search(query, threshold=-1.0, limit=k)
+        timings.append(time.perf_counter() - start)
+        results.append([match["chunk_index"] for match in matches])
+    return results, statistics.median(timings) * 1000
+
+
+def rerank(vectors: np.ndarray, query, candidates, k):
+    """Exact re-score of candidate rows, as LocalVectorIndex does with fetched embeddings"""
+    query = np.asarray(query, dtype=np.float32)
+    query /= np.linalg.norm(query)
+    rows = vectors[candidates]
+    scores = (rows @ query) / np.linalg.norm(rows, axis=1)
+    return [candidates[i] for i in np.argsort(-scores, kind="stable")[:k]]
+
+
+def recall(found, truth):
+    return statistics.mean(len(set(f) & set(t)) / len(t) for f, t in zip(found, truth))
+
+
+def main(chunks: int, queries: int, k: int, rerank_factor: int):
+    rng = np.random.default_rng(0)
+    vectors, centers = clustered_vectors(chunks, clusters=max(8, chunks // 2000), rng=rng)
+    probes, _ = clustered_vectors(queries, clusters=0, rng=rng, centers=centers)
+    probes = probes.tolist()
+    documents = as_chunks(vectors)
+
+    sample = vectors[0].tolist()
+    print(f"wire bytes/chunk: json={len(json.dumps(sample))}  "
+          f"float16 blob={len(encode_embedding(sample, 'float16'))}  "
+          f"int8 blob={len(encode_embedding(sample, 'int8'))}")
+
+    truth = None
+    for dtype in ("float32", "float16", "int8"):
+        index = ChatVectorIndex(dimension=DIMENSION, dtype=dtype)
+        index.upsert(1, "report.pdf", documents)
+        found, ms = timed_search(index, probes, k)
+        if truth is None:
+            truth = found
+        line = (f"{dtype:<8} memory={index.nbytes() / 1024 / 1024:8.1f} MB  "
+                f"recall@{k}={recall(found, truth):.3f}  p50={ms:8.3f} ms")
+
+        if dtype != "float32" and rerank_factor:
+            candidates, ms = timed_search(index, probes, k * rerank_factor)
+            start = time.perf_counter()
+            reranked = [rerank(vectors, q, c, k) for q, c in zip(probes, candidates)]
+            rerank_ms = (time.perf_counter() - start) / len(probes) * 1000
+            line += f"  reranked recall@{k}={recall(reranked, truth):.3f}  p50={ms + rerank_ms:8.3f} ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    args = parser.parse_args()
+    main(args.chunks, args.queries, args.k, args.rerank_factor)
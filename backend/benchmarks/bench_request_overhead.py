@@ -0,0 +1,99 @@
+"""Measure per-request service overhead before and after app-scoped singletons.
+
+"before" rebuilds ServiceIntegrator (Supabase client, genai.configure,
+GenerativeModel, UnstructuredClient) and opens a throwaway httpx client for
+the file download on every request. "after" reuses one ServiceIntegrator
+and its pooled keep-alive connections.
+
+Run from the backend directory (the usual .env settings must be present,
+no network calls are made):
+
+    python -m benchmarks.bench_request_overhead --requests 50
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from app.config import settings
+from app.services.service_integrator import ServiceIntegrator
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+PAYLOAD = b"%PDF-1.4\n" + b"0" * 64 * 1024
+
+
+class PDFHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Allow keep-alive
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PDFHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def per_request(url: str, n: int) -> list:
+    timings = []
+    for _ in range(n):
+        start = time.perf_counter()
+        service = ServiceIntegrator(settings)
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url)
+            response.raise_for_status()
+        await service.aclose()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def app_scoped(url: str, n: int) -> list:
+    service = ServiceIntegrator(settings)
+    timings = []
+    try:
+        for _ in range(n):
+            start = time.perf_counter()
+            response = await service.http_client.get(url)
+            response.raise_for_status()
+            timings.append(time.perf_counter() - start)
+    finally:
+        await service.aclose()
+    return timings
+
+
+def report(label: str, timings: list):
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p95 = timings[int(len(timings) * 0.95) - 1] * 1000
+    print(f"{label:<12} p50={p50:8.2f} ms  p95={p95:8.2f} ms  n={len(timings)}")
+
+
+async def main(n: int):
+    server = start_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/file.pdf"
+    try:
+        report("before", await per_request(url, n))
+        report("after", await app_scoped(url, n))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
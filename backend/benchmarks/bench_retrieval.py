@@ -0,0 +1,120 @@
+"""Compare retrieval latency of the local NumPy index against the RPC path.
+
+The RPC side sends find_similar_chunks through SupabaseService to a local
+PostgREST stand-in that answers match_documents with an exact NumPy scan,
+so the difference is round trip and JSON serialization cost rather than
+database time. No network or credentials are needed:
+
+    python -m benchmarks.bench_retrieval --sizes 1000 5000 20000 --queries 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.services.supabase_service import SupabaseService
+from app.services.vector_index import ChatVectorIndex
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+DIMENSION = 768
+
+
+class Corpus:
+    vectors = np.empty((0, DIMENSION), dtype=np.float32)
+    rows: list = []
+
+
+class MatchDocumentsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        params = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        query = np.asarray(params["query_embedding"], dtype=np.float32)
+        query /= np.linalg.norm(query)
+        similarities = Corpus.vectors @ query
+        matches = np.flatnonzero(similarities > params["similarity_threshold"])
+        matches = matches[np.argsort(-similarities[matches])][:params["match_count"]]
+        body = json.dumps([
+            dict(Corpus.rows[i], similarity=float(similarities[i])) for i in matches
+        ]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_chunks(n: int, rng: np.random.Generator):
+    vectors = rng.normal(size=(n, DIMENSION)).astype(np.float32)
+    chunks = [
+        {"chunk_index": i, "chunk_type": "text", "page_number": i // 20 + 1,
+         "text": f"Line item {i} " * 20, "table_data": None, "embedding": vectors[i]}
+        for i in range(n)
+    ]
+    return vectors, chunks
+
+
+def summarize(timings: list) -> str:
+    timings = sorted(timings)
+    return f"p50={statistics.median(timings) * 1000:8.3f} ms  max={timings[-1] * 1000:8.3f} ms"
+
+
+async def main(sizes: list, queries: int, dtype: str):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MatchDocumentsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    supabase = SupabaseService(SimpleNamespace(
+        SUPABASE_URL=f"http://127.0.0.1:{server.server_address[1]}",
+        SUPABASE_SERVICE_KEY="benchmark",
+        SUPABASE_MAX_WORKERS=4,
+        SUPABASE_TIMEOUT=60.0,
+    ))
+    rng = np.random.default_rng(0)
+
+    try:
+        for n in sizes:
+            vectors, chunks = make_chunks(n, rng)
+            Corpus.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+            Corpus.rows = [
+                {k: v for k, v in dict(chunk, document_id=1, document_name="report.pdf").items()
+                 if k != "embedding"}
+                for chunk in chunks
+            ]
+            index = ChatVectorIndex(dimension=DIMENSION, dtype=dtype)
+            index.upsert(1, "report.pdf", chunks)
+
+            probes = rng.normal(size=(queries, DIMENSION)).astype(np.float32).tolist()
+            local, rpc = [], []
+            for probe in probes:
+                start = time.perf_counter()
+                index.search(probe, threshold=0.0, limit=5)
+                local.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                await supabase.find_similar_chunks(probe, chat_id="chat", threshold=0.0, limit=5)
+                rpc.append(time.perf_counter() - start)
+
+            print(f"{n:>7} chunks  local[{dtype}] {summarize(local)}   rpc {summarize(rpc)}   "
+                  f"index={index.nbytes() / 1024 / 1024:.1f} MB")
+    finally:
+        supabase.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.queries, args.dtype))
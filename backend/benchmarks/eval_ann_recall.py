@@ -0,0 +1,80 @@
+"""Recall@k and latency of the IVF index against exact search.
+
+Builds a synthetic chat of clustered 768-d embeddings (real chunk
+embeddings cluster by topic), then sweeps nprobe to show the recall /
+latency trade-off controlled by IVF_NPROBE:
+
+    python -m benchmarks.eval_ann_recall --chunks 200000 --k 10 --nprobe 4 8 16 32 64
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from app.services.ann_index import IVFChatIndex
+from app.services.vector_index import ChatVectorIndex
+
+DIMENSION = 768
+
+
+def clustered_vectors(n: int, clusters: int, rng: np.random.Generator, centers=None):
+    if centers is None:
+        centers = rng.normal(size=(clusters, DIMENSION)).astype(np.float32)
+    labels = rng.integers(0, len(centers), size=n)
+    vectors = centers[labels] + 0.6 * rng.normal(size=(n, DIMENSION)).astype(np.float32)
+    return vectors.astype(np.float32), centers
+
+
+def as_chunks(vectors: np.ndarray):
+    return [
+        {"chunk_index": i, "chunk_type": "text", "page_number": 1, "text": "", "table_data": None,
+         "embedding": vectors[i]}
+        for i in range(len(vectors))
+    ]
+
+
+def timed_search(index, queries, k):
+    results, timings = [], []
+    for query in queries:
+        start = time.perf_counter()
+        matches = index.search(query, threshold=-1.0, limit=k)
+        timings.append(time.perf_counter() - start)
+        results.append({match["chunk_index"] for match in matches})
+    return results, statistics.median(timings) * 1000
+
+
+def main(chunks: int, queries: int, k: int, nprobes: list, nlist: int):
+    rng = np.random.default_rng(0)
+    vectors, centers = clustered_vectors(chunks, clusters=max(8, chunks // 2000), rng=rng)
+    probes, _ = clustered_vectors(queries, clusters=0, rng=rng, centers=centers)
+    probes = probes.tolist()
+    documents = as_chunks(vectors)
+
+    exact = ChatVectorIndex(dimension=DIMENSION)
+    exact.upsert(1, "report.pdf", documents)
+    truth, exact_ms = timed_search(exact, probes, k)
+    print(f"exact         recall@{k}=1.000  p50={exact_ms:8.3f} ms")
+
+    start = time.perf_counter()
+    ivf = IVFChatIndex(dimension=DIMENSION, nlist=nlist, min_train_size=1)
+    ivf.upsert(1, "report.pdf", documents)
+    ivf.train()
+    print(f"ivf build     {time.perf_counter() - start:.1f} s  lists={len(ivf.centroids)}")
+
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        found, ivf_ms = timed_search(ivf, probes, k)
+        recall = statistics.mean(len(f & t) / len(t) for f, t in zip(found, truth) if t)
+        print(f"ivf nprobe={nprobe:<3} recall@{k}={recall:.3f}  p50={ivf_ms:8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--nlist", type=int, default=None)
+    args = parser.parse_args()
+    main(args.chunks, args.queries, args.k, args.nprobe, args.nlist)
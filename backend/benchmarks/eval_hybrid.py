@@ -0,0 +1,123 @@
+"""Hit rate and latency of hybrid (BM25 + vector, RRF) against vector-only retrieval.
+
+Builds a synthetic chat of financial chunks, one per company, line item
+and fiscal year, plus narrative filler. Each chunk's embedding is its
+line item's topic vector plus its company's vector plus noise. This
+models what dense embeddings do to exact tokens: chunks that differ only
+in the year, ticker or note number look almost the same. Each question
+names a ticker, a line item and a year; a hit means the chunk for that
+exact fact is in the top k. Vector search is the exact local
+ChatVectorIndex; hybrid fuses its top candidates with ChatLexicalIndex
+results as ServiceIntegrator does:
+
+    python -m benchmarks.eval_hybrid --companies 40 --years 8 --queries 200 --k 3
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from app.services.lexical_index import ChatLexicalIndex, reciprocal_rank_fusion
+from app.services.vector_index import ChatVectorIndex
+from benchmarks.eval_ann_recall import DIMENSION
+
+LINE_ITEMS = [
+    "net sales", "cost of sales", "gross margin", "research and development", "selling general and administrative",
+    "operating income", "interest expense", "income tax expense", "net income", "diluted earnings per share",
+    "cash and cash equivalents", "accounts receivable", "inventories", "goodwill", "total assets",
+    "accounts payable", "long-term debt", "total liabilities", "shareholders equity", "operating cash flow",
+    "capital expenditures", "free cash flow", "share repurchases", "dividends paid", "backlog",
+]
+FILLER = [
+    "Management believes the company is well positioned for long-term growth across its end markets.",
+    "Demand trends remained mixed as customers managed inventory levels carefully during the period.",
+    "The company continued to invest in digital capabilities and operational excellence programs.",
+    "Risk factors include supply chain disruption, currency movements and changes in regulation.",
+]
+
+
+def ticker(company: int) -> str:
+    return "".join(chr(ord("A") + (company // 26 ** i) % 26) for i in range(3)) + "X"
+
+
+def build_corpus(companies: int, years: int, rng: np.random.Generator):
+    topics = rng.normal(size=(len(LINE_ITEMS), DIMENSION)).astype(np.float32)
+    firms = 0.5 * rng.normal(size=(companies, DIMENSION)).astype(np.float32)
+    chunks, vectors, facts = [], [], {}
+    for company in range(companies):
+        for item, name in enumerate(LINE_ITEMS):
+            for year in range(2024 - years, 2024):
+                value = int(rng.integers(100, 99999))
+                facts[(company, item, year)] = len(chunks)
+                chunks.append(
+                    f"{ticker(company)} reported {name} of ${value:,} million for fiscal {year}; "
+                    f"see Note {item + 1}."
+                )
+                vectors.append(topics[item] + firms[company] + 0.3 * rng.normal(size=DIMENSION))
+            chunks.append(f"{ticker(company)}: {FILLER[item % len(FILLER)]}")
+            vectors.append(firms[company] + 0.8 * rng.normal(size=DIMENSION))
+    rows = [
+        {"chunk_index": i, "chunk_type": "text", "page_number": 1, "text": text, "table_data": None,
+         "embedding": vector}
+        for i, (text, vector) in enumerate(zip(chunks, np.asarray(vectors, dtype=np.float32)))
+    ]
+    return rows, facts, topics, firms
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main(companies: int, years: int, queries: int, k: int, candidates: int, rrf_k: int):
+    rng = np.random.default_rng(0)
+    rows, facts, topics, firms = build_corpus(companies, years, rng)
+
+    vector_index = ChatVectorIndex(dimension=DIMENSION)
+    vector_index.upsert(1, "filings.pdf", rows)
+    lexical_index = ChatLexicalIndex()
+    _, build_ms = timed(lexical_index.upsert, 1, "filings.pdf", rows)
+    postings = sum(len(ids) for ids, _ in lexical_index._postings.values())
+    print(f"{len(rows)} chunks, {len(lexical_index._postings)} terms, {postings} postings "
+          f"({postings * 6 / 1024:.0f} KB packed), BM25 build {build_ms:.0f} ms")
+
+    keys = list(facts)
+    hits = {"vector": 0, "bm25": 0, "hybrid": 0}
+    latency = {"vector": [], "bm25": [], "fusion": []}
+    for i in rng.choice(len(keys), size=queries, replace=False):
+        company, item, year = keys[i]
+        answer = facts[keys[i]]
+        question = f"What was {ticker(company)} {LINE_ITEMS[item]} in fiscal {year}?"
+        embedding = (topics[item] + firms[company] + 0.3 * rng.normal(size=DIMENSION)).tolist()
+
+        vector, ms = timed(vector_index.search, embedding, threshold=-1.0, limit=candidates)
+        latency["vector"].append(ms)
+        lexical, ms = timed(lexical_index.search, question, limit=candidates)
+        latency["bm25"].append(ms)
+        fused, ms = timed(reciprocal_rank_fusion, [vector, lexical], k=rrf_k, limit=k)
+        latency["fusion"].append(ms)
+
+        hits["vector"] += answer in [row["chunk_index"] for row in vector[:k]]
+        hits["bm25"] += answer in [row["chunk_index"] for row in lexical[:k]]
+        hits["hybrid"] += answer in [row["chunk_index"] for row in fused]
+
+    for name, count in hits.items():
+        print(f"{name:<7} hit@{k}={count / queries:.3f}")
+    for name, timings in latency.items():
+        timings.sort()
+        print(f"{name:<7} p50={statistics.median(timings):7.3f} ms  "
+              f"p99={timings[int(0.99 * (len(timings) - 1))]:7.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--companies", type=int, default=40)
+    parser.add_argument("--years", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--rrf-k", type=int, default=60)
+    args = parser.parse_args()
+    main(args.companies, args.years, args.queries, args.k, args.candidates, args.rrf_k)
@@ -1,17 +1,36 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
 from app.config import settings
-from app.api import document, query
+from app.api import document, metrics, query
+from app.services.service_integrator import ServiceIntegrator
+from app.services.job_queue import IngestionJobQueue
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build clients and connection pools once per process instead of per request
+    app.state.service_integrator = ServiceIntegrator(settings)
+    app.state.job_queue = IngestionJobQueue(settings, app.state.service_integrator)
+    await app.state.job_queue.start()
+    logger.info("Service integrator and ingestion workers initialized")
+    try:
+        yield
+    finally:
+        await app.state.job_queue.stop()
+        await app.state.service_integrator.aclose()
+        app.state.job_queue = None
+        app.state.service_integrator = None
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
-    openapi_url=f"{settings.API_V1_STR}/openapi.json"
+    openapi_url=f"{settings.API_V1_STR}/openapi.json",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -22,10 +41,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware, server_timing=settings.SERVER_TIMING_ENABLED)
 
 # Include routers
 app.include_router(document.router, prefix=settings.API_V1_STR)
 app.include_router(query.router, prefix=settings.API_V1_STR)
+app.include_router(metrics.router)
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -1,7 +1,8 @@
 import pytest
 from fastapi.testclient import TestClient
 from backend.main import app
-from unittest.mock import AsyncMock, patch
+from app.api.deps import get_service_integrator, get_job_queue
+from unittest.mock import AsyncMock, MagicMock, patch
 from uuid import uuid4
 from fastapi import HTTPException
 import logging
@@ -12,7 +13,11 @@ logging.basicConfig(level=logging.INFO)
 @pytest.fixture(scope="session")
 def test_client():
     """Provide a TestClient for FastAPI app"""
-    return TestClient(app)
+    # Never build real clients in tests; individual tests install their own mocks
+    app.dependency_overrides[get_service_integrator] = lambda: MagicMock()
+    app.dependency_overrides[get_job_queue] = lambda: MagicMock()
+    yield TestClient(app)
+    app.dependency_overrides.clear()
 
 @pytest.fixture
 def mock_supabase_service():
@@ -54,7 +59,7 @@ def mock_document_extractor():
 @pytest.fixture(autouse=True)
 def mock_settings():
     """Mock settings to prevent actual API calls"""
-    with patch("app.api.document.settings") as mock_settings:
+    with patch("app.api.deps.settings") as mock_settings:
         mock_settings.UNSTRUCTURED_API_KEY = "test-key"
         mock_settings.UNSTRUCTURED_API_URL = "http://test-url"
         mock_settings.SUPABASE_URL = "http://test-supabase-url"
@@ -65,34 +70,62 @@ def mock_settings():
 @pytest.fixture
 def mock_service_integrator():
     """Mock the ServiceIntegrator"""
-    with patch("app.api.query.ServiceIntegrator") as MockIntegrator, \
-         patch("app.api.document.ServiceIntegrator") as MockIntegratorDoc:
-        
-        # Create instance for both routes
-        query_instance = MockIntegrator.return_value
-        doc_instance = MockIntegratorDoc.return_value
-        
-        # Setup document processing mock
-        doc_instance.process_documents = AsyncMock(return_value=[{
-            "status": "success",
-            "filename": "sample.pdf",
-            "document_id": 1,
-            "chunks_processed": 1,
-            "page_count": 1
-        }])
-        
-        # Setup query mock
-        query_instance.query_documents = AsyncMock(return_value={
-            "response": "Mock response",
-            "sources": [
-                {
-                    "document_id": 1,
-                    "document_name": "test.pdf",
-                    "page_number": 1,
-                    "text": "Sample text"
-                }
-            ]
-        })
-        
-        yield query_instance
+    # The same application-scoped instance serves both routes
+    query_instance = MagicMock()
+    doc_instance = query_instance
+    
+    # Setup document processing mock
+    doc_instance.process_documents = AsyncMock(return_value=[{
+        "status": "success",
+        "filename": "sample.pdf",
+        "document_id": 1,
+        "chunks_processed": 1,
+        "page_count": 1
+    }])
+    
+    # Setup query mock
+    query_instance.query_documents = AsyncMock(return_value={
+        "response": "Mock response",
+        "sources": [
+            {
+                "document_id": 1,
+                "document_name": "test.pdf",
+                "page_number": 1,
+                "text": "Sample text"
+            }
+        ]
+    })
+    
+    previous = app.dependency_overrides.get(get_service_integrator)
+    app.dependency_overrides[get_service_integrator] = lambda: query_instance
+    yield query_instance
+    app.dependency_overrides[get_service_integrator] = previous
+
+
+
+@pytest.fixture
+def mock_job_queue():
+    """Mock the IngestionJobQueue"""
+    job_queue = MagicMock()
+    job_queue.enqueue = AsyncMock(return_value="job-1")
+    job_queue.get_job = AsyncMock(return_value={
+        "job_id": "job-1",
+        "chat_id": "chat-1",
+        "created_at": "2024-01-01T00:00:00+00:00",
+        "status": "running",
+        "documents": [
+            {
+                "document_id": 1,
+                "status": "running",
+                "stage": "embedding",
+                "result": None,
+                "error": None,
+                "updated_at": "2024-01-01T00:00:05+00:00"
+            }
+        ]
+    })
 
+    previous = app.dependency_overrides.get(get_job_queue)
+    app.dependency_overrides[get_job_queue] = lambda: job_queue
+    yield job_queue
+    app.dependency_overrides[get_job_queue] = previous
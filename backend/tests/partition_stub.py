@@ -0,0 +1,16 @@
+"""Picklable stand-in for partition_pdf_bytes, kept free of app imports so
+spawned extraction workers start quickly."""
+import io
+import os
+
+from pypdf import PdfReader
+
+
+def fake_local_partition(data, file_name, starting_page_number=1):
+    """One element per page, tagged with the worker's pid"""
+    pages = len(PdfReader(io.BytesIO(data)).pages)
+    return [
+        {"type": "NarrativeText", "text": f"Page {starting_page_number + i} text",
+         "metadata": {"page_number": starting_page_number + i, "pid": os.getpid()}}
+        for i in range(pages)
+    ]
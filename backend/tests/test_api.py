@@ -1,6 +1,12 @@
+import json
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock
 from uuid import uuid4
+from app.config import settings
+from app.api.metrics import MetricsMiddleware
+from app.utils.metrics import HTTP_REQUEST_SECONDS, timed
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -57,9 +63,133 @@ async def test_successful_query_processing(test_client, mock_service_integrator)
     assert data["response"] == "Mock response"
     assert len(data["source_references"]) == 1
 
+@pytest.mark.asyncio
+async def test_streaming_query_sends_sources_then_tokens(test_client, mock_service_integrator):
+    """The stream opens with the source references and then relays generated text"""
+    source = {
+        "document_id": 1, "document_name": "test.pdf", "page_number": 1,
+        "chunk_type": "text", "text": "Sample text", "table_data": None,
+        "similarity": 0.85, "embedding": [0.1] * 768
+    }
+
+    async def events(query, chat_id, document_ids):
+        yield {"event": "sources", "data": [source]}
+        for text in ["Revenue ", "grew 12%"]:
+            yield {"event": "token", "data": text}
+        raise RuntimeError("model quota exceeded")
+
+    mock_service_integrator.query_documents_stream = events
+    payload = {"query": "How did revenue change?", "chat_id": str(uuid4())}
+    with test_client.stream("POST", "/api/v1/query/stream", json=payload) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        body = "".join(response.iter_text())
+
+    messages = [message.split("\n", 1) for message in body.strip().split("\n\n")]
+    assert [event for event, _ in messages] == [
+        "event: sources", "event: token", "event: token", "event: error"
+    ]
+    sources = json.loads(messages[0][1][len("data: "):])
+    assert sources[0]["similarity"] == 0.85 and "embedding" not in sources[0]
+    assert json.loads(messages[2][1][len("data: "):]) == "grew 12%"
+
+@pytest.mark.asyncio
+async def test_streaming_query_retrieval_failure_is_http_error(test_client, mock_service_integrator):
+    async def events(query, chat_id, document_ids):
+        raise RuntimeError("retrieval failed")
+        yield
+
+    mock_service_integrator.query_documents_stream = events
+    response = test_client.post("/api/v1/query/stream", json={"query": "q", "chat_id": str(uuid4())})
+    assert response.status_code == 500
+
+@pytest.mark.asyncio
+async def test_batch_query_returns_results_in_order(test_client, mock_service_integrator):
+    source = {"document_id": 1, "document_name": "test.pdf", "page_number": 1, "chunk_type": "text",
+              "text": "Sample text", "table_data": None, "similarity": 0.85}
+    mock_service_integrator.query_documents_batch = AsyncMock(return_value=[
+        {"query": "revenue 2022", "response": "{}", "source_references": [source], "error": None},
+        {"query": "net income 2022", "response": None, "source_references": [], "error": "No relevant tables"},
+    ])
+
+    chat_id = str(uuid4())
+    response = test_client.post(
+        "/api/v1/query/batch", json={"queries": ["revenue 2022", "net income 2022"], "chat_id": chat_id}
+    )
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["query"] for result in results] == ["revenue 2022", "net income 2022"]
+    assert results[0]["source_references"][0]["similarity"] == 0.85
+    assert results[1]["response"] is None and results[1]["error"] == "No relevant tables"
+    assert mock_service_integrator.query_documents_batch.await_args.kwargs["queries"] == ["revenue 2022", "net income 2022"]
+
+    too_many = {"queries": ["q"] * (settings.QUERY_BATCH_MAX_QUESTIONS + 1), "chat_id": chat_id}
+    assert test_client.post("/api/v1/query/batch", json=too_many).status_code == 400
+    assert test_client.post("/api/v1/query/batch", json={"queries": [], "chat_id": chat_id}).status_code == 422
+
 @pytest.mark.asyncio
 async def test_query_validation(test_client):
     """Test query validation"""
     payload = {"chat_id": str(uuid4())}  # Missing 'query'
     response = test_client.post("/api/v1/query/", json=payload)
-    assert response.status_code == 422
\ No newline at end of file
+    assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_process_documents_enqueues_job(test_client, mock_job_queue):
+    """Processing returns a job id immediately and progress can be polled"""
+    payload = {"chat_id": "chat-1", "documents": [{"id": 1, "file_path": "chat-1/sample.pdf"}]}
+    response = test_client.post("/api/v1/documents/process", json=payload)
+
+    assert response.status_code == 202
+    assert response.json() == {"job_id": "job-1", "status": "queued"}
+    mock_job_queue.enqueue.assert_called_once_with(
+        chat_id="chat-1",
+        documents=[{"id": 1, "file_path": "chat-1/sample.pdf"}]
+    )
+
+    response = test_client.get("/api/v1/documents/jobs/job-1")
+    assert response.status_code == 200
+    assert response.json()["documents"][0]["stage"] == "embedding"
+
+    mock_job_queue.get_job.return_value = None
+    response = test_client.get("/api/v1/documents/jobs/missing")
+    assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_exposes_stage_histograms(test_client, mock_service_integrator):
+    with timed("test.stage"):
+        pass
+    mock_service_integrator.gemini.cache_stats.return_value = {"embeddings": {"hits": 3, "hit_rate": 0.75}, "responses": None}
+    mock_service_integrator.query_coalescer.stats.return_value = {"coalesced": 2}
+    mock_service_integrator.supabase.write_stats.return_value = {"rows": 10}
+
+    response = test_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'pdfchat_stage_duration_seconds_count{stage="test.stage"}' in body
+    assert 'pdfchat_stage_duration_seconds_bucket{stage="test.stage",le="+Inf"}' in body
+    assert 'pdfchat_embedding_cache{name="hits"} 3.0' in body
+    assert 'pdfchat_query_coalescing{name="coalesced"} 2.0' in body
+    assert "pdfchat_response_cache" not in body
+
+def test_server_timing_header_breaks_down_request_stages():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, server_timing=True)
+
+    @app.get("/work/{item}")
+    async def work(item: int):
+        for _ in range(2):
+            with timed("gemini.embed_content"):
+                pass
+        return {"item": item}
+
+    response = TestClient(app).get("/work/1")
+
+    assert response.status_code == 200
+    entries = [entry.strip() for entry in response.headers["server-timing"].split(",")]
+    assert entries[0].startswith("gemini.embed_content;dur=") and entries[0].endswith(';desc="x2"')
+    assert entries[-1].startswith("total;dur=")
+    assert HTTP_REQUEST_SECONDS.count("GET", "/work/{item}", "200") == 1
@@ -0,0 +1,1647 @@
+import asyncio
+import email
+import httpx
+import io
+import json
+import numpy as np
+import os
+import pytest
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fastapi import UploadFile
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from unittest.mock import AsyncMock, MagicMock, patch
+import logging
+
+from app.services.document_extractor import DocumentExtractor
+from app.services.gemini_service import GeminiService
+from app.services.local_extractor import LocalPartitioner
+from tests.partition_stub import fake_local_partition
+from app.services.embedding_cache import EmbeddingCache
+from app.services.response_cache import ResponseCache
+from app.services.request_coalescer import RequestCoalescer
+from app.utils.metrics import STAGE_ERRORS, STAGE_SECONDS, instrumented
+from app.services.supabase_service import SupabaseService
+from app.services.job_queue import IngestionJobQueue
+from app.services.service_integrator import ServiceIntegrator
+from app.services.vector_index import ChatVectorIndex
+from app.services.ann_index import IVFChatIndex
+from app.services.retrieval import LocalVectorIndex
+from app.services.table_index import TableAdjacencyIndex
+from app.services.lexical_index import ChatLexicalIndex, LexicalIndex, tokenize
+from app.utils.chunking import assemble_chunks, estimate_tokens
+from app.utils.mmr import mmr_select
+from app.utils.quantization import decode_embedding, encode_embedding
+
+logging.basicConfig(level=logging.INFO)
+
+
+def make_settings(**overrides):
+    """Build a minimal settings object for constructing services in tests"""
+    values = {
+        "GOOGLE_API_KEY": "test-key",
+        "EMBEDDING_MODEL": "models/text-embedding-004",
+        "EMBEDDING_BATCH_SIZE": 100,
+        "EMBEDDING_MAX_CONCURRENT_BATCHES": 4,
+        "EMBEDDING_CACHE_ENABLED": False,
+        "RESPONSE_CACHE_ENABLED": False,
+        "TABLE_WINDOW_SIZE": 5,
+        "TABLE_INDEX_MAX_DOCUMENTS": 1024,
+        "TABLE_INDEX_REFRESH_SECONDS": 30.0,
+    }
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+
+class FakeEmbedder:
+    """Local stand-in for genai.embed_content that counts calls"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, model, content):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if isinstance(content, str):
+                return {"embedding": [float(content)]}
+            return {"embedding": [[float(text)] for text in content]}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def fake_embedder():
+    embedder = FakeEmbedder(latency=0.01)
+    with patch("app.services.gemini_service.genai.embed_content", embedder):
+        yield embedder
+
+
+@pytest.mark.asyncio
+async def test_generate_embeddings_batches_and_preserves_order(fake_embedder):
+    """Embeddings are requested per batch, bounded in flight and returned in input order"""
+    service = GeminiService(
+        make_settings(EMBEDDING_BATCH_SIZE=10, EMBEDDING_MAX_CONCURRENT_BATCHES=2),
+        MagicMock()
+    )
+    texts = [str(i) for i in range(95)]
+
+    embeddings = await service.generate_embeddings(texts)
+
+    assert fake_embedder.calls == 10
+    assert fake_embedder.max_in_flight <= 2
+    assert embeddings == [[float(i)] for i in range(95)]
+
+
+@pytest.mark.asyncio
+async def test_generate_embeddings_empty_input_makes_no_calls(fake_embedder):
+    """No request is sent when there is nothing to embed"""
+    service = GeminiService(make_settings(), MagicMock())
+
+    assert await service.generate_embeddings([]) == []
+    assert fake_embedder.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_skips_repeated_texts(fake_embedder):
+    """Cached and duplicate texts are not sent to the embedder again"""
+    service = GeminiService(make_settings(EMBEDDING_BATCH_SIZE=10), MagicMock())
+    service.embedding_cache = EmbeddingCache(max_bytes=1024 * 1024)
+
+    first = await service.generate_embeddings(["1", "2", " 2 ", "3"])
+    assert first == [[1.0], [2.0], [2.0], [3.0]]
+    assert fake_embedder.calls == 1
+
+    second = await service.generate_embeddings(["3", "2", "1"])
+    assert second == [[3.0], [2.0], [1.0]]
+    assert fake_embedder.calls == 1
+
+    assert await service.generate_embedding("1") == [1.0]
+    assert fake_embedder.calls == 1
+    assert service.embedding_cache.stats()["hits"] == 4
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_evicts_least_recently_used():
+    """The in-memory tier stays within its byte budget"""
+    cache = EmbeddingCache(max_bytes=2 * 4 * 2)  # two 2-d float32 vectors
+    await cache.put("model", "a", [1.0, 1.0])
+    await cache.put("model", "b", [2.0, 2.0])
+    assert await cache.get("model", "a") == [1.0, 1.0]
+
+    await cache.put("model", "c", [3.0, 3.0])
+
+    assert await cache.get("model", "b") is None
+    assert await cache.get("model", "a") == [1.0, 1.0]
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] <= stats["max_bytes"]
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_is_keyed_by_model():
+    cache = EmbeddingCache()
+    await cache.put("model-a", "text", [1.0])
+    assert await cache.get("model-b", "text") is None
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_persists_to_disk(tmp_path):
+    """A new cache instance is warm when it shares the SQLite file"""
+    db_path = str(tmp_path / "embeddings.db")
+    cache = EmbeddingCache(db_path=db_path)
+    await cache.put("model", "Consolidated Balance Sheet", [0.5, 0.25])
+    await cache.put_many("model", ["Income Statement", "Cash Flows"], [[1.0], [2.0]])
+    cache.close()
+
+    restarted = EmbeddingCache(db_path=db_path)
+    load, threads = restarted._load_many, []
+    restarted._load_many = lambda *args: threads.append(threading.get_ident()) or load(*args)
+    assert await restarted.get("model", "Consolidated  Balance Sheet") == [0.5, 0.25]
+    assert restarted.stats()["disk_hits"] == 1
+    assert threading.get_ident() not in threads  # disk reads stay off the event loop
+
+    assert await restarted.get_many("model", ["Cash Flows", "Notes", "Consolidated Balance Sheet", "Income Statement"]) == [
+        [2.0], None, [0.5, 0.25], [1.0]
+    ]
+    assert len(threads) == 2  # one query for the batch's memory misses
+    assert restarted.stats()["disk_hits"] == 3
+    restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_single_flights_identical_prompts(tmp_path):
+    """Concurrent identical prompts share one model call; repeats are served from cache"""
+    service = GeminiService(make_settings(
+        RESPONSE_CACHE_ENABLED=True, RESPONSE_CACHE_MAX_BYTES=1024 * 1024,
+        RESPONSE_CACHE_TTL_SECONDS=3600, RESPONSE_CACHE_PATH=str(tmp_path / "responses.db")
+    ), MagicMock())
+    calls = []
+
+    def generate_content(prompt):
+        calls.append(prompt)
+        time.sleep(0.05)
+        return SimpleNamespace(text=f"answer to {prompt}")
+
+    service.model = MagicMock(generate_content=generate_content)
+    responses = await asyncio.gather(*[
+        service._generate_response("Balance sheet:  <table>...</table>") for _ in range(5)
+    ])
+    assert responses == ["answer to Balance sheet:  <table>...</table>"] * 5
+    assert await service._generate_response("Balance sheet: <table>...</table>") == responses[0]
+    assert len(calls) == 1
+
+    stats = service.cache_stats()["responses"]
+    assert stats["coalesced"] == 4 and stats["hits"] == 1 and stats["in_flight"] == 0
+
+    # A fresh process with the same SQLite file starts warm
+    restarted = ResponseCache(db_path=str(tmp_path / "responses.db"))
+    assert await restarted.get("gemini-pro", "Balance sheet: <table>...</table>") == responses[0]
+    restarted.close()
+    service.response_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_expires_and_evicts():
+    cache = ResponseCache(max_bytes=10, ttl_seconds=60)
+    await cache.put("model", "a", "12345")
+    await cache.put("model", "b", "67890")
+    await cache.put("model", "c", "abcde")
+    assert await cache.get("model", "a") is None
+    assert await cache.get("model", "c") == "abcde"
+
+    with patch("app.services.bounded_cache.time.time", return_value=time.time() + 120):
+        assert await cache.get("model", "c") is None
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["expirations"] == 1 and stats["bytes"] == 5
+
+
+@pytest.mark.asyncio
+async def test_identical_concurrent_queries_are_coalesced():
+    """Identical queries share one run, stragglers within the grace window reuse it, other queries do not"""
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator.query_coalescer = RequestCoalescer(grace_seconds=60)
+    runs = []
+
+    async def answer(query, chat_id, document_ids):
+        runs.append((query, document_ids))
+        await asyncio.sleep(0.05)
+        return {'response': f"answer to {query}", 'source_references': []}
+
+    integrator._query_documents = answer
+    results = await asyncio.gather(*[
+        integrator.query_documents("revenue 2022", "chat", [2, 1]) for _ in range(5)
+    ], integrator.query_documents("revenue 2022", "chat", [1, 2]), integrator.query_documents("revenue 2023", "chat"))
+    assert [r['response'] for r in results] == ["answer to revenue 2022"] * 6 + ["answer to revenue 2023"]
+    assert results[0] is not results[1]
+
+    await integrator.query_documents("revenue 2022", "chat", [1, 2])
+    assert len(runs) == 2
+    stats = integrator.query_coalescer.stats()
+    assert stats["executions"] == 2 and stats["coalesced"] == 5 and stats["grace_hits"] == 1
+    assert stats["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_coalescer_propagates_errors_and_cancellation():
+    coalescer = RequestCoalescer(grace_seconds=60)
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("model unavailable")
+
+    results = await asyncio.gather(*[coalescer.run("q", failing) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+    with pytest.raises(ValueError):
+        await coalescer.run("q", failing)
+    assert len(attempts) == 2  # Failures are never served from the grace window
+
+    started, finished = asyncio.Event(), []
+
+    async def slow():
+        started.set()
+        await asyncio.sleep(0.05)
+        finished.append(1)
+        return "done"
+
+    # One caller leaving does not cancel the work the other is waiting on
+    first = asyncio.ensure_future(coalescer.run("slow", slow))
+    second = asyncio.ensure_future(coalescer.run("slow", slow))
+    await started.wait()
+    first.cancel()
+    assert await second == "done" and finished == [1]
+
+    # Once every caller has gone, the shared work is cancelled too
+    started.clear()
+    lone = asyncio.ensure_future(coalescer.run("abandoned", slow))
+    await started.wait()
+    lone.cancel()
+    await asyncio.sleep(0.1)
+    assert finished == [1]
+    stats = coalescer.stats()
+    assert stats["errors"] == 2 and stats["cancellations"] == 1 and stats["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_instrumented_stages_count_errors_but_not_cancellation():
+    @instrumented("test.flaky")
+    async def flaky(fail):
+        await asyncio.sleep(0.01 if fail is None else 0)
+        if fail:
+            raise ValueError("boom")
+        return "ok"
+
+    before = STAGE_SECONDS.count("test.flaky")
+    assert await flaky(False) == "ok"
+    with pytest.raises(ValueError):
+        await flaky(True)
+    task = asyncio.ensure_future(flaky(None))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert STAGE_SECONDS.count("test.flaky") == before + 2
+    assert STAGE_ERRORS.value("test.flaky") == 1
+    assert flaky.__name__ == "flaky"
+
+
+class StubPostgrestHandler(BaseHTTPRequestHandler):
+    """Local PostgREST stand-in that answers every request after a fixed delay"""
+    protocol_version = "HTTP/1.1"
+    delay = 0.2
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.delay)
+        body = json.dumps([]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RecordingPostgrestHandler(StubPostgrestHandler):
+    """Stub that echoes inserted rows back and fails the first write"""
+    delay = 0.0
+    requests = []
+    fail_next = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        RecordingPostgrestHandler.requests.append((self.path, self.headers.get("Prefer", ""), body))
+        if RecordingPostgrestHandler.fail_next:
+            RecordingPostgrestHandler.fail_next = False
+            status, payload = 500, {"message": "statement timeout"}
+        else:
+            status, payload = 201, body
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class PagedPostgrestHandler(StubPostgrestHandler):
+    """Stub that serves a large chunks table truncated at PostgREST's max-rows"""
+    delay = 0.0
+    max_rows = 1000
+    total_rows = 2500
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        offset = int(params.get("offset", ["0"])[0])
+        limit = min(int(params.get("limit", [str(self.max_rows)])[0]), self.max_rows)
+        rows = [
+            {'id': i, 'document_id': 7, 'chunk_index': i, 'chunk_type': 'text', 'text': f"chunk {i}",
+             'page_number': 1, 'table_data': None, 'embedding': "[0.5,0.5]"}
+            for i in range(offset, min(offset + limit, self.total_rows))
+        ]
+        data = json.dumps(rows).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_supabase_service(handler, **overrides):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    values = dict(
+        SUPABASE_URL=f"http://127.0.0.1:{server.server_address[1]}",
+        SUPABASE_SERVICE_KEY="test-key",
+        SUPABASE_MAX_WORKERS=16,
+        SUPABASE_TIMEOUT=5.0,
+        EMBEDDING_STORAGE_FORMAT="float",
+        CHUNK_INSERT_BATCH_ROWS=200,
+        CHUNK_INSERT_BATCH_BYTES=2 * 1024 * 1024,
+        CHUNK_INSERT_CONCURRENCY=4,
+        CHUNK_INSERT_MAX_RETRIES=3,
+        CHUNK_INSERT_RETRY_BACKOFF=0.0,
+        CHUNK_READ_PAGE_ROWS=1000,
+    )
+    values.update(overrides)
+    return SupabaseService(SimpleNamespace(**values)), server
+
+
+@pytest.fixture
+def stub_supabase():
+    service, server = make_supabase_service(StubPostgrestHandler)
+    yield service
+    service.close()
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_supabase_calls_do_not_block_event_loop(stub_supabase):
+    """N concurrent queries finish in about the latency of one, not the sum"""
+    n = 8
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        stub_supabase.find_similar_chunks(embedding=[0.1] * 768, chat_id="chat")
+        for _ in range(n)
+    ])
+    elapsed = time.perf_counter() - start
+
+    assert results == [[]] * n
+    assert elapsed < StubPostgrestHandler.delay * n / 2
+
+
+@pytest.mark.asyncio
+async def test_supabase_calls_time_out_and_free_their_thread():
+    """The HTTP timeout fails a hung call on its worker thread, so the next call is not stuck behind it"""
+    service, server = make_supabase_service(StubPostgrestHandler, SUPABASE_MAX_WORKERS=1, SUPABASE_TIMEOUT=0.05)
+    try:
+        start = time.perf_counter()
+        with pytest.raises(httpx.TimeoutException):
+            await service.get_chat_documents("chat")
+        await asyncio.get_running_loop().run_in_executor(service.executor, lambda: None)
+        assert time.perf_counter() - start < StubPostgrestHandler.delay
+    finally:
+        service.close()
+        server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_write_throughput_counts_wall_time_of_concurrent_batches():
+    service, server = make_supabase_service(
+        StubPostgrestHandler, CHUNK_INSERT_BATCH_ROWS=1, CHUNK_INSERT_CONCURRENCY=4
+    )
+    chunks = [
+        {'chunk_index': i, 'chunk_type': 'text', 'text': f"chunk {i}", 'page_number': 1, 'embedding': [0.1] * 8}
+        for i in range(4)
+    ]
+    try:
+        await service.store_chunks(7, chunks)
+    finally:
+        service.close()
+        server.shutdown()
+
+    stats = service.write_stats()
+    assert stats['batches'] == 4
+    # Four overlapping 0.2 s requests take about 0.2 s, not 0.8 s
+    assert StubPostgrestHandler.delay <= stats['seconds'] < 2 * StubPostgrestHandler.delay
+
+
+@pytest.mark.parametrize("size", [100, 4096])
+@pytest.mark.asyncio
+async def test_extractor_uploads_spooled_files(size):
+    """Spooled downloads, in memory or rolled over to disk past their size limit, are accepted by the SDK"""
+    uploads = []
+
+    async def endpoint(request: httpx.Request) -> httpx.Response:
+        form = email.message_from_bytes(
+            f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode() + request.content
+        )
+        uploads.extend(
+            part.get_payload(decode=True) for part in form.get_payload()
+            if part.get_param("name", header="content-disposition") == "files"
+        )
+        return httpx.Response(200, json=[
+            {"type": "NarrativeText", "text": "Revenue grew", "metadata": {"page_number": 1}}
+        ])
+
+    extractor = make_extractor(endpoint)
+    spool = tempfile.SpooledTemporaryFile(max_size=1024)
+    spool.write(b"x" * size)
+    assert spool._rolled == (size > 1024)
+
+    elements = await extractor._partition(spool, "notes.txt")
+
+    assert uploads == [b"x" * size]
+    assert [element["text"] for element in elements] == ["Revenue grew"]
+
+
+@pytest.mark.asyncio
+async def test_store_chunks_batches_and_retries_idempotently():
+    """Rows are split by count and size; a failed batch is retried as an upsert"""
+    RecordingPostgrestHandler.requests = []
+    RecordingPostgrestHandler.fail_next = True
+    service, server = make_supabase_service(
+        RecordingPostgrestHandler, CHUNK_INSERT_BATCH_ROWS=10, CHUNK_INSERT_BATCH_BYTES=100 * 1024,
+        CHUNK_INSERT_CONCURRENCY=1
+    )
+    chunks = [
+        {'chunk_index': i, 'chunk_type': 'table' if i == 0 else 'text', 'text': f"chunk {i}",
+         'page_number': 1, 'table_data': '{"html": "<table></table>"}' if i == 0 else None,
+         'embedding': [0.123456789] * 768}
+        for i in range(25)
+    ]
+    try:
+        stored = await service.store_chunks(7, chunks)
+    finally:
+        service.close()
+        server.shutdown()
+
+    # ~15 KB per row keeps batches under the 100 KB budget before the 10 row limit
+    sizes = [len(body) for _, _, body in RecordingPostgrestHandler.requests]
+    assert max(sizes) < 10 and sum(sizes[1:]) == 25
+    first_path, first_prefer, _ = RecordingPostgrestHandler.requests[0]
+    retry_path, retry_prefer, retry_body = RecordingPostgrestHandler.requests[1]
+    assert "on_conflict" not in first_path
+    assert "on_conflict=document_id%2Cchunk_index" in retry_path
+    assert "merge-duplicates" in retry_prefer
+    assert retry_body == RecordingPostgrestHandler.requests[0][2]
+
+    assert sorted(row['chunk_index'] for row in stored) == list(range(25))
+    assert stored[0]['table_data'] == '{"html": "<table></table>"}'
+    stats = service.write_stats()
+    assert (stats['rows'], stats['retries'], stats['failures']) == (25, 1, 0)
+    assert stats['rows_per_second'] > 0
+
+
+@pytest.mark.asyncio
+async def test_chunk_reads_page_past_the_postgrest_row_limit():
+    service, server = make_supabase_service(PagedPostgrestHandler)
+    try:
+        chunks = await service.get_document_chunks(7)
+        texts = await service.get_document_texts(7)
+    finally:
+        service.close()
+        server.shutdown()
+
+    assert [chunk['chunk_index'] for chunk in chunks] == list(range(2500))
+    assert chunks[-1]['embedding'] == [0.5, 0.5]
+    assert len(texts) == 2500
+
+
+class FakeIntegrator:
+    """Records concurrency and walks through the ingestion stages"""
+
+    def __init__(self, fail_ids=()):
+        self.fail_ids = set(fail_ids)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def process_document(self, doc_id, file_path, chat_id, on_stage=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            for stage in ("downloading", "extracting", "embedding", "storing"):
+                on_stage(stage)
+                await asyncio.sleep(0.01)
+            if doc_id in self.fail_ids:
+                raise ValueError("extraction failed")
+            return {"document_id": doc_id, "status": "success"}
+        finally:
+            self.in_flight -= 1
+
+
+@pytest.mark.asyncio
+async def test_job_queue_processes_documents_in_background(tmp_path):
+    """Workers drain the queue under the global limit and record per-document status"""
+    settings = SimpleNamespace(
+        INGESTION_CONCURRENCY=2,
+        JOB_QUEUE_PATH=str(tmp_path / "jobs.db"),
+        JOB_QUEUE_POLL_INTERVAL=0.05,
+        JOB_QUEUE_LEASE_SECONDS=60.0,
+    )
+    integrator = FakeIntegrator(fail_ids={3})
+    queue = IngestionJobQueue(settings, integrator)
+    await queue.start()
+    try:
+        job_id = await queue.enqueue("chat", [{"id": i, "file_path": f"chat/{i}.pdf"} for i in range(1, 6)])
+        assert (await queue.get_job(job_id))["status"] in ("queued", "running")
+
+        for _ in range(100):
+            job = await queue.get_job(job_id)
+            if job["status"] not in ("queued", "running"):
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        await queue.stop()
+
+    assert job["status"] == "partial"
+    statuses = {doc["document_id"]: doc["status"] for doc in job["documents"]}
+    assert statuses == {1: "completed", 2: "completed", 3: "failed", 4: "completed", 5: "completed"}
+    assert job["documents"][0]["result"] == {"document_id": 1, "status": "success"}
+    assert integrator.max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_job_queue_requeues_interrupted_documents(tmp_path):
+    """Documents left running by a crashed process are picked up again once their lease lapses"""
+    settings = SimpleNamespace(
+        INGESTION_CONCURRENCY=1,
+        JOB_QUEUE_PATH=str(tmp_path / "jobs.db"),
+        JOB_QUEUE_POLL_INTERVAL=0.05,
+        JOB_QUEUE_LEASE_SECONDS=0.2,
+    )
+    queue = IngestionJobQueue(settings, FakeIntegrator())
+    job_id = await queue.enqueue("chat", [{"id": 1, "file_path": "chat/1.pdf"}])
+    queue._claim_next()
+    queue._db.close()
+
+    restarted = IngestionJobQueue(settings, FakeIntegrator())
+    await restarted.start()
+    try:
+        for _ in range(100):
+            if (await restarted.get_job(job_id))["status"] == "completed":
+                break
+            await asyncio.sleep(0.02)
+        assert (await restarted.get_job(job_id))["status"] == "completed"
+    finally:
+        await restarted.stop()
+
+
+@pytest.mark.asyncio
+async def test_job_queue_is_shared_safely_between_processes(tmp_path):
+    """Concurrent claimers never take the same document, and a live owner's work is not re-queued"""
+    settings = SimpleNamespace(
+        INGESTION_CONCURRENCY=1,
+        JOB_QUEUE_PATH=str(tmp_path / "jobs.db"),
+        JOB_QUEUE_POLL_INTERVAL=0.05,
+        JOB_QUEUE_LEASE_SECONDS=0.3,
+    )
+    queues = [IngestionJobQueue(settings, FakeIntegrator()) for _ in range(4)]
+    await queues[0].enqueue("chat", [{"id": i, "file_path": f"chat/{i}.pdf"} for i in range(200)])
+
+    def drain(queue):
+        claimed = []
+        while (row := queue._claim_next()) is not None:
+            claimed.append(row['seq'])
+        return claimed
+
+    claims = await asyncio.gather(*[asyncio.to_thread(drain, queue) for queue in queues])
+    assert sorted(seq for claimed in claims for seq in claimed) == list(range(1, 201))
+
+    # The owner keeps renewing its leases, so a peer starting up leaves its documents alone
+    owner, peer = queues[:2]
+    owner._heartbeat = asyncio.create_task(owner._renew_leases())
+    await peer.start()
+    await asyncio.sleep(0.5)
+    statuses = {
+        row['status'] for row in peer._db.execute(
+            "SELECT status FROM job_documents WHERE owner = ?", (owner.owner,)
+        )
+    }
+    assert statuses == {'running'}
+    await peer.stop()
+    await owner.stop()
+    for queue in queues[2:]:
+        queue._db.close()
+
+
+def page_batches(elements, pages_per_batch=1, delay=0.0):
+    """Stand-in for DocumentExtractor.iter_page_batches over elements grouped by page"""
+    async def iterate(file):
+        pages = sorted({element['page_number'] for element in elements})
+        for i in range(0, len(pages), pages_per_batch):
+            window = pages[i:i + pages_per_batch]
+            await asyncio.sleep(delay)
+            yield {
+                'elements': [element for element in elements if element['page_number'] in window],
+                'metadata': {'page_range': [window[0], window[-1]]}
+            }
+    return MagicMock(side_effect=iterate)
+
+
+def make_integrator(documents, stored_chunks, elements):
+    """ServiceIntegrator wired to in-memory stand-ins for storage, extraction and embedding"""
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator.pipeline_version = "test-v1"
+    integrator.settings = SimpleNamespace(
+        PIPELINE_QUEUE_SIZE=2, PIPELINE_EMBED_CONCURRENCY=2, PIPELINE_STORE_CONCURRENCY=2
+    )
+
+    file = MagicMock()
+    file.close = AsyncMock()
+    integrator.download_file = AsyncMock(return_value=(file, "file-hash"))
+
+    integrator.document_extractor = MagicMock()
+    integrator.document_extractor.iter_page_batches = page_batches(elements)
+
+    integrator.gemini = MagicMock()
+    integrator.gemini.generate_embeddings = AsyncMock(
+        side_effect=lambda texts: [[float(len(text))] for text in texts]
+    )
+
+    supabase = MagicMock()
+    supabase.update_document = AsyncMock(
+        side_effect=lambda doc_id, updates: documents.setdefault(doc_id, {}).update(updates)
+    )
+    supabase.get_document_metadata = AsyncMock(side_effect=lambda doc_id: documents.get(doc_id))
+    supabase.find_document_by_fingerprint = AsyncMock(side_effect=lambda fingerprint, exclude_id=None: next(
+        (dict(doc, id=doc_id) for doc_id, doc in documents.items()
+         if doc_id != exclude_id and doc.get('content_fingerprint') == fingerprint),
+        None
+    ))
+    supabase.get_document_chunks = AsyncMock(side_effect=lambda doc_id: [
+        dict(chunk) for chunk in stored_chunks.get(doc_id, [])
+    ])
+    rows_by_id = {}
+
+    async def store_chunks(doc_id, chunks, upsert=False):
+        rows = [dict(chunk, id=len(rows_by_id) + i + 1, document_id=doc_id) for i, chunk in enumerate(chunks)]
+        rows_by_id.update((row['id'], row) for row in rows)
+        return rows
+
+    supabase.store_chunks = AsyncMock(side_effect=store_chunks)
+    supabase.get_chunk_embeddings = AsyncMock(side_effect=lambda ids: {
+        i: rows_by_id[i]['embedding'] for i in ids if i in rows_by_id
+    })
+    supabase.delete_chunks = AsyncMock()
+    integrator.supabase = supabase
+    integrator.retriever = MagicMock()
+    integrator.table_index = TableAdjacencyIndex(supabase)
+    integrator.lexical_index = None
+    return integrator
+
+
+def text_element(text, page_number=1):
+    return {'text': text, 'page_number': page_number, 'chunk_type': 'text', 'table_data': None}
+
+
+@pytest.mark.asyncio
+async def test_reingestion_only_embeds_changed_chunks():
+    """Amended files re-embed only new text; identical files are skipped"""
+    stored = {1: [
+        dict(text_element("Revenue grew"), chunk_index=0, embedding=[12.0]),
+        dict(text_element("Net income fell"), chunk_index=1, embedding=[15.0]),
+        dict(text_element("Old footnote"), chunk_index=2, embedding=[12.0]),
+    ]}
+    documents = {1: {'content_fingerprint': 'stale'}}
+    elements = [text_element("Revenue grew"), text_element("Net income rose")]
+    integrator = make_integrator(documents, stored, elements)
+
+    result = await integrator.process_document(1, "chat/1.pdf", "chat")
+
+    assert result['ingestion_mode'] == 'incremental'
+    integrator.gemini.generate_embeddings.assert_awaited_once_with(["Net income rose"])
+    written = integrator.supabase.store_chunks.await_args.args[1]
+    assert [chunk['chunk_index'] for chunk in written] == [1]
+    integrator.supabase.delete_chunks.assert_awaited_once_with(1, from_index=2)
+
+    # Same bytes and pipeline version again: nothing is extracted or embedded
+    integrator.document_extractor.iter_page_batches.reset_mock()
+    result = await integrator.process_document(1, "chat/1.pdf", "chat")
+    assert result['ingestion_mode'] == 'unchanged'
+    integrator.document_extractor.iter_page_batches.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_identical_file_clones_existing_chunks():
+    """A file already processed as another document is cloned, not re-extracted"""
+    integrator = make_integrator({}, {}, [text_element("Revenue grew")])
+    await integrator.process_document(1, "chat-a/report.pdf", "chat-a")
+
+    stored = integrator.supabase.store_chunks.await_args.args[1]
+    integrator.supabase.get_document_chunks.side_effect = lambda doc_id: stored if doc_id == 1 else []
+    integrator.document_extractor.iter_page_batches.reset_mock()
+    integrator.gemini.generate_embeddings.reset_mock()
+
+    result = await integrator.process_document(2, "chat-b/report.pdf", "chat-b")
+
+    assert result['ingestion_mode'] == 'cloned'
+    assert result['chunks_processed'] == 1
+    integrator.document_extractor.iter_page_batches.assert_not_called()
+    integrator.gemini.generate_embeddings.assert_not_awaited()
+    assert integrator.supabase.store_chunks.await_args.args[0] == 2
+
+
+@pytest.mark.asyncio
+async def test_quantized_local_index_finds_freshly_ingested_chunks():
+    """Chunks indexed at ingest carry their stored ids, so exact re-ranking can fetch them"""
+    elements = [text_element(text) for text in ["Revenue grew", "Net income fell", "Cash declined"]]
+    integrator = make_integrator({}, {}, elements)
+    vectors = dict(zip([element['text'] for element in elements], np.eye(3, 8).tolist()))
+    integrator.gemini.generate_embeddings.side_effect = lambda texts: [vectors[text] for text in texts]
+    integrator.supabase.get_chat_documents = AsyncMock(return_value=[])
+    integrator.retriever = LocalVectorIndex(
+        SimpleNamespace(
+            LOCAL_INDEX_DTYPE="int8", EMBEDDING_DIMENSION=8,
+            EMBEDDING_STORAGE_FORMAT="int8", QUANTIZED_RERANK_FACTOR=4, LOCAL_INDEX_LOAD_CONCURRENCY=4
+        ),
+        integrator.supabase
+    )
+    # Load the (empty) index first so ingestion updates it in place
+    assert await integrator.retriever.find_similar_chunks(vectors["Net income fell"], chat_id="chat") == []
+
+    await integrator.process_document(1, "chat/1.pdf", "chat")
+
+    results = await integrator.retriever.find_similar_chunks(vectors["Net income fell"], chat_id="chat", limit=1)
+    assert [(r['text'], r['id']) for r in results] == [("Net income fell", 2)]
+    assert results[0]['similarity'] == pytest.approx(1.0)
+
+
+@pytest.mark.asyncio
+async def test_ingestion_pipeline_overlaps_stages():
+    """Early pages are stored while later pages are still being extracted"""
+    elements = [text_element(f"Page {page} paragraph {i}", page) for page in range(1, 7) for i in range(3)]
+    integrator = make_integrator({}, {}, elements)
+    extraction_done = asyncio.Event()
+    stored_during_extraction = []
+
+    async def slow_batches(file):
+        async for batch in page_batches(elements, pages_per_batch=2, delay=0.05)(file):
+            yield batch
+        extraction_done.set()
+
+    async def store_chunks(doc_id, chunks, upsert=False):
+        stored_during_extraction.append(not extraction_done.is_set())
+        return chunks
+
+    integrator.document_extractor.iter_page_batches = MagicMock(side_effect=slow_batches)
+    integrator.supabase.store_chunks = AsyncMock(side_effect=store_chunks)
+
+    result = await integrator.process_document(1, "chat/1.pdf", "chat")
+
+    assert result['chunks_processed'] == 18
+    assert result['page_count'] == 6
+    assert stored_during_extraction[0] is True
+    stored = [c['chunk_index'] for call in integrator.supabase.store_chunks.await_args_list for c in call.args[1]]
+    assert sorted(stored) == list(range(18))
+    assert set(result['timings']['stages']) == {'downloading', 'extracting', 'embedding', 'storing'}
+    assert result['timings']['stages']['extracting']['busy_seconds'] >= 0.15
+
+
+class FakePartitionEndpoint:
+    """Local stand-in for the Unstructured partition API.
+
+    Returns one element per page of the uploaded PDF, numbered from the
+    request's starting_page_number. Earlier page ranges answer more slowly
+    so out-of-order completion is exercised.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        form = email.message_from_bytes(
+            f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode() + request.content
+        )
+        fields = {
+            part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+            for part in form.get_payload()
+        }
+        start = int(fields.get("starting_page_number") or 1)
+        pages = len(PdfReader(io.BytesIO(fields["files"])).pages)
+
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.1 / start)
+        finally:
+            self.in_flight -= 1
+        return httpx.Response(200, json=[
+            {"type": "NarrativeText", "text": f"Page {start + i} text", "metadata": {"page_number": start + i}}
+            for i in range(pages)
+        ])
+
+
+def make_extractor(endpoint, **overrides):
+    values = dict(
+        UNSTRUCTURED_API_KEY="test-key",
+        UNSTRUCTURED_API_URL="http://partition.test",
+        DOWNLOAD_TEMP_DIR=None,
+        DOWNLOAD_SPOOL_MAX_BYTES=1024 * 1024,
+        PIPELINE_PAGES_PER_BATCH=4,
+        EXTRACTION_FANOUT=3,
+        EXTRACTION_ROUTING=True,
+        EXTRACTION_MIN_TEXT_CHARS=100,
+        EXTRACTION_TABLE_MIN_ROWS=3,
+        EXTRACTION_BACKEND="api",
+        CHUNK_MAX_TOKENS=0,
+        CHUNK_OVERLAP_TOKENS=0,
+    )
+    values.update(overrides)
+    return DocumentExtractor(
+        SimpleNamespace(**values), http_client=httpx.AsyncClient(transport=httpx.MockTransport(endpoint))
+    )
+
+
+def make_pdf(pages):
+    """Spooled PDF whose pages carry the given lines as a text layer (an empty list is a blank page)"""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for lines in pages:
+        page = writer.add_blank_page(612, 792)
+        if not lines:
+            continue
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+        })
+        stream = DecodedStreamObject()
+        stream.set_data(
+            b"BT /F1 10 Tf 72 720 Td 14 TL "
+            + b" ".join(f"({line}) Tj T*".encode() for line in lines)
+            + b" ET"
+        )
+        page[NameObject("/Contents")] = writer._add_object(stream)
+    spool = tempfile.SpooledTemporaryFile(max_size=1024)
+    writer.write(spool)
+    return spool
+
+
+@pytest.mark.asyncio
+async def test_extractor_partitions_page_ranges_concurrently():
+    """Page ranges run in parallel and merge back in page order with absolute page numbers"""
+    endpoint = FakePartitionEndpoint()
+    extractor = make_extractor(endpoint)
+
+    result = await extractor.process_file(UploadFile(file=make_pdf([[]] * 22), filename="filing.pdf"))
+
+    assert [element['page_number'] for element in result['elements']] == list(range(1, 23))
+    assert result['elements'][4]['text'] == "Page 5 text"
+    assert result['metadata']['total_pages'] == 22
+    assert endpoint.requests == 6
+    assert endpoint.max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_extractor_routes_plain_text_pages_to_text_layer():
+    """Only scanned and table pages reach hi-res partitioning; output keeps the same shape"""
+    narrative = [
+        "Management discussion of results for the fiscal year ended December 31.",
+        "Revenue increased due to higher volumes in the services segment and",
+        "improved pricing across our core markets.",
+    ]
+    table = ["Segment 2023 2022 Change", "Services 1,200 1,050 14%", "Products 800 (120) -5%", "Total 2,000 930 6.5%"]
+    endpoint = FakePartitionEndpoint()
+    extractor = make_extractor(endpoint)
+    pages = [narrative, narrative, table, [], narrative]
+
+    result = await extractor.process_file(UploadFile(file=make_pdf(pages), filename="filing.pdf"))
+
+    assert endpoint.requests == 1  # Pages 3-4 as one hi-res range
+    by_page = {}
+    for element in result['elements']:
+        by_page.setdefault(element['page_number'], []).append(element['text'])
+    assert by_page[1] == [
+        "Management discussion of results for the fiscal year ended December 31.",
+        "Revenue increased due to higher volumes in the services segment and improved pricing across our core markets.",
+    ]
+    assert by_page[3] == ["Page 3 text"] and by_page[4] == ["Page 4 text"]
+    assert [element['page_number'] for element in result['elements']] == [1, 1, 2, 2, 3, 4, 5, 5]
+    assert set(result) == {'elements', 'text_chunks', 'tables', 'metadata'}
+    assert all(
+        set(element) == {'text', 'page_number', 'chunk_type', 'table_data', 'element_start', 'element_end'}
+        for element in result['elements']
+    )
+
+    report = result['metadata']['extraction']
+    assert report['pages'] == {'fast': 3, 'hi_res': 2}
+    assert report['estimated_seconds_saved'] > 0
+
+
+def test_extractor_routes_two_period_statements_to_hi_res():
+    """A balance sheet with current and prior period columns counts as a table page"""
+    extractor = make_extractor(FakePartitionEndpoint())
+    balance_sheet = "\n".join([
+        "Consolidated Balance Sheets (in millions) September 28, 2024 September 30, 2023",
+        "Cash and cash equivalents $ 29,965 $ 23,646",
+        "Marketable securities 35,228 31,590",
+        "Accounts receivable, net 33,410 29,508",
+        "Total current assets $152,987 $143,566",
+    ])
+    narrative = (
+        "Revenue increased 2% in fiscal 2024 compared to the prior year, driven by higher\n"
+        "services revenue, partially offset by lower products revenue in several markets."
+    )
+
+    assert extractor._page_strategy(balance_sheet) == "hi_res"
+    assert extractor._page_strategy(narrative) == "fast"
+
+
+@pytest.mark.asyncio
+async def test_local_extraction_backend_matches_api_and_recycles_workers():
+    """The process-pool backend yields the same elements as the API and replaces workers"""
+    api_result = await make_extractor(FakePartitionEndpoint()).process_file(
+        UploadFile(file=make_pdf([[]] * 10), filename="filing.pdf")
+    )
+
+    extractor = make_extractor(FakePartitionEndpoint(), EXTRACTION_FANOUT=1)
+    extractor.local_partitioner = LocalPartitioner(
+        workers=1, max_tasks_per_worker=1, partition_func=fake_local_partition
+    )
+    try:
+        local_result = await extractor.process_file(UploadFile(file=make_pdf([[]] * 10), filename="filing.pdf"))
+        pids = {
+            (await extractor.local_partitioner.partition(make_pdf([[]]), "page.pdf"))[0]["metadata"]["pid"]
+            for _ in range(2)
+        }
+    finally:
+        extractor.close()
+
+    assert local_result['elements'] == api_result['elements']
+    assert local_result['metadata']['total_pages'] == 10
+    assert len(pids) == 2 and os.getpid() not in pids
+
+
+def test_chunk_assembler_merges_text_within_pages_and_budget():
+    """Text merges up to the budget with overlap; titles, pages and tables break chunks"""
+    def element(index, text, page=1, element_type="narrativetext", chunk_type="text"):
+        return {'text': text, 'page_number': page, 'chunk_type': chunk_type, 'element_type': element_type,
+                'table_data': '{"html": ""}' if chunk_type == "table" else None, 'element_index': index}
+
+    sentence = "Revenue from services grew on higher volumes and pricing."  # 15 tokens
+    elements = [
+        element(0, "Results of Operations", element_type="title"),
+        *[element(i, f"{sentence} ({i})") for i in range(1, 8)],
+        element(8, "Segment table", element_type="table", chunk_type="table"),
+        element(9, sentence),
+        element(10, "Liquidity", element_type="title"),
+        element(11, sentence),
+        element(12, sentence, page=2),
+    ]
+
+    chunks = assemble_chunks(elements, max_tokens=60, overlap_tokens=10)
+
+    assert [(c['element_start'], c['element_end']) for c in chunks] == [
+        (0, 3), (3, 6), (6, 7), (8, 8), (9, 9), (10, 11), (12, 12)
+    ]
+    assert chunks[0]['text'].startswith("Results of Operations Revenue")
+    assert all(estimate_tokens(c['text']) <= 60 for c in chunks)
+    # Each full chunk's tail opens the next one, whose range starts at the carried element
+    assert chunks[1]['text'].startswith("volumes and pricing. (3) Revenue")
+    assert chunks[3]['chunk_type'] == 'table' and chunks[3]['table_data'] == '{"html": ""}'
+    assert [c['page_number'] for c in chunks] == [1, 1, 1, 1, 1, 1, 2]
+
+    unmerged = assemble_chunks(elements, max_tokens=0)
+    assert [(c['element_start'], c['element_end']) for c in unmerged] == [(i, i) for i in range(13)]
+
+
+FINANCIAL_TABLE_HTML = (
+    "<table><tr><td></td><td colspan=\"2\">Year ended December 31</td></tr>"
+    "<tr><td></td><td>2023</td><td>2022</td></tr>"
+    "<tr><td>Net sales</td><td>$4,210</td><td>$3,760</td></tr>"
+    "<tr><td>Operating expenses</td><td></td><td></td></tr>"
+    "<tr><td>Cost of sales</td><td>(2,471.5)</td><td>(2,268)</td></tr>"
+    "<tr><td>Restructuring</td><td>-12</td><td>—</td></tr>"
+    "<tr><td>Total operating expenses</td><td>(2,483.5)</td><td>(2,268)</td></tr></table>"
+)
+
+
+@pytest.mark.asyncio
+async def test_tables_are_parsed_at_ingest_and_answered_without_the_model():
+    """Extraction stores parsed table JSON and the query path serves it with no LLM call"""
+    extractor = make_extractor(lambda request: httpx.Response(500))
+    result = extractor._process_response([
+        {"type": "NarrativeText", "text": "Consolidated results of operations", "metadata": {"page_number": 3}},
+        {"type": "Table", "text": "Net sales 4,210 3,760",
+         "metadata": {"page_number": 3, "text_as_html": FINANCIAL_TABLE_HTML}},
+    ], "report.pdf")
+    structured = json.loads(result['tables'][0]['table_data'])['structured']
+
+    assert structured['columns'][1:] == ["Year ended December 31 2023", "Year ended December 31 2022"]
+    assert [row['values'] for row in structured['rows'] if row['label'] != "Operating expenses"] == [
+        [4210.0, 3760.0], [-2471.5, -2268.0], [-12.0, None], [-2483.5, -2268.0]
+    ]
+
+    supabase = MagicMock()
+    supabase.get_document_metadata = AsyncMock(return_value={'content_fingerprint': "v1"})
+    supabase.get_document_tables = AsyncMock(return_value=[
+        dict(result['tables'][0], chunk_index=1, document_id=7)
+    ])
+    service = GeminiService(make_settings(), supabase)
+    service.model = MagicMock()
+    response = json.loads(await service.generate_response("What were net sales?", [
+        dict(result['text_chunks'][0], chunk_index=0, document_id=7, similarity=0.8)
+    ]))
+
+    service.model.generate_content.assert_not_called()
+    assert response['statement_type'] == "Income Statement"
+    assert response['line_items'][1] == {
+        "name": "Cost of sales",
+        "values": {"Year ended December 31 2023": -2471.5, "Year ended December 31 2022": -2268.0},
+        "parent": "Operating expenses",
+    }
+    assert [item['name'] for item in response['subtotals']] == ["Total operating expenses"]
+
+
+@pytest.mark.asyncio
+async def test_table_adjacency_index_finds_nearest_table_in_memory():
+    """One load per document, then lookups and ingestion updates never query"""
+    def table(chunk_index, page_number):
+        return {'chunk_index': chunk_index, 'chunk_type': 'table', 'text': f"table {chunk_index}",
+                'page_number': page_number, 'table_data': '{"html": ""}'}
+
+    supabase = MagicMock()
+    supabase.get_document_metadata = AsyncMock(return_value={'content_fingerprint': "v1"})
+    supabase.get_document_tables = AsyncMock(return_value=[table(3, 1), table(9, 1), table(4, 2)])
+    index = TableAdjacencyIndex(supabase, window_size=5)
+
+    assert (await index.nearest_table(1, 1, 6))['chunk_index'] == 3  # tie goes to the earlier table
+    assert (await index.nearest_table(1, 1, 7))['chunk_index'] == 9
+    assert await index.nearest_table(1, 1, 15) is None
+    assert (await index.nearest_table(1, 1, 15, window_size=6))['chunk_index'] == 9
+    assert await index.nearest_table(1, 3, 4) is None
+    supabase.get_document_tables.assert_awaited_once_with(1)
+
+    index.on_chunks_stored(1, [dict(text_element("Now text"), chunk_index=3)])
+    assert (await index.nearest_table(1, 1, 5))['chunk_index'] == 9
+    index.on_chunks_deleted(1, from_index=8)
+    assert await index.nearest_table(1, 1, 5) is None
+
+    index.reset(2, [table(0, 1)])
+    assert (await index.nearest_table(2, 1, 2))['document_id'] == 2
+    assert supabase.get_document_tables.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_table_adjacency_index_reloads_reingested_documents_and_evicts():
+    """A fingerprint changed by another process reloads the entry once it is stale; old documents are evicted"""
+    def table(chunk_index):
+        return {'chunk_index': chunk_index, 'chunk_type': 'table', 'text': "table",
+                'page_number': 1, 'table_data': '{"html": ""}'}
+
+    fingerprints = {1: "v1", 2: "v1"}
+    tables = {1: [table(3)], 2: [table(0)]}
+    supabase = MagicMock()
+    supabase.get_document_metadata = AsyncMock(side_effect=lambda doc_id: {'content_fingerprint': fingerprints[doc_id]})
+    supabase.get_document_tables = AsyncMock(side_effect=lambda doc_id: tables[doc_id])
+    index = TableAdjacencyIndex(supabase, window_size=5, max_documents=1, refresh_seconds=60)
+
+    assert (await index.nearest_table(1, 1, 4))['chunk_index'] == 3
+    fingerprints[1], tables[1] = "v2", [table(6)]
+    assert (await index.nearest_table(1, 1, 4))['chunk_index'] == 3  # trusted within the refresh interval
+
+    index.refresh_seconds = 0
+    assert (await index.nearest_table(1, 1, 4))['chunk_index'] == 6
+    assert (await index.nearest_table(1, 1, 4))['chunk_index'] == 6
+    assert supabase.get_document_tables.await_count == 2  # an unchanged fingerprint is not reloaded
+
+    assert (await index.nearest_table(2, 1, 1))['chunk_index'] == 0
+    assert list(index._tables) == [2]
+
+
+@pytest.mark.asyncio
+async def test_query_stream_sends_sources_first_and_stores_query_afterwards():
+    """Sources go out before generation starts; store_query runs after the stream, off the request path"""
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator._background_tasks = set()
+    integrator.lexical_index = None
+    integrator.settings = SimpleNamespace(MMR_ENABLED=False)
+    chunks = [{'chunk_type': 'text', 'text': "Net sales grew", 'similarity': 0.9, 'chunk_index': 0,
+               'document_id': 1, 'page_number': 1}]
+    integrator.retriever = MagicMock(find_similar_chunks=AsyncMock(return_value=chunks))
+    generation_started = asyncio.Event()
+
+    async def generate_response_stream(query, source_references):
+        generation_started.set()
+        for text in ["Net sales ", "rose 12%"]:
+            yield text
+
+    integrator.gemini = MagicMock(generate_embedding=AsyncMock(return_value=[0.1]))
+    integrator.gemini.generate_response_stream = generate_response_stream
+    stored = asyncio.Event()
+    integrator.supabase = MagicMock(store_query=AsyncMock(side_effect=lambda **kwargs: stored.set()))
+
+    stream = integrator.query_documents_stream("How did sales do?", "chat")
+    assert await stream.__anext__() == {'event': 'sources', 'data': chunks}
+    assert not generation_started.is_set()
+
+    events = [event async for event in stream]
+    assert [event['data'] for event in events] == ["Net sales ", "rose 12%", None]
+    await asyncio.wait_for(stored.wait(), 1)
+    integrator.supabase.store_query.assert_awaited_once_with(
+        chat_id="chat", query_text="How did sales do?", response_text="Net sales rose 12%", source_references=chunks
+    )
+    await asyncio.sleep(0)
+    assert not integrator._background_tasks
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_stores_what_was_sent_and_caches_nothing():
+    """A mid-stream disconnect stores the sent pieces, times the model from its thread and skips the cache"""
+    service = GeminiService(make_settings(), MagicMock())
+    service.response_cache = ResponseCache(max_bytes=1024 * 1024)
+    produced = threading.Event()
+
+    def generate_content(prompt, stream):
+        for text in ["Net sales ", "rose 12%", " in 2023"]:
+            yield SimpleNamespace(text=text)
+            produced.wait(1)
+
+    service.model = MagicMock(generate_content=generate_content)
+    service._prepare_response = AsyncMock(return_value=(None, "prompt"))
+    first_pieces = STAGE_SECONDS.count('gemini.stream_first_piece')
+
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator._background_tasks = set()
+    integrator._find_chunks = AsyncMock(return_value=[])
+    integrator.gemini = service
+    stored = asyncio.Event()
+    integrator.supabase = MagicMock(store_query=AsyncMock(side_effect=lambda **kwargs: stored.set()))
+
+    stream = integrator.query_documents_stream("How did sales do?", "chat")
+    assert (await stream.__anext__())['event'] == 'sources'
+    assert (await stream.__anext__())['data'] == "Net sales "
+    await stream.aclose()
+    produced.set()
+
+    await asyncio.wait_for(stored.wait(), 1)
+    assert integrator.supabase.store_query.await_args.kwargs['response_text'] == "Net sales "
+    assert STAGE_SECONDS.count('gemini.stream_first_piece') == first_pieces + 1
+    assert await service.response_cache.get(service.model_name, "prompt") is None
+
+
+def test_lexical_index_ranks_exact_tokens_and_stays_in_sync():
+    """BM25 finds exact figures and years; replaced and deleted chunks drop out"""
+    def chunk(index, text):
+        return {'chunk_index': index, 'chunk_type': 'text', 'text': text, 'page_number': 1, 'table_data': None}
+
+    index = ChatLexicalIndex()
+    index.upsert(1, "10-K.pdf", [
+        chunk(0, "Net sales were $4,210 million in fiscal 2023."),
+        chunk(1, "Net sales were $3,760 million in fiscal 2022."),
+        chunk(2, "See Note 12 for goodwill impairment testing."),
+    ])
+    index.upsert(2, "10-Q.pdf", [chunk(0, "Quarterly net sales in fiscal 2023 rose.")])
+
+    assert tokenize("What were Net Sales of $4,210.5 in 2023?") == ["net", "sales", "4210.5", "2023"]
+    assert [(r['document_id'], r['chunk_index']) for r in index.search("net sales fiscal 2022")][0] == (1, 1)
+    assert index.search("note 12")[0]['chunk_index'] == 2
+    assert [r['document_id'] for r in index.search("4210")] == [1]
+    assert {r['document_id'] for r in index.search("fiscal 2023", document_ids=[2])} == {2}
+    assert index.search("unrelated words") == []
+
+    index.upsert(1, "10-K.pdf", [chunk(2, "Goodwill was not impaired.")])
+    assert index.search("note 12") == []
+    index.remove(1, from_index=1)
+    assert len(index) == 2
+    index._compact()
+    assert index.search("goodwill") == []
+    assert {(r['document_id'], r['chunk_index']) for r in index.search("net sales")} == {(1, 0), (2, 0)}
+
+
+@pytest.mark.asyncio
+async def test_lexical_index_picks_up_other_processes_ingestion_and_evicts():
+    """Re-ingested and deleted documents are reloaded or dropped once stale; old chats are evicted"""
+    def chunk(index, text):
+        return {'chunk_index': index, 'chunk_type': 'text', 'text': text, 'page_number': 1, 'table_data': None}
+
+    documents = {'chat-a': [{'id': 1, 'name': "10-K.pdf", 'content_fingerprint': "v1"},
+                            {'id': 2, 'name': "10-Q.pdf", 'content_fingerprint': "v1"}],
+                 'chat-b': [{'id': 3, 'name': "8-K.pdf", 'content_fingerprint': "v1"}]}
+    texts = {1: [chunk(0, "Goodwill was impaired.")], 2: [chunk(0, "Quarterly revenue rose.")],
+             3: [chunk(0, "Goodwill is tested annually.")]}
+    supabase = MagicMock()
+    supabase.get_chat_documents = AsyncMock(side_effect=lambda chat_id: [dict(d) for d in documents[chat_id]])
+    supabase.get_document_texts = AsyncMock(side_effect=lambda document_id: texts[document_id])
+    lexical = LexicalIndex(
+        SimpleNamespace(BM25_K1=1.2, BM25_B=0.75, LEXICAL_INDEX_MAX_CHATS=1, LEXICAL_INDEX_REFRESH_SECONDS=60),
+        supabase
+    )
+
+    assert [r['document_id'] for r in await lexical.search("goodwill", "chat-a")] == [1]
+    # Another process re-ingests document 1 and deletes document 2
+    texts[1] = [chunk(0, "Goodwill was not impaired."), chunk(1, "Inventory fell.")]
+    documents['chat-a'] = [{'id': 1, 'name': "10-K.pdf", 'content_fingerprint': "v2"}]
+    assert await lexical.search("inventory", "chat-a") == []  # still trusted within the refresh interval
+    assert supabase.get_chat_documents.await_count == 1
+
+    lexical.refresh_seconds = 0
+    assert [r['chunk_index'] for r in await lexical.search("inventory", "chat-a")] == [1]
+    assert await lexical.search("quarterly revenue", "chat-a") == []
+    assert supabase.get_document_texts.await_count == 3  # unchanged documents are not re-read
+
+    await lexical.search("goodwill", "chat-b")
+    assert list(lexical._indexes) == ["chat-b"]
+
+
+@pytest.mark.asyncio
+async def test_hybrid_retrieval_fuses_vector_and_keyword_ranks():
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator.settings = SimpleNamespace(HYBRID_CANDIDATES=20, RRF_K=60, MMR_ENABLED=False)
+
+    def row(index, similarity=None):
+        row = {'document_id': 1, 'chunk_index': index, 'chunk_type': 'text', 'text': f"chunk {index}"}
+        return dict(row, similarity=similarity) if similarity is not None else row
+
+    integrator.gemini = MagicMock(generate_embedding=AsyncMock(return_value=[0.1]))
+    integrator.retriever = MagicMock(find_similar_chunks=AsyncMock(return_value=[row(0, 0.8), row(1, 0.7)]))
+    integrator.lexical_index = MagicMock(search=AsyncMock(return_value=[row(2), row(1)]))
+
+    chunks = await integrator._find_chunks("goodwill note 12", "chat", None)
+
+    assert [chunk['chunk_index'] for chunk in chunks] == [1, 0, 2]
+    assert chunks[0]['similarity'] == 0.7 and chunks[2]['similarity'] == 0.0
+    assert integrator.retriever.find_similar_chunks.await_args.kwargs['limit'] == 20
+
+
+def test_mmr_skips_near_duplicates():
+    """Near-identical fragments give way to the next most relevant distinct chunk"""
+    vectors = np.array([[1.0, 0.0, 0.0], [0.99, 0.01, 0.0], [0.98, 0.02, 0.0], [0.0, 1.0, 0.0],
+                        [0.0, 0.0, 1.0], [0.0, 0.0, 0.0]], dtype=np.float32)
+    relevance = np.array([1.0, 0.99, 0.98, 0.8, 0.6, 0.7])
+
+    assert mmr_select(relevance, vectors, 3, lambda_=1.0) == [0, 1, 2]
+    assert mmr_select(relevance, vectors, 3, lambda_=0.7) == [0, 3, 5]
+    assert mmr_select(relevance, vectors, 10, lambda_=0.7)[:4] == [0, 3, 5, 4]
+    assert mmr_select(relevance[:0], vectors[:0], 3) == []
+
+
+@pytest.mark.asyncio
+async def test_query_over_fetches_and_diversifies_candidates():
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator.settings = SimpleNamespace(MMR_ENABLED=True, MMR_FETCH_FACTOR=4, MMR_LAMBDA=0.5)
+    integrator.lexical_index = None
+    rng = np.random.default_rng(0)
+    base = rng.normal(size=(2, 16)).astype(np.float32)
+    # Twelve fragments of one page, then eight distinct chunks that score a little lower
+    vectors = np.concatenate([base[0] + 0.01 * rng.normal(size=(12, 16)), rng.normal(size=(8, 16))])
+    candidates = [
+        {'document_id': 1, 'chunk_index': i, 'chunk_type': 'text', 'text': f"chunk {i}",
+         'similarity': 0.9 - 0.01 * i}
+        for i in range(20)
+    ]
+    integrator.gemini = MagicMock(generate_embedding=AsyncMock(return_value=[0.1]))
+    integrator.retriever = MagicMock(
+        has_embeddings=True,
+        find_similar_chunks=AsyncMock(return_value=candidates),
+        get_embeddings=AsyncMock(return_value=vectors.astype(np.float32))
+    )
+
+    chunks = await integrator._find_chunks("question", "chat", None)
+
+    assert integrator.retriever.find_similar_chunks.await_args.kwargs['limit'] == 20
+    assert len(chunks) == 5 and chunks[0]['chunk_index'] == 0
+    assert sum(chunk['chunk_index'] < 12 for chunk in chunks) == 1
+
+    # The RPC backend returns no vectors, so it is not over-fetched or re-ranked
+    integrator.retriever.has_embeddings = False
+    integrator.retriever.find_similar_chunks.return_value = candidates[:5]
+    chunks = await integrator._find_chunks("question", "chat", None)
+
+    assert integrator.retriever.find_similar_chunks.await_args.kwargs['limit'] == 5
+    assert [chunk['chunk_index'] for chunk in chunks] == [0, 1, 2, 3, 4]
+    integrator.retriever.get_embeddings.assert_awaited_once()
+
+
+def make_chunks(vectors, start_index=0):
+    return [
+        {'chunk_index': start_index + i, 'chunk_type': 'text', 'text': f"chunk {start_index + i}",
+         'page_number': 1, 'table_data': None, 'embedding': list(vector)}
+        for i, vector in enumerate(vectors)
+    ]
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_chat_vector_index_matches_exact_search(dtype):
+    """Threshold, top-k ordering and document filtering follow the RPC semantics"""
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(300, 16)).astype(np.float32)
+    index = ChatVectorIndex(dimension=16, dtype=dtype)
+    index.upsert(1, "a.pdf", make_chunks(vectors[:200]))
+    index.upsert(2, "b.pdf", make_chunks(vectors[200:], start_index=200))
+
+    query = rng.normal(size=16).astype(np.float32)
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = unit @ (query / np.linalg.norm(query))
+
+    results = index.search(query.tolist(), threshold=0.1, limit=5)
+    assert [r['chunk_index'] for r in results] == list(np.argsort(-expected)[:5])
+    assert all(r['similarity'] > 0.1 for r in results)
+    assert results[0]['document_name'] in ("a.pdf", "b.pdf")
+
+    filtered = index.search(query.tolist(), document_ids=[2], threshold=-1.0, limit=3)
+    assert {r['document_id'] for r in filtered} == {2}
+    assert [r['chunk_index'] for r in filtered] == list(200 + np.argsort(-expected[200:])[:3])
+
+    assert index.search(query.tolist(), threshold=1.0, limit=5) == []
+
+
+def test_chat_vector_index_grows_in_place_across_batches():
+    """Small interleaved batches, filtered searches and removals match an index built at once"""
+    vectors = np.random.default_rng(2).normal(size=(500, 16)).astype(np.float32)
+    query = vectors[0].tolist()
+    grown = ChatVectorIndex(dimension=16)
+    for start in range(0, 500, 25):
+        doc_id = 1 + (start // 25) % 2
+        grown.upsert(doc_id, None, make_chunks(vectors[start:start + 25], start_index=start))
+        grown.search(query, document_ids=[doc_id], threshold=-1.0, limit=1)
+    grown.remove(1, from_index=400)
+
+    built = ChatVectorIndex(dimension=16)
+    for doc_id in (1, 2):
+        chunks = [
+            chunk for start in range(0, 500, 25) if 1 + (start // 25) % 2 == doc_id
+            for chunk in make_chunks(vectors[start:start + 25], start_index=start)
+            if not (doc_id == 1 and chunk['chunk_index'] >= 400)
+        ]
+        built.upsert(doc_id, None, chunks)
+
+    assert len(grown) == len(built) == 450
+    for document_ids in (None, [1], [2]):
+        assert (
+            [r['chunk_index'] for r in grown.search(query, document_ids=document_ids, threshold=-1.0, limit=20)]
+            == [r['chunk_index'] for r in built.search(query, document_ids=document_ids, threshold=-1.0, limit=20)]
+        )
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_chat_vector_index_search_many_matches_search(dtype):
+    rng = np.random.default_rng(1)
+    index = ChatVectorIndex(dimension=16, dtype=dtype)
+    index.upsert(1, "a.pdf", make_chunks(rng.normal(size=(100, 16))))
+    index.upsert(2, "b.pdf", make_chunks(rng.normal(size=(50, 16)), start_index=100))
+    queries = rng.normal(size=(4, 16)).tolist()
+
+    for document_ids in (None, [2]):
+        batched = index.search_many(queries, document_ids=document_ids, threshold=0.1, limit=5)
+        for results, query in zip(batched, queries):
+            single = index.search(query, document_ids=document_ids, threshold=0.1, limit=5)
+            assert [r['chunk_index'] for r in results] == [r['chunk_index'] for r in single]
+            assert [r['similarity'] for r in results] == pytest.approx([r['similarity'] for r in single], abs=1e-5)
+
+
+@pytest.mark.asyncio
+async def test_batch_query_embeds_and_stores_once():
+    """One embedding call and one retrieval pass for all questions; a failed answer does not fail the batch"""
+    integrator = ServiceIntegrator.__new__(ServiceIntegrator)
+    integrator.settings = SimpleNamespace(MMR_ENABLED=False, QUERY_BATCH_CONCURRENCY=2)
+    integrator.lexical_index = None
+    chunk = {'document_id': 1, 'chunk_index': 0, 'chunk_type': 'text', 'text': "t", 'similarity': 0.8}
+    integrator.gemini = MagicMock(
+        generate_embeddings=AsyncMock(return_value=[[0.1], [0.2], [0.3]]),
+        generate_response=AsyncMock(side_effect=["a1", ValueError("No relevant tables"), "a3"])
+    )
+    integrator.retriever = MagicMock(find_similar_chunks_many=AsyncMock(return_value=[[chunk], [], [chunk]]))
+    integrator.supabase = MagicMock(store_queries=AsyncMock())
+
+    results = await integrator.query_documents_batch(["q1", "q2", "q3"], "chat")
+
+    integrator.gemini.generate_embeddings.assert_awaited_once_with(["q1", "q2", "q3"])
+    assert integrator.retriever.find_similar_chunks_many.await_args.kwargs['embeddings'] == [[0.1], [0.2], [0.3]]
+    assert [(r['query'], r['response'], r['error']) for r in results] == [
+        ("q1", "a1", None), ("q2", None, "No relevant tables"), ("q3", "a3", None)
+    ]
+    integrator.supabase.store_queries.assert_awaited_once()
+    stored = integrator.supabase.store_queries.await_args.args[1]
+    assert [item['query_text'] for item in stored] == ["q1", "q3"]
+
+
+@pytest.mark.asyncio
+async def test_local_vector_index_loads_lazily_and_stays_in_sync():
+    supabase = MagicMock()
+    supabase.get_chat_documents = AsyncMock(return_value=[{'id': 1, 'name': 'a.pdf'}])
+    supabase.get_document_chunks = AsyncMock(return_value=make_chunks([[1.0, 0.0], [0.0, 1.0]]))
+    retriever = LocalVectorIndex(
+        SimpleNamespace(
+            LOCAL_INDEX_DTYPE="float32", EMBEDDING_DIMENSION=2,
+            EMBEDDING_STORAGE_FORMAT="float", QUANTIZED_RERANK_FACTOR=4, LOCAL_INDEX_LOAD_CONCURRENCY=4
+        ),
+        supabase
+    )
+
+    retriever.on_chunks_stored("chat", 1, make_chunks([[1.0, 1.0]], start_index=2))
+    supabase.get_chat_documents.assert_not_awaited()
+
+    results = await retriever.find_similar_chunks([1.0, 0.0], chat_id="chat", threshold=0.5, limit=5)
+    assert [r['chunk_index'] for r in results] == [0]
+
+    retriever.on_chunks_stored("chat", 2, make_chunks([[0.9, 0.1]]), document_name="b.pdf")
+    retriever.on_chunks_deleted("chat", 1)
+    results = await retriever.find_similar_chunks([1.0, 0.0], chat_id="chat", threshold=0.5, limit=5)
+    assert [(r['document_id'], r['document_name']) for r in results] == [(2, "b.pdf")]
+    supabase.get_chat_documents.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_local_vector_index_loads_documents_concurrently():
+    """Documents are fetched with bounded concurrency and indexed in document order"""
+    in_flight, max_in_flight = 0, 0
+
+    async def get_document_chunks(doc_id, compact=False):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01 * (6 - doc_id))
+        in_flight -= 1
+        return make_chunks([[1.0, 0.1 * doc_id]])
+
+    supabase = MagicMock()
+    supabase.get_chat_documents = AsyncMock(return_value=[{'id': i, 'name': f"{i}.pdf"} for i in range(1, 6)])
+    supabase.get_document_chunks = AsyncMock(side_effect=get_document_chunks)
+    retriever = LocalVectorIndex(
+        SimpleNamespace(
+            LOCAL_INDEX_DTYPE="float32", EMBEDDING_DIMENSION=2,
+            EMBEDDING_STORAGE_FORMAT="float", QUANTIZED_RERANK_FACTOR=4, LOCAL_INDEX_LOAD_CONCURRENCY=2
+        ),
+        supabase
+    )
+
+    await retriever.find_similar_chunks([1.0, 0.0], chat_id="chat")
+
+    assert max_in_flight == 2
+    assert [row['document_id'] for row in retriever._indexes["chat"].rows] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize("storage_format,tolerance", [("float16", 1e-3), ("int8", 1e-2)])
+def test_embedding_blob_round_trip(storage_format, tolerance):
+    vector = np.random.default_rng(0).normal(size=768).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    blob = encode_embedding(vector.tolist(), storage_format)
+
+    assert len(blob) < len(json.dumps(vector.tolist())) / 4
+    decoded = decode_embedding(blob)
+    assert decoded.shape == (768,)
+    assert np.abs(decoded - vector).max() < tolerance
+
+
+@pytest.mark.asyncio
+async def test_int8_local_index_reranks_with_exact_embeddings():
+    """Quantized candidates are re-scored exactly, so results match a float32 search"""
+    vectors = clustered_vectors(500)
+    chunks = make_chunks(vectors)
+    for i, chunk in enumerate(chunks):
+        chunk['id'] = 1000 + i
+    exact = {chunk['id']: chunk['embedding'] for chunk in chunks}
+
+    supabase = MagicMock()
+    supabase.get_chat_documents = AsyncMock(return_value=[{'id': 1, 'name': 'a.pdf'}])
+    supabase.get_document_chunks = AsyncMock(return_value=chunks)
+    supabase.get_chunk_embeddings = AsyncMock(side_effect=lambda ids: {i: exact[i] for i in ids})
+    retriever = LocalVectorIndex(
+        SimpleNamespace(
+            LOCAL_INDEX_DTYPE="int8", EMBEDDING_DIMENSION=32,
+            EMBEDDING_STORAGE_FORMAT="int8", QUANTIZED_RERANK_FACTOR=4, LOCAL_INDEX_LOAD_CONCURRENCY=4
+        ),
+        supabase
+    )
+    reference = ChatVectorIndex(dimension=32)
+    reference.upsert(1, "a.pdf", chunks)
+
+    for query in clustered_vectors(10, seed=1):
+        results = await retriever.find_similar_chunks(query.tolist(), chat_id="chat", threshold=0.3, limit=5)
+        expected = reference.search(query.tolist(), threshold=0.3, limit=5)
+        assert [r['id'] for r in results] == [r['id'] for r in expected]
+        assert [r['similarity'] for r in results] == pytest.approx([r['similarity'] for r in expected], abs=1e-5)
+    supabase.get_document_chunks.assert_awaited_once_with(1, compact=True)
+    assert retriever._indexes["chat"].nbytes() < reference.nbytes() / 3
+
+
+def clustered_vectors(n, dimension=32, clusters=20, seed=0):
+    """Embedding-like data: points scattered around a few topic directions"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    labels = rng.integers(0, clusters, size=n)
+    return (centers[labels] + 0.3 * rng.normal(size=(n, dimension))).astype(np.float32)
+
+
+def test_ivf_index_recall_and_persistence(tmp_path):
+    """Probing every cell is exact, and inserts after training stay searchable across a reload"""
+    vectors = clustered_vectors(2200)
+    params = dict(dimension=32, nprobe=4, min_train_size=1000)
+    index = IVFChatIndex(**params)
+    index.upsert(1, "a.pdf", make_chunks(vectors[:2000]))
+    assert index.needs_training() and not index.trained
+    index.train()
+    assert index.trained and not index.needs_training()
+
+    exact = ChatVectorIndex(dimension=32)
+    exact.upsert(1, "a.pdf", make_chunks(vectors[:2000]))
+    queries = clustered_vectors(20, seed=1)
+    hits = sum(
+        len({r['chunk_index'] for r in index.search(q.tolist(), threshold=-1.0, limit=10)}
+            & {r['chunk_index'] for r in exact.search(q.tolist(), threshold=-1.0, limit=10)})
+        for q in queries
+    )
+    assert hits / (20 * 10) >= 0.9
+
+    index.nprobe = len(index.centroids)
+    for q in queries:
+        assert index.search(q.tolist(), threshold=-1.0, limit=10) == exact.search(q.tolist(), threshold=-1.0, limit=10)
+
+    index.upsert(2, "b.pdf", make_chunks(vectors[2000:]))
+    path = str(tmp_path / "chat")
+    index.save(path, metadata={"documents": {"1": "fp1", "2": "fp2"}})
+    restored, metadata = IVFChatIndex.load(path, **params)
+
+    assert metadata == {"documents": {"1": "fp1", "2": "fp2"}}
+    assert len(restored) == 2200
+    restored.nprobe = len(restored.centroids)
+    results = restored.search(vectors[2100].tolist(), document_ids=[2], threshold=0.5, limit=1)
+    assert [(r['document_id'], r['chunk_index']) for r in results] == [(2, 100)]
+
+
+@pytest.mark.asyncio
+async def test_ivf_trains_off_the_event_loop_and_keeps_concurrent_writes(tmp_path):
+    """Ingestion schedules the fit on a thread; rows written meanwhile land in the swapped-in cells"""
+    vectors = clustered_vectors(2200)
+    supabase = MagicMock()
+    supabase.get_chat_documents = AsyncMock(return_value=[{'id': 1, 'name': 'a.pdf'}])
+    supabase.get_document_chunks = AsyncMock(return_value=make_chunks(vectors[:500]))
+    retriever = LocalVectorIndex(
+        SimpleNamespace(
+            LOCAL_INDEX_DTYPE="float32", EMBEDDING_DIMENSION=32,
+            EMBEDDING_STORAGE_FORMAT="float", QUANTIZED_RERANK_FACTOR=4, LOCAL_INDEX_LOAD_CONCURRENCY=4,
+            IVF_INDEX_DIR=str(tmp_path), IVF_NPROBE=4, IVF_NLIST=None, IVF_MIN_TRAIN_SIZE=1000
+        ),
+        supabase,
+        index_type="ivf"
+    )
+    await retriever.find_similar_chunks(vectors[0].tolist(), chat_id="chat")
+    index = retriever._indexes["chat"]
+
+    retriever.on_chunks_stored("chat", 1, make_chunks(vectors[500:2000], start_index=500))
+    assert len(retriever._training) == 1 and not index.trained
+    await asyncio.sleep(0)  # Let the fit start on its thread
+    retriever.on_chunks_stored("chat", 2, make_chunks(vectors[2000:]), document_name="b.pdf")
+    retriever.on_chunks_stored("chat", 1, make_chunks(vectors[2000:2001]))  # Rewrites chunk 0 of a.pdf
+    assert len(retriever._training) == 1
+
+    await retriever.flush()
+
+    assert index.trained and len(index.assignments) == len(index) == 2200
+    assert (index.assignments == index._assign(index.vectors)).all()
+    index.nprobe = len(index.centroids)
+    results = index.search(vectors[2000].tolist(), threshold=0.5, limit=2)
+    assert {(r['document_id'], r['chunk_index']) for r in results} == {(1, 0), (2, 0)}
+    restored, _ = IVFChatIndex.load(str(tmp_path / "chat"), dimension=32, nprobe=4, min_train_size=1000)
+    assert len(restored) == 2200 and restored.trained
+